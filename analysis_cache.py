@@ -0,0 +1,122 @@
+"""
+已解析程序的磁盘缓存,类似python的__pycache__
+
+脚本中的全部表达式经过GenExp与analyze后(树遍历模式,包括位置信息)用pickle保存在脚本旁的__lispcache__目录中,
+以源码、位置中的输入序号、解释器源码与python版本的哈希为键,键不符时视为未命中并重新生成
+键与程序分别pickle,先读出键比较,键不符时不再反序列化程序
+"""
+from __future__ import annotations
+import gc
+import os
+import sys
+from contextlib import contextmanager
+import pickle
+import hashlib
+from analyze_eval import analyze, Exp, EndOfSource
+from interpreter import StrGen, TokenGen, GenExp
+import interpreter
+import analyze_eval
+from lisp_shell_config import CACHE_DIR
+
+# 缓存格式变化时修改
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.lispc'
+# 解析结果依赖于这些模块的实现
+SOURCE_MODULES = ('analyze_eval', 'interpreter')
+CHUNK_SIZE = 1 << 16
+
+_interpreter_hash: str|None = None
+
+
+def interpreter_hash() -> str:
+    """解释器实现的哈希:解析与analyze相关的源码改变后旧缓存自动失效"""
+    global _interpreter_hash
+    if _interpreter_hash is None:
+        digest = hashlib.sha256(f'{CACHE_VERSION} {sys.version}'.encode())
+        for name in SOURCE_MODULES:
+            with open(sys.modules[name].__file__, 'rb') as f: # type:ignore
+                digest.update(f.read())
+        _interpreter_hash = digest.hexdigest()
+    return _interpreter_hash
+
+
+def cache_key(source: str, time: int) -> str:
+    digest = hashlib.sha256(interpreter_hash().encode())
+    # 分数字面量的解析结果取决于EXACT_FRACTION,是否折叠常量取决于CONSTANT_FOLDING
+    digest.update(f'{time} {interpreter.EXACT_FRACTION} {analyze_eval.CONSTANT_FOLDING}\n'.encode())
+    digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def cache_path(path: str) -> str:
+    """path对应的缓存文件:CACHE_DIR为None时位于脚本所在目录的__lispcache__中"""
+    directory, name = os.path.split(os.path.abspath(path))
+    cache_dir = CACHE_DIR if CACHE_DIR is not None else os.path.join(directory, '__lispcache__')
+    return os.path.join(cache_dir, name + CACHE_SUFFIX)
+
+
+def analyze_program(source: str, time: int = 1) -> list[Exp]:
+    """解析并analyze source中的全部表达式,出错时抛出对应的InterpretError"""
+    tokengen = TokenGen(StrGen(source, CHUNK_SIZE), time)
+    program = []
+    while True:
+        try:
+            exp = GenExp(tokengen)
+        except EndOfSource:
+            return program
+        program.append(analyze(exp))
+
+
+@contextmanager
+def gc_paused():
+    """
+    序列化与反序列化会产生大量对象,期间暂停循环垃圾回收(否则反复触发的回收占去大部分时间)
+    不冻结(gc.freeze)加载的对象:那会影响整个进程,由短时运行的lisp_run在加载后自行决定
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def load(path: str, key: str) -> list[Exp]|None:
+    try:
+        with open(cache_path(path), 'rb') as f:
+            if pickle.load(f) != key:
+                return None
+            # 只有命中时才反序列化程序
+            with gc_paused():
+                return pickle.load(f)
+    except Exception:
+        # 不存在或损坏的缓存都视为未命中
+        return None
+
+
+def store(path: str, key: str, program: list[Exp]) -> None:
+    """先写入临时文件再替换,写入失败(如目录不可写或程序不能pickle)时忽略"""
+    target = cache_path(path)
+    temp = f'{target}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(temp, 'wb') as f, gc_paused():
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(program, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, target)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError, RecursionError):
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+
+
+def load_program(path: str, source: str, time: int = 1) -> list[Exp]:
+    """返回path处源码source解析后的全部表达式,命中缓存时不再解析"""
+    key = cache_key(source, time)
+    program = load(path, key)
+    if program is None:
+        program = analyze_program(source, time)
+        store(path, key, program)
+    return program
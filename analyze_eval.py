@@ -1,8 +1,17 @@
 from __future__ import annotations
-from typing import NamedTuple, TypeAlias, NoReturn,Any,Iterable,Generator
-from collections import UserList, ChainMap,UserString,deque
+from typing import NamedTuple, TypeAlias, NoReturn,Any,Iterable,Generator,Callable
+from collections import UserList, ChainMap,deque,OrderedDict
 from abc import ABC, abstractmethod
 from abc import ABC, abstractmethod
+from fractions import Fraction
+from functools import reduce
+from itertools import repeat
+from array import array
+import pickle
+import csv
+import mmap
+import sys
+import threading
 
 class LocationInterface(ABC):
     @abstractmethod
@@ -20,16 +29,26 @@ class Token(NamedTuple):
     location: Location
     where: int #用于指示token在源代码中的位置
 
-Symbol:TypeAlias=UserString
+class Symbol(str):
+    """
+    驻留的符号:同名符号全局只有一个对象,可以用is比较,哈希值由str缓存
+    符号本身不携带位置信息,源码位置记录在所在Compound_的位置表中
+    """
+    __slots__ = ()
+    table: dict[str, Symbol] = {}
 
-# self.data 存储数据
-class Symbol_(UserString,LocationInterface):
-    def __init__(self, token: Token):
-        super().__init__(token.value)
-        self.location = token.location
+    def __new__(cls, name: str) -> Symbol:
+        symbol = cls.table.get(name)
+        if symbol is None:
+            symbol = cls.table[name] = super().__new__(cls, name)
+        return symbol
 
-    def location_message(self):
-        return f'Cell<input> In[{self.location.time}], line {self.location.line}, col {self.location.col}</input>\n'
+    def __reduce__(self):
+        return (Symbol, (str(self),))
+
+
+def location_message(location: Location) -> str:
+    return f'Cell<input> In[{location.time}], line {location.line}, col {location.col}</input>\n'
 
 # self.data 存储数据
 class Compound(UserList):
@@ -47,10 +66,10 @@ class Compound(UserList):
             raise LispSyntaxError(f'{cls.__name__} usagefault.\n correct usage: {cls.__doc__}',exp)
         
     @classmethod
-    def analysis(cls,exp:Compound)->Compound|None:
+    def analysis(cls,exp:Compound,scope:Scope|None=None)->Compound|None:
         return exp
     
-    def evaluate(self,env:Environment,exp_queue:list[Exp])->Atom|Environment:
+    def evaluate(self,env:Environment,exp_queue:list[Exp])->Atom|Frame:
         now_exp = self.data
         if not now_exp:
             return None
@@ -58,10 +77,10 @@ class Compound(UserList):
         if not callable(first):
             raise LispTypeError('first element must be a procedure or operator',self)
         
-        other = iter(eval(i,env)for i in now_exp[1:])       
         if isinstance(first, Procedure):
             # 过程调用
             if first.need_tail_optimization():
+                other = iter(eval(i,env)for i in now_exp[1:])
                 try:
                     # 捕获过程中的错误
                     env_new,last_body=first(other)
@@ -86,10 +105,16 @@ class Compound(UserList):
                     else:
                         raise LispError(str(e),self) from None
         else:
-            other = iter(eval(i,env)for i in now_exp[1:])            
             try:
                 # 捕获过程中的错误
-                return first(other) 
+                if isinstance(first, Operator) and not first.lazy:
+                    # 一、二个参数时走快速入口
+                    length = len(now_exp)
+                    if length == 2:
+                        return first.call1(eval(now_exp[1],env))
+                    if length == 3:
+                        return first.call2(eval(now_exp[1],env),eval(now_exp[2],env))
+                return first(iter(eval(i,env)for i in now_exp[1:]))
             except Exception as e:
                 if isinstance(e, LispError):
                     # 传递错误，加入调用栈信息
@@ -97,13 +122,615 @@ class Compound(UserList):
                 else:
                     raise LispError(str(e),self) from None
 
+    def compile(self,tail:bool=False)->Code:
+        """
+        编译为执行闭包(SICP中的execution procedure),只在analyze时做一次分派
+        tail为真表示处于过程体的尾位置,此时过程调用不直接执行,而是返回TailCall交给外层蹦床
+        """
+        if not self.data:
+            return lambda env: None
+        first_code = compile_exp(self.data[0])
+        args_code = [compile_exp(i) for i in self.data[1:]]
+        exp = self
+        # 一、二个参数时内置操作走快速入口
+        length = len(args_code)
+        fast = length == 1 or length == 2
+        arg0 = args_code[0] if length > 0 else None
+        arg1 = args_code[1] if length > 1 else None
+
+        def run(env:Environment):
+            global STACK_CHECK
+            first = first_code(env)
+            if not callable(first):
+                raise LispTypeError('first element must be a procedure or operator',exp)
+            if isinstance(first, Procedure):
+                try:
+                    args = [code(env) for code in args_code]
+                    if not first.need_tail_optimization():
+                        return first.no_tail_call(iter(args))
+                    if tail:
+                        return TailCall(first, args, exp)
+                    STACK_CHECK += 1
+                    deep = not STACK_CHECK & STACK_CHECK_MASK and stack_is_deep()
+                    if deep:
+                        if len(args) != len(first.parms):
+                            raise LispTypeError(f'error arguments number')
+                    else:
+                        env_new, last_code = first.enter(args)
+                except Exception as e:
+                    if isinstance(e, LispError):
+                        raise e(exp)
+                    else:
+                        raise LispProcError(str(e),exp) from None
+                if deep:
+                    # python栈将要用尽:过程体改在显式栈上求值
+                    from machine import call
+                    return call(first, args, exp)
+                return trampoline(last_code(env_new))
+            try:
+                if fast and isinstance(first, Operator) and not first.lazy:
+                    if length == 1:
+                        return first.call1(arg0(env))# type:ignore
+                    return first.call2(arg0(env), arg1(env))# type:ignore
+                # 参数以生成器传递,保持and/or的短路求值
+                return first(code(env) for code in args_code)
+            except Exception as e:
+                if isinstance(e, LispError):
+                    raise e(exp)
+                else:
+                    raise LispError(str(e),exp) from None
+        return run
+
+
+
+class Pair:
+    """
+    不可变的序对(cons cell):cdr与原表共享结构,cons/car/cdr均为O(1)
+    表尾为一个Compound(通常是空表),length在cons时即已确定
+    """
+    __slots__ = ('car', 'cdr', 'length')
+
+    def __init__(self, car: Exp, cdr: Pair|Compound):
+        self.car = car
+        self.cdr = cdr
+        self.length = len(cdr) + 1
+
+    @classmethod
+    def from_items(cls, items: list[Exp], tail: Pair|Compound|None=None) -> Pair|Compound:
+        """由items依次cons到tail(默认空表)上,tail被共享"""
+        result = Compound([]) if tail is None else tail
+        for item in reversed(items):
+            result = cls(item, result)
+        return result
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        node = self
+        while type(node) is Pair:
+            yield node.car
+            node = node.cdr
+        yield from node
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, (Pair, Compound, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None # type:ignore
+
+    def __str__(self):
+        return f"({' '.join(map(str, self))})"
+
+
+# 内置的表操作同时接受Compound与Pair
+LIST_TYPES = (Compound, Pair)
+
+
+def structural_key(value: Any) -> Any:
+    """
+    可哈希的结构化键:元素相同的表(Compound或Pair)得到相同的键
+    原子带上类型,使1、1.0与#t互不相同;过程等其他对象按身份区分
+    """
+    if isinstance(value, LIST_TYPES):
+        return (Compound, tuple(map(structural_key, value)))
+    if isinstance(value, Symbol):
+        return value
+    return (type(value), value)
+
+
+def numpy_module():
+    """向量依赖numpy,在第一次建立向量时才导入,未安装时报错"""
+    try:
+        import numpy
+    except ImportError:
+        raise LispTypeError('vector requires numpy') from None
+    return numpy
+
+
+def unwrap(x: Any) -> Any:
+    return x.array if type(x) is Vector else x
+
+
+def to_python(x: Any) -> Any:
+    """numpy的数转换为python的数,object数组中的元素本来就是python的数"""
+    return x.item() if hasattr(x, 'item') else x
+
+
+# int64运算的结果估计不小于该值时可能已经溢出(float64的估计有误差,留出余量)
+INT64_CHECK = 2.0 ** 62
+
+
+def numpy_apply(func: Callable, *operands: Any) -> Any:
+    """
+    按numpy的规则计算func(*operands),不输出溢出与除零等警告
+    结果为int64时先用float64估计其大小,可能溢出(或者python整数超出int64)时改用python整数(object数组)重新计算,
+    重新计算的结果仍在int64范围内时转回int64
+    """
+    np = numpy_module()
+    with np.errstate(all='ignore'):
+        try:
+            result = func(*operands)
+        except OverflowError:
+            pass
+        else:
+            if getattr(result, 'dtype', None) != np.int64:
+                return result
+            estimate = func(*(x.astype(np.float64) if isinstance(x, np.ndarray) else float(x) for x in operands))
+            if (np.abs(estimate) < INT64_CHECK).all():
+                return result
+        result = func(*(x.astype(object) if isinstance(x, np.ndarray) else x for x in operands))
+    if isinstance(result, np.ndarray):
+        try:
+            return result.astype(np.int64)
+        except OverflowError:
+            pass
+    return result
+
+
+class Vector:
+    """
+    由numpy数组支持的数值向量,算术与比较按numpy的规则广播,结果仍为Vector
+    元素只能是整数(int64)或浮点数(float64),整数超出int64时改为python整数(object数组);取出的元素转换为python的数
+    """
+    __slots__ = ('array',)
+    # 超过该长度时只打印首尾的元素
+    PRINT_LIMIT = 20
+
+    def __init__(self, array: Any):
+        self.array = array
+
+    @classmethod
+    def from_items(cls, items: Any) -> Vector:
+        np = numpy_module()
+        items = list(items)
+        for item in items:
+            if not isinstance(item, NUMBER_TYPES) or isinstance(item, bool):
+                raise LispTypeError('vector elements must be numbers')
+        exact = all(type(item) is int for item in items)
+        try:
+            return cls(np.array(items, dtype=np.int64 if exact else np.float64))
+        except OverflowError:
+            return cls(np.array(items, dtype=object if exact else np.float64))
+
+    @classmethod
+    def range(cls, start: Number, stop: Number|None=None, step: Number=1) -> Vector:
+        if stop is None:
+            start, stop = 0, start
+        if not step:
+            raise LispTypeError('vector-range step must not be zero')
+        np = numpy_module()
+        exact = all(type(x) is int for x in (start, stop, step))
+        return cls(np.arange(start, stop, step, dtype=np.int64 if exact else np.float64))
+
+    def __add__(self, other): return Vector(numpy_apply(op.add, self.array, unwrap(other)))
+    def __radd__(self, other): return Vector(numpy_apply(op.add, unwrap(other), self.array))
+    def __sub__(self, other): return Vector(numpy_apply(op.sub, self.array, unwrap(other)))
+    def __rsub__(self, other): return Vector(numpy_apply(op.sub, unwrap(other), self.array))
+    def __mul__(self, other): return Vector(numpy_apply(op.mul, self.array, unwrap(other)))
+    def __rmul__(self, other): return Vector(numpy_apply(op.mul, unwrap(other), self.array))
+    def __truediv__(self, other): return Vector(numpy_apply(op.truediv, self.array, unwrap(other)))
+    def __rtruediv__(self, other): return Vector(numpy_apply(op.truediv, unwrap(other), self.array))
+    def __floordiv__(self, other): return Vector(numpy_apply(op.floordiv, self.array, unwrap(other)))
+    def __rfloordiv__(self, other): return Vector(numpy_apply(op.floordiv, unwrap(other), self.array))
+    # 比较得到布尔向量,反向比较由python自动交换
+    def __lt__(self, other): return Vector(numpy_apply(op.lt, self.array, unwrap(other)))
+    def __le__(self, other): return Vector(numpy_apply(op.le, self.array, unwrap(other)))
+    def __gt__(self, other): return Vector(numpy_apply(op.gt, self.array, unwrap(other)))
+    def __ge__(self, other): return Vector(numpy_apply(op.ge, self.array, unwrap(other)))
+    def __eq__(self, other): return Vector(numpy_apply(op.eq, self.array, unwrap(other))) # type:ignore
+    def __and__(self, other): return Vector(self.array & unwrap(other))
+    def __abs__(self): return Vector(numpy_apply(abs, self.array))
+
+    __hash__ = None # type:ignore
+
+    def __bool__(self):
+        raise LispTypeError('the truth value of a vector is ambiguous')
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.array.tolist())
+
+    def ref(self, i: int) -> Number:
+        if not -len(self.array) <= i < len(self.array):
+            raise LispTypeError('vector index out of range')
+        return to_python(self.array[i])
+
+    def sum(self) -> Number:
+        return to_python(numpy_apply(lambda array: array.sum(), self.array))
+
+    def prod(self) -> Number:
+        return to_python(numpy_apply(lambda array: array.prod(), self.array))
+
+    def mean(self) -> float:
+        if not len(self.array):
+            raise LispTypeError('mean of an empty vector')
+        return to_python(numpy_apply(lambda array: array.mean(), self.array))
+
+    def dot(self, other: Vector) -> Number:
+        if len(self.array) != len(other.array):
+            raise LispTypeError('vector-dot needs vectors of the same length')
+        return to_python(numpy_apply(lambda a, b: a.dot(b), self.array, other.array))
+
+    def to_list(self) -> Compound:
+        return Compound(self.array.tolist())
+
+    def __str__(self) -> str:
+        def show(items):
+            return ' '.join(map(str, items))
+        array = self.array
+        if len(array) > self.PRINT_LIMIT:
+            half = self.PRINT_LIMIT // 2
+            return f'#({show(array[:half].tolist())} ... {show(array[-half:].tolist())})'
+        return f'#({show(array.tolist())})'
+
+
+class HashTable:
+    """
+    可变的哈希表,以键的structural_key在dict中存放(键, 值)
+    元素相同的表作为同一个键;作为键的表在插入后被修改不会改变已存入的键
+    """
+    __slots__ = ('items',)
+
+    def __init__(self):
+        self.items: dict[Any, tuple[Exp, Exp]] = {}
+
+    @staticmethod
+    def key(key: Exp) -> Any:
+        key_ = structural_key(key)
+        try:
+            hash(key_)
+        except TypeError:
+            raise LispTypeError(f'unhashable key {key}') from None
+        return key_
+
+    def ref(self, key: Exp, *default: Exp) -> Exp:
+        try:
+            return self.items[self.key(key)][1]
+        except KeyError:
+            if default:
+                return default[0]
+            raise LispKeyError(f'key not found {key}') from None
+
+    def set(self, key: Exp, value: Exp) -> None:
+        key_ = self.key(key)
+        item = self.items.get(key_)
+        # 已有的键保留最初插入的对象
+        self.items[key_] = (key if item is None else item[0], value)
+
+    def delete(self, key: Exp) -> None:
+        self.items.pop(self.key(key), None)
+
+    def contains(self, key: Exp) -> bool:
+        return self.key(key) in self.items
+
+    def update(self, key: Exp, func: Any, *default: Exp) -> Exp:
+        """把键对应的值替换为(func 值),键不存在时使用default,返回新的值"""
+        value = func_call(func, [self.ref(key, *default)])
+        self.set(key, value)
+        return value
+
+    def keys(self) -> Compound:
+        return Compound([item[0] for item in self.items.values()])
+
+    def values(self) -> Compound:
+        return Compound([item[1] for item in self.items.values()])
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __str__(self) -> str:
+        return f'#<hash-table {len(self.items)}>'
+
+
+class Promise:
+    """
+    delay产生的承诺:第一次force时求值thunk并记住结果,之后的force直接返回结果
+    求值出错时不记住,再次force会重新求值
+    """
+    __slots__ = ('thunk', 'value')
+
+    def __init__(self, thunk: Callable[[], Exp]):
+        self.thunk: Callable[[], Exp]|None = thunk
+        self.value: Exp = None
+
+    def force(self) -> Exp:
+        thunk = self.thunk
+        if thunk is None:
+            return self.value
+        value = thunk()
+        # thunk求值期间可能已经被force过,以先得到的结果为准
+        if self.thunk is not None:
+            self.value = value
+            self.thunk = None
+        return self.value
+
+    def __str__(self) -> str:
+        return '#<promise>'
+
+
+class Stream:
+    """cons-stream产生的流:car已经求值,cdr为求值流的其余部分的Promise,空流为空表"""
+    __slots__ = ('car', 'cdr')
+
+    def __init__(self, car: Exp, cdr: Promise):
+        self.car = car
+        self.cdr = cdr
+
+    def rest(self) -> Stream|Compound:
+        return self.cdr.force()
+
+    def __str__(self) -> str:
+        return f'({self.car} . {self.cdr})'
+
+
+def force(x: Exp) -> Exp:
+    """不是Promise的值原样返回"""
+    return x.force() if type(x) is Promise else x
+
+
+def stream_check(x: Exp) -> bool:
+    """x为非空的流时为真,为空表时为假,否则报错"""
+    if type(x) is Stream:
+        return True
+    if isinstance(x, LIST_TYPES) and not len(x):
+        return False
+    raise LispTypeError('expected a stream')
+
+
+def stream_map(func: Any, streams: list[Stream|Compound]) -> Stream|Compound:
+    """(stream-map f s1 s2 ...):任一个流结束时结束,其余部分在被访问时才求值"""
+    if not all([stream_check(s) for s in streams]):
+        return Compound([])
+    return Stream(func_call(func, [s.car for s in streams]),
+                  Promise(lambda: stream_map(func, [s.rest() for s in streams])))
+
+
+def stream_filter(func: Any, stream: Stream|Compound) -> Stream|Compound:
+    """跳过不满足条件的元素时逐个force,不产生递归"""
+    while stream_check(stream):
+        if func_call(func, [stream.car]):
+            rest = stream
+            return Stream(stream.car, Promise(lambda: stream_filter(func, rest.rest())))
+        stream = stream.rest() # type:ignore
+    return Compound([])
+
+
+def stream_take(stream: Stream|Compound, n: int) -> Stream|Compound:
+    """前n个元素组成的流,不会force第n个元素之后的部分"""
+    if n <= 0 or not stream_check(stream):
+        return Compound([])
+    return Stream(stream.car, Promise(lambda: stream_take(stream.rest(), n - 1) if n > 1 else Compound([])))
+
+
+def stream_to_list(stream: Stream|Compound, n: int|None = None) -> Compound:
+    """把流(的前n个元素)转换为列表,无限的流须给出n"""
+    result = []
+    while (n is None or len(result) < n) and stream_check(stream):
+        result.append(stream.car)
+        if len(result) == n:
+            # 不force第n个元素之后的部分
+            break
+        stream = stream.rest() # type:ignore
+    return Compound(result)
+
+
+def iterator_stream(iterator: Any) -> Stream|Compound:
+    """由python迭代器逐个取元素的流"""
+    for item in iterator:
+        return Stream(item, Promise(lambda: iterator_stream(iterator)))
+    return Compound([])
+
+
+def read_lines(path: str) -> Generator[str, None, None]:
+    with open(path, encoding='utf-8', newline='', buffering=FILE_BUFFER_SIZE) as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def file_lines(path: str) -> Stream|Compound:
+    """
+    (file-lines path):文件各行(不含换行符)组成的流,读到哪一行才从文件中读取到哪一行,读完时关闭文件
+    不保留流的开头时,已经处理过的行可以被回收
+    """
+    return iterator_stream(read_lines(path))
+
+
+def read_blocks(path: str, size: int) -> Generator[bytes, None, None]:
+    """通过mmap按约size字节的块读取文件,每块在换行处结束,内存占用与文件大小无关"""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件不能mmap
+            return
+        with data:
+            start = 0
+            length = len(data)
+            while start < length:
+                end = data.find(b'\n', min(start + size, length) - 1)
+                end = length if end < 0 else end + 1
+                yield data[start:end]
+                start = end
+
+
+class CsvColumn:
+    """
+    读取csv时的一列:先按整数存放在array('q')中,遇到非整数时转换为array('d'),
+    遇到不是数的值时转换为文本(已读取的数转换为其字符串形式);数值列中的空值为nan
+    """
+    __slots__ = ('kind', 'data')
+
+    def __init__(self):
+        self.kind = 'int'
+        self.data: Any = array('q')
+
+    @staticmethod
+    def to_float(value: str) -> float:
+        return float(value) if value.strip() else math.nan
+
+    def extend(self, values: list[str]) -> None:
+        if self.kind == 'int':
+            try:
+                self.data.extend(array('q', map(int, values)))
+                return
+            except (ValueError, OverflowError):
+                self.kind = 'float'
+                self.data = array('d', self.data)
+        if self.kind == 'float':
+            try:
+                try:
+                    self.data.extend(array('d', map(float, values)))
+                except ValueError:
+                    self.data.extend(array('d', map(self.to_float, values)))
+                return
+            except ValueError:
+                self.kind = 'text'
+                self.data = [str(i) for i in self.data]
+        self.data.extend(values)
+
+    def value(self) -> Vector|Compound:
+        """数值列为共享存储的Vector(没有numpy时为列表),文本列为列表"""
+        if self.kind == 'text':
+            return Compound(self.data)
+        try:
+            np = numpy_module()
+        except LispTypeError:
+            return Compound(self.data.tolist())
+        return Vector(np.frombuffer(self.data, dtype=np.int64 if self.kind == 'int' else np.float64))
+
+
+def check_fields(lines: list[str], width: int, row: int, quoted: bool) -> list[list[str]]|None:
+    """
+    检查若干行csv的字段数都为width,row为第一行的行号,用于报错
+    有引号时用csv模块逐行拆分,返回各列的字段;否则只数逗号,返回None
+    """
+    if quoted:
+        rows = list(csv.reader(lines))
+        for i, fields in enumerate(rows):
+            if len(fields) != width:
+                raise LispTypeError(f'row {row + i} has {len(fields)} fields, expected {width}')
+        return [list(column) for column in zip(*rows)]
+    if {*map(str.count, lines, repeat(','))} != {width - 1}:
+        for i, count in enumerate(map(str.count, lines, repeat(','))):
+            if count != width - 1:
+                raise LispTypeError(f'row {row + i} has {count + 1} fields, expected {width}')
+    return None
+
+
+def split_fields(lines: list[str], width: int) -> list[list[str]]:
+    """没有引号的若干行拆分为各列:整块拼接后一次split再按步长切片,不逐行建立列表"""
+    fields = ','.join(lines).split(',')
+    return [fields[i::width] for i in range(width)]
+
+
+def load_numeric(np: Any, lines: list[str], columns: list[CsvColumn]) -> set[int]:
+    """
+    有numpy且没有引号时用loadtxt直接解析整块中的整数列与浮点数列,不为每个字段建立str,返回已解析的列
+    某组列中有不能按其类型解析的值(如需要提升类型或有空值)时,该组留给split_fields处理
+    """
+    done: set[int] = set()
+    for kind, dtype in (('int', np.int64), ('float', np.float64)):
+        usecols = [i for i, column in enumerate(columns) if column.kind == kind]
+        if not usecols:
+            continue
+        try:
+            values = np.loadtxt(lines, dtype=dtype, delimiter=',', usecols=usecols, ndmin=2,
+                                comments=None, quotechar=None)
+        except ValueError:
+            continue
+        for j, i in enumerate(usecols):
+            columns[i].data.frombytes(values[:, j].tobytes())
+        done.update(usecols)
+    return done
+
+
+def read_csv(path: str) -> HashTable:
+    """
+    (read-csv path):第一行为列名,返回以列名(符号)为键、以列为值的哈希表,列的顺序即插入顺序
+    按块读取文件,每块的各列一次性转换类型;空行被跳过,字段中不能有换行
+    """
+    try:
+        np = numpy_module()
+    except LispTypeError:
+        np = None
+    table = HashTable()
+    names: list[Symbol]|None = None
+    columns: list[CsvColumn] = []
+    row = 1
+    for block in read_blocks(path, CSV_BLOCK_SIZE):
+        text = block.decode('utf-8-sig' if names is None else 'utf-8')
+        lines = text.splitlines()
+        if '' in lines:
+            lines = [line for line in lines if line]
+        if names is None:
+            if not lines:
+                continue
+            names = [Symbol(name.strip()) for name in next(csv.reader(lines[:1]))]
+            columns = [CsvColumn() for _ in names]
+            lines = lines[1:]
+        if not lines:
+            continue
+        # 总是检查每行的字段数,loadtxt在usecols之外多出的字段不会报错
+        fields = check_fields(lines, len(names), row + 1, '"' in text)
+        done = load_numeric(np, lines, columns) if np is not None and fields is None else set()
+        if len(done) < len(columns):
+            if fields is None:
+                fields = split_fields(lines, len(names))
+            for i, column in enumerate(columns):
+                if i not in done:
+                    column.extend(fields[i])
+        row += len(lines)
+    for name, column in zip(names or [], columns):
+        table.set(name, column.value())
+    return table
+
+
+def func_call(func: Any, args: list[Exp]) -> Exp:
+    """在内置过程中调用过程或内置操作,与map中的调用方式相同"""
+    if not callable(func):
+        raise LispTypeError(f'first element must be a procedure or operator')
+    if isinstance(func, Procedure):
+        return func.no_tail_call(iter(args))
+    return func(iter(args))
 
 
 class Compound_(Compound,LocationInterface):
-    def __init__(self, value: list[Exp] ,front: Location|None=None, end: Location|None=None):
+    def __init__(self, value: list[Exp] ,front: Location|None=None, end: Location|None=None,
+                 locations: list[Location|None]|None=None):
         super().__init__(value)
         self.front = front
         self.end = end
+        # 位置表:第i项为第i个原子子表达式的位置,子表达式为Compound_时为None(其位置由自身记录)
+        self.locations = locations if locations is not None else []
+
+    def add(self, exp: Exp, location: Location|None=None) -> None:
+        """加入子表达式,同时记录其位置"""
+        self.data.append(exp)
+        self.locations.append(location)
 
     def location_message(self):
         return (f'Cell<input> In[{self.front.time}]</input>\n'
@@ -111,9 +738,34 @@ class Compound_(Compound,LocationInterface):
             f'To <input>line {self.end.line}, col {self.end.col}</input>\n')
     
 
-Number:TypeAlias=int|float
+Number:TypeAlias=int|float|Fraction
+# 分数字面量在EXACT_FRACTION打开时保留为Fraction
+NUMBER_TYPES = (int, float, Fraction)
+# 算术与比较操作还接受向量
+NUMERIC_TYPES = (int, float, Fraction, Vector)
 Atom:TypeAlias=Number|bool|Symbol|None
 Exp:TypeAlias=Compound|Atom
+Code:TypeAlias=Callable[['Environment'],Any]
+
+ELSE = Symbol('else')
+DEFINE = Symbol('define')
+DEFINE_MEMO = Symbol('define-memo')
+BEGIN = Symbol('begin')
+LAMBDA = Symbol('lambda')
+# do展开为named let时循环的名字,含空格,源码中不会出现
+DO_LOOP = Symbol('do loop')
+
+
+def location_of(exp: Compound, i: int) -> Location|None:
+    """从exp的位置表中取出第i个子表达式的位置,运行中生成的表达式没有位置"""
+    if isinstance(exp, Compound_) and i < len(exp.locations):
+        return exp.locations[i]
+    return None
+
+
+def analyze_item(exp: Compound, i: int, scope: Scope|None) -> Exp:
+    """解析exp的第i个子表达式,并带上其在源码中的位置"""
+    return analyze(exp[i], scope=scope, location=location_of(exp, i))
 
 
 class If(Compound):
@@ -124,23 +776,37 @@ class If(Compound):
         self.alternative = alternative
 
     @classmethod
-    def analysis(cls,exp:Compound) -> If|None:
+    def analysis(cls,exp:Compound,scope:Scope|None=None) -> If|None:
         if len(exp) != 3 and len(exp) != 4:
             cls.raise_error(exp)
 
-        condition = analyze(exp[1])
-        consequence = analyze(exp[2])
+        condition = analyze_item(exp, 1, scope)
+        consequence = analyze_item(exp, 2, scope)
         if len(exp) == 4:
-            alternative = analyze(exp[3])
+            alternative = analyze_item(exp, 3, scope)
         else:
             alternative = None
         return If(condition, consequence, alternative)
         
     def evaluate(self,env:Environment,exp_queue:list[Exp]):
-        if eval(self.condition,env):
-            exp_queue.insert(0,self.consequence)
-        else:
-            exp_queue.insert(0,self.alternative)
+        try:
+            chosen = self.consequence if eval(self.condition,env) else self.alternative
+        except LispError as e:
+            raise e.locate(self.condition)
+        exp_queue.insert(0,chosen)
+
+    def compile(self,tail:bool=False)->Code:
+        condition = compile_exp(self.condition)
+        consequence = compile_exp(self.consequence,tail)
+        alternative = compile_exp(self.alternative,tail)
+        condition_exp = self.condition
+        def run(env:Environment):
+            try:
+                chosen = consequence if condition(env) else alternative
+            except LispError as e:
+                raise e.locate(condition_exp)
+            return chosen(env)
+        return run
         
     def __str__(self):
         return f"(if {self.condition} {self.consequence} {self.alternative})"
@@ -151,11 +817,11 @@ class Begin(Compound):
         self.expressions = expressions
 
     @classmethod
-    def analysis(cls, exp: Compound)->Begin|None:
+    def analysis(cls, exp: Compound,scope:Scope|None=None)->Begin|None:
         if len(exp) < 2:
             cls.raise_error(exp)
 
-        expressions = [analyze(e) for e in exp[1:]]
+        expressions = [analyze_item(exp, i, scope) for i in range(1, len(exp))]
         return Begin(expressions)
 
         
@@ -165,6 +831,15 @@ class Begin(Compound):
         # 最后一个表达式加入队列,以便优化尾递归
         exp_queue.insert(0,self.expressions[-1])
 
+    def compile(self,tail:bool=False)->Code:
+        body = [compile_exp(exp) for exp in self.expressions[:-1]]
+        last = compile_exp(self.expressions[-1],tail)
+        def run(env:Environment):
+            for code in body:
+                code(env)
+            return last(env)
+        return run
+
     def __str__(self):
         return f"(begin {' '.join(map(str, self.expressions))})"
 
@@ -177,7 +852,7 @@ class Cond(Compound):
         self.clauses = clauses
 
     @classmethod
-    def analysis(cls, exp: Compound) -> Cond | None:
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Cond | None:
         if len(exp) < 2:
             cls.raise_error(exp)
 
@@ -185,15 +860,15 @@ class Cond(Compound):
         for clause in exp[1:]:
             if isinstance(clause, Compound):
                 # Check for 'else' clause
-                if len(clause) == 2 and isinstance(clause[0], Symbol) and clause[0] == 'else':
+                if len(clause) == 2 and clause[0] is ELSE:
                     if exp.index(clause) != len(exp) - 1:  # Ensure 'else' is the last clause
                         cls.raise_error(clause,"Else clause must be the last one.")
-                    expression = analyze(clause[1])
+                    expression = analyze_item(clause, 1, scope)
                     clauses.append((None, expression))  # None signifies the 'else' clause
                     break  # Stop further clause processing after 'else'
                 elif len(clause) == 2:
-                    predicate = analyze(clause[0])
-                    expression = analyze(clause[1])
+                    predicate = analyze_item(clause, 0, scope)
+                    expression = analyze_item(clause, 1, scope)
                     clauses.append((predicate, expression)) #type:ignore
                 else:
                     cls.raise_error(clause)
@@ -203,25 +878,48 @@ class Cond(Compound):
 
     def evaluate(self, env: Environment, exp_queue: list[Exp]):
         for predicate, expression in self.clauses:
-            if predicate is None or eval(predicate, env):  # 'None' is for 'else' case
-                return exp_queue.insert(0, expression)
+            try:
+                if predicate is None or eval(predicate, env):  # 'None' is for 'else' case
+                    return exp_queue.insert(0, expression)
+            except LispError as e:
+                raise e.locate(predicate)
         return None
+
+    def compile(self,tail:bool=False)->Code:
+        clauses = [(None if predicate is None else compile_exp(predicate), compile_exp(expression,tail), predicate)
+                   for predicate, expression in self.clauses]
+        def run(env:Environment):
+            for predicate, expression, predicate_exp in clauses:
+                try:
+                    if predicate is not None and not predicate(env):
+                        continue
+                except LispError as e:
+                    raise e.locate(predicate_exp)
+                return expression(env)
+            return None
+        return run
         
     def __str__(self):
         result = '(cond '
         for i in self.clauses:
-            result += f' ({i[0] or "else"} {i[1]})'  # Use 'else' for the 'None' predicate
+            result += f' ({"else" if i[0] is None else i[0]} {i[1]})'  # Use 'else' for the 'None' predicate
         return result + ')'
 
     
 class Lambda(Compound):
     """(lambda (parameter1 parameter2 ... parameterN) body)"""
-    def __init__(self,parameters:list[Symbol], body:list[Exp]):
+    def __init__(self,parameters:list[Symbol], body:list[Exp], scope:Scope, location:Location|None=None):
         self.parameters = parameters
         self.body = body
+        # 过程体对应的词法作用域,决定调用时帧的大小
+        self.scope = scope
+        self.code: tuple[list[Code],Code]|None = None
+        # 定义处的名字与位置,用于profile等按过程汇总的信息
+        self.name: Symbol|None = None
+        self.location = location
 
     @classmethod
-    def analysis(cls, exp:Compound)->Lambda|None:
+    def analysis(cls, exp:Compound,scope:Scope|None=None)->Lambda|None:
         if len(exp) < 3 or not isinstance(exp[1], Compound):
             cls.raise_error(exp)
 
@@ -231,33 +929,65 @@ class Lambda(Compound):
                 parameters.append(i)
             else:
                 cls.raise_error(i, 'parameter must be a symbol')     
-        body = [analyze(i) for i in exp[2:]]
-        if body==[]:
+        return cls.make(parameters, exp, 2, scope)
+
+    @classmethod
+    def make(cls, parameters:list[Symbol], exp:Compound, start:int, scope:Scope|None)->Lambda:
+        """
+        exp[start:]为过程体
+        以parameters和过程体内部define的变量建立新的作用域,再在其中解析过程体
+        """
+        if len(exp) <= start:
             cls.raise_error(exp,'function body is empty')
-        return Lambda(parameters, body)
+        new_scope = Scope(parameters, scope)
+        new_scope.scan_defines(exp[start:])
+        body = [analyze_item(exp, i, new_scope) for i in range(start, len(exp))]
+        return Lambda(parameters, body, new_scope, exp.front if isinstance(exp, Compound_) else None)
         
     def evaluate(self,env:Environment,exp_queue:list[Exp]):
-        return Procedure(self.parameters, self.body, env)
+        return Procedure(self.parameters, self.body, env, self.scope, source=self)
+
+    def compile(self,tail:bool=False)->Code:
+        # 过程体只编译一次,所有由该lambda产生的闭包共享
+        if self.code is None:
+            self.code = compile_body(self.body)
+        code = self.code
+        return lambda env: Procedure(self.parameters, self.body, env, self.scope, code, self)
     
+    def __getstate__(self):
+        # 编译得到的闭包不能序列化,加载后按需重新编译
+        state = self.__dict__.copy()
+        state['code'] = None
+        return state
+
     def __str__(self):
         return f"(lambda ({' '.join(map(str, self.parameters))}) {' '.join(map(str, self.body))})"
 
 class Define(Compound):
     """(define variable-name value)
        (define (function-name parameter1 parameter2 ... parameterN) body)"""
-    def __init__(self,name:Symbol,value:Exp):
+    def __init__(self,name:Symbol,value:Exp,slot:int|None=None):
         self.name = name
         self.value = value
+        # 过程体内的define写入当前帧的槽位,None表示全局定义
+        self.slot = slot
 
     @classmethod
-    def analysis(cls, exp: Compound)->Define|None:
+    def analysis(cls, exp: Compound,scope:Scope|None=None)->Define|None:
+        if len(exp) < 3:
+            cls.raise_error(exp)
         if isinstance(exp[1], Symbol):
             if len(exp) == 3:
-                value = analyze(exp[2])
-                return Define(exp[1], value)
+                slot = scope.declare(exp[1]) if scope is not None else None
+                value = analyze_item(exp, 2, scope)
+                if isinstance(value, Lambda) and value.name is None:
+                    value.name = exp[1]
+                return Define(exp[1], value, slot)
             else:
                 cls.raise_error(exp)
         else:
+            if not isinstance(exp[1], Compound) or not exp[1]:
+                cls.raise_error(exp)
             name = exp[1][0]
             if not isinstance(name, Symbol):
                 cls.raise_error(exp,'name must be a symbol')
@@ -267,15 +997,33 @@ class Define(Compound):
                     parameters.append(i)
                 else:
                     cls.raise_error(exp,'parameter must be a symbol')
-            body = [analyze(i) for i in exp[2:]]
-            if body==[]:
-                cls.raise_error(exp,'function body is empty')
-            return Define(name, Lambda(parameters, body))
+            slot = scope.declare(name) if scope is not None else None
+            value = Lambda.make(parameters, exp, 2, scope)
+            value.name = name
+            return Define(name, value, slot)
     
     def evaluate(self, env: Environment, exp_queue: list[Exp]):
-        env[str(self.name)] = eval(self.value, env)
+        self.assign(env, eval(self.value, env))
         return None
 
+    def assign(self, env: Environment, value: Any) -> None:
+        if self.slot is None:
+            env[str(self.name)] = value
+        else:
+            env.values[self.slot] = value
+
+    def compile(self,tail:bool=False)->Code:
+        value = compile_exp(self.value)
+        if self.slot is None:
+            name = str(self.name)
+            def run(env:Environment):
+                env[name] = value(env)
+        else:
+            slot = self.slot
+            def run(env:Environment):
+                env.values[slot] = value(env)
+        return run
+
     def __str__(self):
         if isinstance(self.value, Lambda):
             return f"(define ({self.name} {' '.join(map(str, self.value.parameters))}) {' '.join(map(str, self.value.body))})"
@@ -284,25 +1032,44 @@ class Define(Compound):
     
 class Set(Compound):
     """(set! variable new-value)"""
-    def __init__(self,variable:Symbol, value:Exp):
+    def __init__(self,variable:Symbol, value:Exp, address:tuple[int,int]|None=None):
         self.variable = variable
         self.value = value
+        # 局部变量的词法地址(depth, slot),None表示全局变量
+        self.address = address
 
     @classmethod
-    def analysis(cls, exp:Compound)->Set|None:
+    def analysis(cls, exp:Compound,scope:Scope|None=None)->Set|None:
         if len(exp) != 3:
             cls.raise_error(exp)
         variable = exp[1]
         if not isinstance(variable, Symbol):
             cls.raise_error(exp,'variable must be a symbol')
-        value = analyze(exp[2])
-        return Set(variable, value)
+        value = analyze_item(exp, 2, scope)
+        address = scope.resolve(variable) if scope is not None else None
+        return Set(variable, value, address)
         
     def evaluate(self, env: Environment, exp_queue: list[Exp]):
-        try:
-            env.change(self.variable, eval(self.value, env))
-        except KeyError:
-            raise LispNameError(f'undefined variable {self.variable}',self)
+        self.assign(env, eval(self.value, env))
+
+    def assign(self, env: Environment, value: Any) -> None:
+        if self.address is None:
+            try:
+                env.globals.change(str(self.variable), value)
+            except KeyError:
+                raise LispNameError(f'undefined variable {self.variable}',self)
+        else:
+            depth, slot = self.address
+            for _ in range(depth):
+                env = env.parent
+            if env.values[slot] is UNBOUND:
+                raise LispNameError(f'undefined variable {self.variable}',self)
+            env.values[slot] = value
+
+    def compile(self,tail:bool=False)->Code:
+        value = compile_exp(self.value)
+        assign = self.assign
+        return lambda env: assign(env, value(env))
 
     def __str__(self):
         return f"(set! {self.variable} {self.value})"
@@ -313,13 +1080,17 @@ class Quote(Compound):
         self.value = value
 
     @classmethod
-    def analysis(cls, exp: Compound) -> Quote | None:
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Quote | None:
         if len(exp) != 2:
             cls.raise_error(exp)
         return Quote(exp[1])
     
     def evaluate(self, env: Environment, exp_queue: list[Exp]):
         return self.value
+
+    def compile(self,tail:bool=False)->Code:
+        value = self.value
+        return lambda env: value
     
     def __str__(self):
         return f"(quote {self.value})"
@@ -330,55 +1101,857 @@ class Return(Compound):
         self.value = value
 
     @classmethod
-    def analysis(cls, exp: Compound) -> Return | None:
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Return | None:
         if len(exp) != 2:
             cls.raise_error(exp)
-        return Return(exp[1])
+        return Return(analyze_item(exp, 1, scope))
     
     def evaluate(self, env: Environment, exp_queue: list[Exp]):
         return eval(self.value, env)
+
+    def compile(self,tail:bool=False)->Code:
+        # return 关闭尾递归优化,因此总是以非尾位置编译
+        return compile_exp(self.value)
     
     def __str__(self):
         return f"(return {self.value})"
 
-COMPOUND:dict[str,type[Compound]]= {'if': If, 'begin': Begin, 'cond': Cond, 'lambda': Lambda, 'define': Define, 'set!': Set, 'quote': Quote, 'return': Return}
-def analyze(exp: Exp) -> Exp:
+class DefineMemo(Compound):
+    """(define-memo (function-name parameter1 parameter2 ... parameterN) body)
+       (define-memo function-name (lambda (parameter1 ... parameterN) body))"""
+    def __init__(self,value:Lambda):
+        self.value = value
+
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Define | None:
+        # 与define相同地解析,只是所定义的过程被包装为Memoized
+        define = Define.analysis(exp, scope)
+        if define is None or not isinstance(define.value, Lambda):
+            cls.raise_error(exp)
+        define.value = DefineMemo(define.value)
+        return define
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        return Memoized(eval(self.value, env))
+
+    def compile(self,tail:bool=False)->Code:
+        code = compile_exp(self.value)
+        return lambda env: Memoized(code(env))
+
+    def __str__(self):
+        return f"(memoize {self.value})"
+
+class Profile(Compound):
+    """(profile <expression>)"""
+    def __init__(self,value:Exp):
+        self.value = value
+
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Profile | None:
+        if len(exp) != 2:
+            cls.raise_error(exp)
+        return Profile(analyze_item(exp, 1, scope))
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        # profiler只在使用时导入,平时不产生任何开销
+        from profiler import Profiler
+        return Profiler.run_and_report(lambda: eval(self.value, env))
+
+    def compile(self,tail:bool=False)->Code:
+        code = compile_exp(self.value)
+        def run(env:Environment):
+            from profiler import Profiler
+            return Profiler.run_and_report(lambda: code(env))
+        return run
+
+    def __str__(self):
+        return f"(profile {self.value})"
+
+class Delay(Compound):
+    """(delay <expression>)"""
+    def __init__(self,value:Exp):
+        self.value = value
+
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Delay | None:
+        if len(exp) != 2:
+            cls.raise_error(exp)
+        return Delay(analyze_item(exp, 1, scope))
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        value = self.value
+        return Promise(lambda: eval(value, env))
+
+    def compile(self,tail:bool=False)->Code:
+        code = compile_exp(self.value)
+        return lambda env: Promise(lambda: code(env))
+
+    def __str__(self):
+        return f"(delay {self.value})"
+
+class ConsStream(Compound):
+    """(cons-stream <first> <rest>),即(cons first (delay rest))"""
+    def __init__(self,first:Exp, rest:Exp):
+        self.first = first
+        self.rest = rest
+
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> ConsStream | None:
+        if len(exp) != 3:
+            cls.raise_error(exp)
+        return ConsStream(analyze_item(exp, 1, scope), analyze_item(exp, 2, scope))
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        rest = self.rest
+        return Stream(eval(self.first, env), Promise(lambda: eval(rest, env)))
+
+    def compile(self,tail:bool=False)->Code:
+        first = compile_exp(self.first)
+        rest = compile_exp(self.rest)
+        return lambda env: Stream(first(env), Promise(lambda: rest(env)))
+
+    def __str__(self):
+        return f"(cons-stream {self.first} {self.rest})"
+
+class Let(Compound):
+    """(let ((variable1 init1) ... (variableN initN)) body)
+       (let name ((variable1 init1) ... (variableN initN)) body)"""
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Exp:
+        named = len(exp) > 1 and isinstance(exp[1], Symbol)
+        start = 3 if named else 2
+        if len(exp) <= start or not isinstance(exp[start - 1], Compound):
+            cls.raise_error(exp)
+        variables, inits = [], []
+        for binding in exp[start - 1]:
+            if not isinstance(binding, Compound) or len(binding) != 2 or not isinstance(binding[0], Symbol):
+                cls.raise_error(binding, 'binding must be (variable init)')
+            variables.append(binding[0])
+            inits.append(binding[1])
+        body = list(exp[start:])
+        if not named:
+            # ((lambda (variable1 ... variableN) body) init1 ... initN)
+            return analyze(Compound([Compound([LAMBDA, Compound(variables), *body]), *inits]), scope=scope)
+        name = exp[1]
+        if all(loop_tail(i, name, len(variables)) for i in body[-1:]) and all(loop_free(i, name) for i in body[:-1]):
+            return Loop.make(name, variables, inits, body, scope)
+        # 循环过程可能被非尾调用或被闭包引用时按定义展开:(((lambda () (define (name variable1 ...) body) name)) init1 ...)
+        procedure = Compound([LAMBDA, Compound([]), Compound([DEFINE, Compound([name, *variables]), *body]), name])
+        return analyze(Compound([Compound([procedure]), *inits]), scope=scope)
+
+class Do(Compound):
+    """(do ((variable1 init1 step1) ... (variableN initN stepN)) (test expression ...) command ...)"""
+    @classmethod
+    def analysis(cls, exp: Compound,scope:Scope|None=None) -> Exp:
+        if len(exp) < 3 or not isinstance(exp[1], Compound) or not isinstance(exp[2], Compound) or not exp[2]:
+            cls.raise_error(exp)
+        bindings, steps = [], []
+        for binding in exp[1]:
+            if not isinstance(binding, Compound) or len(binding) not in (2, 3) or not isinstance(binding[0], Symbol):
+                cls.raise_error(binding, 'binding must be (variable init step) or (variable init)')
+            bindings.append(Compound(binding[:2]))
+            steps.append(binding[-1] if len(binding) == 3 else binding[0])
+        test, *result = exp[2]
+        # (let <loop> (bindings) (if test (begin expression ...) (begin command ... (<loop> step ...))))
+        done = Compound([BEGIN, *result]) if result else None
+        again = Compound([BEGIN, *exp[3:], Compound([DO_LOOP, *steps])])
+        return Let.analysis(Compound([Symbol('let'), DO_LOOP, Compound(bindings), Compound([Symbol('if'), test, done, again])]), scope)
+
+
+# 过程体中出现这些句式时,循环的帧可能被闭包保留,不能在各次循环间复用
+CAPTURING_FORMS = ('lambda', 'define-memo', 'delay', 'cons-stream', 'let', 'do')
+
+
+def loop_free(exp: Exp, name: Symbol) -> bool:
+    """exp中没有出现name,也没有产生闭包的句式"""
+    if exp is name:
+        return False
+    if not isinstance(exp, Compound) or not exp:
+        return True
+    if exp[0] == 'quote':
+        return True
+    if exp[0] in CAPTURING_FORMS or (exp[0] is DEFINE and len(exp) > 1 and isinstance(exp[1], Compound)):
+        return False
+    return all(loop_free(i, name) for i in exp)
+
+
+def loop_tail(exp: Exp, name: Symbol, arity: int) -> bool:
+    """处在尾位置的exp中,name只作为参数个数正确的尾调用出现,且没有产生闭包的句式"""
+    if not isinstance(exp, Compound) or not exp:
+        return loop_free(exp, name)
+    head = exp[0]
+    if head is name:
+        return len(exp) == arity + 1 and all(loop_free(i, name) for i in exp[1:])
+    if head == 'if' and len(exp) in (3, 4):
+        return loop_free(exp[1], name) and all(loop_tail(i, name, arity) for i in exp[2:])
+    if head == 'begin' and len(exp) > 1:
+        return all(loop_free(i, name) for i in exp[1:-1]) and loop_tail(exp[-1], name, arity)
+    if head == 'cond':
+        return all(isinstance(clause, Compound) and len(clause) == 2 and loop_free(clause[0], name)
+                   and loop_tail(clause[1], name, arity) for clause in exp[1:])
+    return loop_free(exp, name)
+
+
+class Loop(Compound):
+    """
+    只在尾位置调用自身、且不产生闭包的named let:整个循环只建立一个帧,
+    每次循环把新的值写入帧中循环变量的槽位,不调用过程
+    """
+    def __init__(self, name: Symbol, parameters: list[Symbol], inits: list[Exp], body: list[Exp], scope: Scope):
+        self.name = name
+        self.parameters = parameters
+        self.inits = inits
+        self.body = body
+        self.scope = scope
+        # 非编译模式下使用的循环体闭包,第一次求值时编译
+        self.code: tuple[list[Code],Code]|None = None
+
+    @classmethod
+    def make(cls, name: Symbol, parameters: list[Symbol], inits: list[Exp], body: list[Exp],
+             scope: Scope|None) -> Loop:
+        inits = [analyze(i, scope=scope) for i in inits]
+        new_scope = Scope(parameters, scope)
+        new_scope.scan_defines(body)
+        body = [analyze(i, scope=new_scope) for i in body]
+        loop = Loop(name, parameters, inits, body, new_scope)
+        body[-1] = loop.recur(body[-1])
+        return loop
+
+    def recur(self, exp: Exp) -> Exp:
+        """把尾位置上对循环的调用替换为Recur"""
+        t = type(exp)
+        if t is If:
+            exp.consequence = self.recur(exp.consequence) # type:ignore
+            exp.alternative = self.recur(exp.alternative) # type:ignore
+        elif t is Begin:
+            exp.expressions[-1] = self.recur(exp.expressions[-1]) # type:ignore
+        elif t is Cond:
+            exp.clauses = [(predicate, self.recur(expression)) for predicate, expression in exp.clauses] # type:ignore
+        elif t is Folded:
+            exp.result = self.recur(exp.result) # type:ignore
+            exp.original = self.recur(exp.original) # type:ignore
+        elif t is Compound_ or t is Compound:
+            first = exp.data[0] if exp.data else None # type:ignore
+            if (type(first) is GlobalRef or type(first) is LocalRef) and first.name is self.name: # type:ignore
+                return Recur(self.name, exp.data[1:], self) # type:ignore
+        return exp
+
+    def frame(self, values: list, env: Environment|Frame) -> Frame:
+        extra = len(self.scope.names) - len(values)
+        if extra:
+            values.extend([UNBOUND] * extra)
+        return Frame(values, env, self.scope.names)
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        # 循环内的表达式编译为闭包后执行,只有循环结束时的表达式放回队列,与过程调用相同地保持尾递归优化
+        if self.code is None:
+            self.code = ([compile_exp(i) for i in self.body[:-1]],
+                         compile_loop_tail(self.body[-1], lambda exp: lambda env: exp))
+        body, last = self.code
+        frame = self.frame([eval(i, env) for i in self.inits], env)
+        profiler = active_profiler() if PROFILER is not None else None
+        if profiler is not None:
+            key, depth = profiler.key(self), len(profiler.stack)
+            profiler.push(key)
+        while True:
+            for code in body:
+                code(frame)
+            exp = last(frame)
+            if type(exp) is not Recur:
+                if profiler is not None:
+                    profiler.close_to(depth)
+                exp_queue.insert(0, exp)
+                return frame
+            if profiler is not None:
+                profiler.iterate(key)
+
+    def compile(self,tail:bool=False)->Code:
+        inits = [compile_exp(i) for i in self.inits]
+        body = [compile_exp(i) for i in self.body[:-1]]
+        last = compile_loop_tail(self.body[-1], lambda exp: compile_exp(exp, tail))
+        make_frame = self.frame
+        loop = self
+        def run(env:Environment):
+            frame = make_frame([code(env) for code in inits], env)
+            profiler = active_profiler() if PROFILER is not None else None
+            if profiler is not None:
+                key, depth = profiler.key(loop), len(profiler.stack)
+                profiler.push(key)
+            while True:
+                for code in body:
+                    code(frame)
+                result = last(frame)
+                if type(result) is not Recur:
+                    if profiler is not None:
+                        profiler.close_to(depth)
+                    return result
+                if profiler is not None:
+                    profiler.iterate(key)
+        return run
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['code'] = None
+        return state
+
+    def __str__(self):
+        bindings = ' '.join(f'({p} {i})' for p, i in zip(self.parameters, self.inits))
+        return f"(let {self.name} ({bindings}) {' '.join(map(str, self.body))})"
+
+class Recur(Compound):
+    """循环尾位置上对循环自身的调用:在当前帧中依次求值新的值后写入循环变量的槽位"""
+    def __init__(self, name: Symbol, args: list[Exp], loop: Loop):
+        self.name = name
+        self.args = args
+        # machine.py按步求值时由此回到循环体的开头
+        self.loop = loop
+
+    def compile(self,tail:bool=False)->Code:
+        args = [compile_exp(i) for i in self.args]
+        # 以Recur节点自身作为"继续循环"的返回值
+        if len(args) == 1:
+            arg = args[0]
+            def run(frame:Frame):
+                frame.values[0] = arg(frame)
+                return self
+        elif len(args) == 2:
+            arg0, arg1 = args
+            def run(frame:Frame):
+                values = frame.values
+                values[0], values[1] = arg0(frame), arg1(frame)
+                return self
+        else:
+            def run(frame:Frame):
+                frame.values[:len(args)] = [code(frame) for code in args]
+                return self
+        return run
+
+    def __str__(self):
+        return f"({' '.join(map(str, [self.name, *self.args]))})"
+
+
+def compile_loop_tail(exp: Exp, leaf: Callable[[Exp], Code]) -> Code:
+    """
+    编译循环体的最后一句:展开尾位置上的if/begin/cond,其中的Recur更新循环变量后返回自身表示继续循环,
+    其余的尾位置表达式由leaf编译(编译模式下为其值,非编译模式下返回表达式本身,放回eval的队列)
+    """
+    t = type(exp)
+    if t is If:
+        condition = compile_exp(exp.condition) # type:ignore
+        consequence = compile_loop_tail(exp.consequence, leaf) # type:ignore
+        alternative = compile_loop_tail(exp.alternative, leaf) # type:ignore
+        return lambda env: consequence(env) if condition(env) else alternative(env)
+    if t is Begin:
+        body = [compile_exp(i) for i in exp.expressions[:-1]] # type:ignore
+        last = compile_loop_tail(exp.expressions[-1], leaf) # type:ignore
+        def run(env:Environment):
+            for code in body:
+                code(env)
+            return last(env)
+        return run
+    if t is Cond:
+        clauses = [(None if predicate is None else compile_exp(predicate), compile_loop_tail(expression, leaf))
+                   for predicate, expression in exp.clauses] # type:ignore
+        otherwise = leaf(None)
+        def run(env:Environment):
+            for predicate, expression in clauses:
+                if predicate is None or predicate(env):
+                    return expression(env)
+            return otherwise(env)
+        return run
+    if t is Folded:
+        result = compile_loop_tail(exp.result, leaf) # type:ignore
+        original = compile_loop_tail(exp.original, leaf) # type:ignore
+        valid = exp.valid # type:ignore
+        return lambda env: result(env) if valid(env) else original(env)
+    if t is Recur:
+        return exp.compile() # type:ignore
+    return leaf(exp)
+
+class LocalRef(Compound,LocationInterface):
+    """对过程内局部变量的引用,(depth, slot)为解析时确定的词法地址"""
+    def __init__(self, name:Symbol, depth:int, slot:int, checked:bool, location:Location|None=None):
+        self.name = name
+        self.depth = depth
+        self.slot = slot
+        # 过程体内define的变量在执行define之前未绑定,需要检查
+        self.checked = checked
+        self.location = location
+
+    def location_message(self):
+        return location_message(self.location) if self.location else ''
+
+    def lookup(self, env: Frame) -> Any:
+        for _ in range(self.depth):
+            env = env.parent
+        value = env.values[self.slot]
+        if value is UNBOUND:
+            raise LispNameError(f'undefined variable {self.name}',self)
+        return value
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        return self.lookup(env)
+
+    def compile(self,tail:bool=False)->Code:
+        slot = self.slot
+        if self.checked:
+            return self.lookup
+        if self.depth == 0:
+            return lambda env: env.values[slot]
+        if self.depth == 1:
+            return lambda env: env.parent.values[slot]
+        return self.lookup
+
+    def __str__(self):
+        return str(self.name)
+
+class GlobalRef(Compound,LocationInterface):
+    """对全局变量的引用,总是在最外层环境中查找"""
+    def __init__(self, name:Symbol, location:Location|None=None):
+        self.name = name
+        # 环境中的键为str,用精确的str查找可以走dict的快速路径
+        self.key = str(name)
+        self.location = location
+        # 内联缓存:上次查找的全局环境、当时的GLOBALS_VERSION与查到的值
+        self.cache_env: Environment|None = None
+        self.cache_version = -1
+        self.cache_value: Any = None
+
+    def location_message(self):
+        return location_message(self.location) if self.location else ''
+
+    def lookup(self, env: Environment) -> Any:
+        env_globals = env.globals
+        version = GLOBALS_VERSION
+        if self.cache_version == version and self.cache_env is env_globals:
+            return self.cache_value
+        try:
+            value = env_globals[self.key]
+        except KeyError:
+            raise LispNameError(f'undefined variable {self.name}',self)
+        # 记录查找前的版本号:查找期间其他线程修改了绑定时,下次查找会重新进行
+        self.cache_env = env_globals
+        self.cache_version = version
+        self.cache_value = value
+        return value
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        return self.lookup(env)
+
+    def compile(self,tail:bool=False)->Code:
+        return self.lookup
+
+    def __getstate__(self):
+        # 缓存引用着环境,不序列化
+        state = self.__dict__.copy()
+        state.update(cache_env=None, cache_version=-1, cache_value=None)
+        return state
+
+    def __str__(self):
+        return str(self.name)
+
+class Compiled(Compound):
+    """analyze(exp,compiled=True)的结果:整个表达式已被编译为闭包"""
+    def __init__(self,exp:Exp):
+        self.exp = exp
+        self.code = compile_exp(exp)
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        return self.code(env)
+
+    def compile(self,tail:bool=False)->Code:
+        return self.code
+
+    def __str__(self):
+        return str(self.exp)
+
+
+class Scope:
+    """解析时的词法作用域:一个过程帧中的变量名及其槽位"""
+    def __init__(self, parameters:list[Symbol], parent:Scope|None):
+        self.names: list[str] = [str(i) for i in parameters]
+        self.slots: dict[str,int] = {name: i for i, name in enumerate(self.names)}
+        self.parameter_num = len(self.names)
+        self.parent = parent
+
+    def declare(self, name: Symbol) -> int:
+        """为过程体内define的变量分配槽位"""
+        key = str(name)
+        if key not in self.slots:
+            self.slots[key] = len(self.names)
+            self.names.append(key)
+        return self.slots[key]
+
+    def scan_defines(self, body: list[Exp]) -> None:
+        """预先扫描过程体中的define,使得相互引用的内部定义解析到同一帧"""
+        for exp in body:
+            if isinstance(exp, Compound) and exp and isinstance(exp[0], Symbol):
+                if (exp[0] is DEFINE or exp[0] is DEFINE_MEMO) and len(exp) > 1:
+                    if isinstance(exp[1], Symbol):
+                        self.declare(exp[1])
+                    elif isinstance(exp[1], Compound) and exp[1] and isinstance(exp[1][0], Symbol):
+                        self.declare(exp[1][0])
+                elif exp[0] is BEGIN:
+                    self.scan_defines(exp[1:])
+
+    def resolve(self, name: Symbol) -> tuple[int,int]|None:
+        """返回变量的词法地址(depth, slot),全局变量返回None"""
+        key = str(name)
+        scope, depth = self, 0
+        while scope is not None:
+            if key in scope.slots:
+                return depth, scope.slots[key]
+            scope, depth = scope.parent, depth + 1
+        return None
+
+
+COMPOUND:dict[str,type[Compound]]= {'if': If, 'begin': Begin, 'cond': Cond, 'lambda': Lambda, 'define': Define, 'set!': Set, 'quote': Quote, 'return': Return, 'profile': Profile, 'define-memo': DefineMemo,
+                                 'delay': Delay, 'cons-stream': ConsStream, 'let': Let, 'do': Do}
+def analyze(exp: Exp, compiled: bool = False, scope: Scope|None = None, location: Location|None = None) -> Exp:
+    """
+    compiled为真时,返回预先编译为闭包的表达式,求值时不再逐节点分派
+    scope为当前所在过程的作用域,变量引用被解析为LocalRef或GlobalRef
+    location为exp是符号时其在源码中的位置(取自上层的位置表)
+    """
+    if compiled:
+        return Compiled(analyze(exp,scope=scope,location=location))
     if isinstance(exp, Compound):
-        if isinstance(exp[0], Symbol) and exp[0] in COMPOUND:
-            return COMPOUND[str(exp[0])].analysis(exp)
-        if isinstance(exp, Compound_):
-            return Compound_([analyze(i) for i in exp],exp.front,exp.end)
+        if exp and isinstance(exp[0], Symbol) and exp[0] in COMPOUND:
+            node = COMPOUND[exp[0]].analysis(exp,scope)
+        elif isinstance(exp, Compound_):
+            node = Compound_([analyze_item(exp, i, scope) for i in range(len(exp))],exp.front,exp.end,exp.locations)
         else:
-            return Compound([analyze(i) for i in exp])
+            node = Compound([analyze(i,scope=scope) for i in exp])
+        # 子表达式已先被折叠,因此自底向上一次完成
+        return fold(node) if CONSTANT_FOLDING else node
+    elif isinstance(exp, Symbol):
+        address = scope.resolve(exp) if scope is not None else None
+        if address is None:
+            return GlobalRef(exp, location)
+        depth, slot = address
+        scope_ = scope
+        for _ in range(depth):
+            scope_ = scope_.parent #type:ignore
+        return LocalRef(exp, depth, slot, slot >= scope_.parameter_num, location) #type:ignore
     else:
         return exp
 
 
+class Folded(Compound):
+    """
+    常量折叠的结果:guards中的名字仍绑定着折叠时使用的内置过程时求值result,否则求值原来的表达式
+    guards为(名字, 内置过程的op)的元组,保证全局重新定义了内置过程后结果仍然正确
+    """
+    def __init__(self, result: Exp, original: Exp, guards: tuple[tuple[str, Any], ...]):
+        self.result = result
+        self.original = original
+        self.guards = guards
+        # 与GlobalRef相同的缓存:全局绑定没有变化时直接使用上次检查的结果
+        self.cache_env: Environment|None = None
+        self.cache_version = -1
+        self.cache_valid = False
+
+    def valid(self, env: Environment|Frame) -> bool:
+        env_globals = env.globals
+        version = GLOBALS_VERSION
+        if self.cache_version == version and self.cache_env is env_globals:
+            return self.cache_valid
+        valid = True
+        for key, op_ in self.guards:
+            if getattr(env_globals.get(key), 'op', None) is not op_:
+                valid = False
+                break
+        self.cache_env = env_globals
+        self.cache_version = version
+        self.cache_valid = valid
+        return valid
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(cache_env=None, cache_version=-1, cache_valid=False)
+        return state
+
+    def evaluate(self, env: Environment, exp_queue: list[Exp]):
+        # 与if相同地放回队列,保持尾递归优化
+        exp_queue.insert(0, self.result if self.valid(env) else self.original)
+
+    def compile(self,tail:bool=False)->Code:
+        result = compile_exp(self.result, tail)
+        original = compile_exp(self.original, tail)
+        valid = self.valid
+        return lambda env: result(env) if valid(env) else original(env)
+
+    def __str__(self):
+        return str(self.original)
+
+
+# 可以折叠的内置过程:没有副作用,结果为数或布尔值,且op为模块级的函数(不同环境中的同名内置过程相同)
+FOLDABLE = ('+', '-', '*', '/', 'quotient', '>', '<', '>=', '<=', '=', 'abs', 'max', 'min', 'eq?', 'equal?')
+_fold_builtins: Environment|None = None
+
+
+def fold_builtin(key: str) -> Operator|None:
+    """用于计算折叠结果的内置过程,取自单独建立的标准环境,不受run_env中重新定义的影响"""
+    global _fold_builtins
+    if key not in FOLDABLE:
+        return None
+    if _fold_builtins is None:
+        _fold_builtins = standard_env()
+    return _fold_builtins[key]
+
+
+def constant_of(exp: Exp) -> tuple[Any, tuple]|None:
+    """exp为常量时返回(值, guards),否则返回None"""
+    if isinstance(exp, NUMBER_TYPES) or exp is None:
+        return exp, ()
+    if type(exp) is Quote and not isinstance(exp.value, LIST_TYPES):
+        return exp.value, ()
+    if type(exp) is Folded:
+        constant = constant_of(exp.result)
+        if constant is not None:
+            return constant[0], exp.guards + constant[1]
+    return None
+
+
+def literal(value: Any) -> Exp:
+    return Quote(value) if isinstance(value, Symbol) else value
+
+
+def folded(result: Exp, original: Exp, guards: tuple) -> Exp:
+    return Folded(result, original, tuple(dict.fromkeys(guards))) if guards else result
+
+
+def fold(node: Exp) -> Exp:
+    """
+    常量折叠与去除死分支:
+    - 参数都是常量的纯内置过程调用替换为结果,出错时保留原表达式到运行时报错
+    - 条件为常量的if/cond只保留会被执行的分支
+    - begin中非最后的常量表达式没有作用,被去掉
+    局部变量遮蔽的名字已被解析为LocalRef,不会被折叠;全局的重新定义由Folded在运行时检查
+    """
+    t = type(node)
+    if t is Compound_ or t is Compound:
+        data = node.data # type:ignore
+        if not data or type(data[0]) is not GlobalRef:
+            return node
+        builtin = fold_builtin(data[0].key)
+        if builtin is None:
+            return node
+        constants = [constant_of(arg) for arg in data[1:]]
+        if any(constant is None for constant in constants):
+            return node
+        try:
+            value = builtin(iter([constant[0] for constant in constants])) # type:ignore
+        except Exception:
+            return node
+        if not isinstance(value, NUMBER_TYPES):
+            return node
+        guards = ((data[0].key, builtin.op),) + sum((constant[1] for constant in constants), ()) # type:ignore
+        return folded(literal(value), node, guards)
+    if t is If:
+        constant = constant_of(node.condition) # type:ignore
+        if constant is None:
+            return node
+        value, guards = constant
+        return folded(node.consequence if value else node.alternative, node, guards) # type:ignore
+    if t is Cond:
+        guards = ()
+        for i, (predicate, expression) in enumerate(node.clauses): # type:ignore
+            if predicate is None:
+                return folded(expression, node, guards)
+            constant = constant_of(predicate)
+            if constant is None:
+                if i == 0:
+                    return node
+                return folded(Cond(node.clauses[i:]), node, guards) # type:ignore
+            value, predicate_guards = constant
+            guards += predicate_guards
+            if value:
+                return folded(expression, node, guards)
+        return folded(None, node, guards)
+    if t is Begin:
+        expressions = node.expressions # type:ignore
+        kept = []
+        guards = ()
+        for exp in expressions[:-1]:
+            constant = constant_of(exp)
+            if constant is None:
+                kept.append(exp)
+            else:
+                guards += constant[1]
+        if len(kept) == len(expressions) - 1:
+            return node
+        result = Begin(kept + [expressions[-1]]) if kept else expressions[-1]
+        return folded(result, node, guards)
+    return node
+
+
+def compile_exp(exp: Exp, tail: bool = False) -> Code:
+    """将已解析的表达式编译为闭包:code(env)即为表达式的值"""
+    if isinstance(exp, Compound):
+        return exp.compile(tail)
+    if isinstance(exp, Symbol):
+        name = str(exp)
+        def lookup(env:Environment):
+            try:
+                return env[name]
+            except KeyError:
+                raise LispNameError(f'undefined variable {name}',exp)
+        return lookup
+    return lambda env: exp
+
+
+def compile_body(body: list[Exp]) -> tuple[list[Code],Code]:
+    """编译过程体:最后一句若不是return则以尾位置编译"""
+    return ([compile_exp(exp) for exp in body[:-1]],
+            compile_exp(body[-1],not isinstance(body[-1], Return)))
+
+
+class TailCall(NamedTuple):
+    """编译模式下尾位置的过程调用,由trampoline继续执行"""
+    procedure: Procedure
+    args: list
+    exp: Compound
+
+
+def trampoline(result: Any) -> Any:
+    """不断展开TailCall,使编译模式下的尾递归不占用python栈"""
+    while type(result) is TailCall:
+        procedure, args, exp = result
+        try:
+            env, last_code = procedure.enter(args)
+        except Exception as e:
+            if isinstance(e, LispError):
+                raise e(exp)
+            else:
+                raise LispProcError(str(e),exp) from None
+        result = last_code(env)
+    return result
+
 #####################################################################################################
 #                                    Eval and Environment                                           #
 #####################################################################################################
 import operator as op
 import math
+from lisp_shell_config import CONSTANT_FOLDING, MEMO_SIZE, PMAP_WORKERS, PMAP_CHUNK_SIZE, PMAP_SERIAL_BELOW
+from lisp_shell_config import FILE_BUFFER_SIZE, CSV_BLOCK_SIZE, HEAP_STACK_MARGIN
+# 全局绑定的版本号:任何Environment中的绑定被增加、修改或删除时加一,GlobalRef等的缓存据此失效
+# lisp_server等多线程求值时各线程都可能修改绑定,加一在锁中进行以免丢失
+GLOBALS_VERSION = 0
+GLOBALS_LOCK = threading.Lock()
+
+
+def bump_globals_version() -> None:
+    global GLOBALS_VERSION
+    with GLOBALS_LOCK:
+        GLOBALS_VERSION += 1
+
+
 class Environment(ChainMap):
+    """
+    全局环境,通过它增删改绑定时会增加GLOBALS_VERSION(值不变的赋值不增加)
+    直接修改maps中的dict不会使缓存失效
+    """
+    def __setitem__(self, key: str, value: object) -> None:
+        map = self.maps[0]
+        if key not in map or map[key] is not value:
+            map[key] = value
+            bump_globals_version()
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        bump_globals_version()
+
+    def pop(self, key: str, *args: Any) -> Any:
+        value = super().pop(key, *args)
+        bump_globals_version()
+        return value
+
+    def popitem(self) -> tuple[str, Any]:
+        item = super().popitem()
+        bump_globals_version()
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        bump_globals_version()
+
     def change(self, key: Symbol, value: object) -> None:
         for map in self.maps:
             if key in map:
-                map[key] = value
+                if map[key] is not value:
+                    map[key] = value
+                    bump_globals_version()
                 return
         raise KeyError(key)
 
+    @property
+    def globals(self) -> Environment:
+        """最外层环境即为全局环境"""
+        return self
+
+
+class Unbound:
+    """过程体内已声明但尚未执行define的变量"""
+    def __repr__(self) -> str:
+        return '<unbound>'
+
+UNBOUND = Unbound()
+
+
+class Frame:
+    """
+    过程调用产生的局部环境:变量按解析时分配的槽位存放在values中
+    names与Scope共享,仅用于按名字查找(如调试与测试),求值时不使用
+    """
+    __slots__ = ('values', 'parent', 'names', 'globals')
+
+    def __init__(self, values: list, parent: Frame|Environment, names: list[str]):
+        self.values = values
+        self.parent = parent
+        self.names = names
+        self.globals: Environment = parent.globals
+
+    def __getitem__(self, key: str) -> Any:
+        frame = self
+        while isinstance(frame, Frame):
+            if key in frame.names:
+                value = frame.values[frame.names.index(key)]
+                if value is UNBOUND:
+                    raise KeyError(key)
+                return value
+            frame = frame.parent
+        return frame[key]
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
 
 class Procedure:
     def __init__(
-        self, parms: list[Symbol], body: list[Exp], env: Environment
+        self, parms: list[Symbol], body: list[Exp], env: Environment|Frame, scope: Scope,
+        code: tuple[list[Code],Code]|None=None, source: Lambda|None=None
     ):
         self.parms = parms
         self.body = body
         self.definition_env = env
-
-    def application_env(self, args:list[Exp]) -> Environment:
-        local_env = dict(zip(self.parms, args))
-        return Environment(local_env, self.definition_env)
+        # 帧中的变量名:参数在前,过程体内define的变量在后
+        self.names = scope.names
+        # 编译模式下由Lambda.compile提供的过程体闭包
+        self.code = code
+        # 产生该过程的lambda,提供名字与定义位置
+        self.source = source
+
+    def application_env(self, args:list[Exp]) -> Frame:
+        """args须为新建的列表,会被直接用作帧的存储"""
+        extra = len(self.names) - len(args)
+        if extra:
+            args.extend([UNBOUND] * extra)
+        return Frame(args, self.definition_env, self.names)
 
     def __call__(self, args: Generator[Exp,None,None]):
         args_list = list(args)
@@ -396,9 +1969,30 @@ class Procedure:
             raise LispTypeError(f'error arguments number')
         
         env = self.application_env(args_list)
+        global STACK_CHECK
+        STACK_CHECK += 1
+        if self.code is not None and (STACK_CHECK & STACK_CHECK_MASK or not stack_is_deep()):
+            body, last_code = self.code
+            for code in body:
+                code(env)
+            return trampoline(last_code(env))
+        # 非编译模式,或者python栈将要用尽时由eval(在显式栈上)求值
         for exp in self.body:
             result=eval(exp, env)
         return result
+
+    def enter(self, args: list):
+        """编译模式下的__call__:执行过程体除最后一句外的部分,返回新环境与最后一句的闭包"""
+        if len(args) != len(self.parms):
+            raise LispTypeError(f'error arguments number')
+
+        if self.code is None:
+            self.code = compile_body(self.body)
+        env = self.application_env(args)
+        body, last_code = self.code
+        for code in body:
+            code(env)
+        return (env, last_code)
     
     def need_tail_optimization(self):
         return not isinstance(self.body[-1], Return)
@@ -409,31 +2003,85 @@ class Procedure:
 
 def all_float():
     while True:
-        yield (float,int)
+        yield NUMERIC_TYPES
+
+def all_vector():
+    while True:
+        yield Vector
+
+def vector_int():
+    yield Vector
+    yield int
 
 def one_list():
-    yield Compound
+    yield LIST_TYPES
     while True:
         yield object
 
 def one_list_end():
     yield object
-    yield Compound
+    yield LIST_TYPES
 
 def all_object():
     while True:
         yield object
 
+def procedure_int():
+    yield Procedure
+    yield int
+
+def memoized():
+    yield Memoized
+
+def hash_table():
+    yield HashTable
+    while True:
+        yield object
+
+def one_stream():
+    yield Stream
+
+def procedure_stream():
+    yield object
+    yield (Stream, Compound)
+
+def stream_int():
+    yield (Stream, Compound)
+    yield int
+
+def one_path():
+    yield str
+
 def list_int_object():
     yield Compound
     yield int
     yield object
 
 class Operator:
+    """
+    内置操作:__call__接受参数生成器,是通用的调用约定
+    call1/call2是一、二个参数时的快速入口,参数直接传入,不建立生成器与列表
+    lazy为真的操作(and/or)需要惰性求值参数,调用方不能走快速入口
+    """
+    lazy = False
+
     def __init__(self,op,num:tuple[int|None,int|None],type_gen=all_object) -> None:
         self.op = op
         self.num = num
         self.type_gen = type_gen
+        # 预先算出前两个参数的类型与一、二个参数时是否满足参数个数
+        types = type_gen()
+        self.type0 = next(types, object)
+        self.type1 = next(types, object)
+        low, high = num
+        self.arity1 = (low is None or low <= 1) and (high is None or high >= 1)
+        self.arity2 = (low is None or low <= 2) and (high is None or high >= 2)
+
+    def call1(self, a: Exp) -> Any:
+        return self((a,))# type:ignore
+
+    def call2(self, a: Exp, b: Exp) -> Any:
+        return self((a, b))# type:ignore
 
     def __call__(self, args:Generator[Exp,None,None]) -> Any:
         args_list=list(args)
@@ -469,6 +2117,20 @@ class Sequential_Mixin():
             result = self.op(result, arg)
         return result
 
+    def call1(self, a):
+        if not self.arity1:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0):
+            raise LispTypeError(f'error type')
+        return a
+
+    def call2(self, a, b):
+        if not self.arity2:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0) or not isinstance(b, self.type1):
+            raise LispTypeError(f'error type')
+        return self.op(a, b)
+
 class Comparative_mixin():
     """(> 1 2 3)=> and( 1>2, 1>3 )"""
     def operate(self, args):
@@ -476,13 +2138,35 @@ class Comparative_mixin():
         first = args[0]
         if not isinstance(first, next(type_gen)):
             raise LispTypeError(f'error type')
+        result = True
         for arg in args[1:]:
             if not isinstance(arg, next(type_gen)):
                 raise LispTypeError(f'error type')
-            if not self.op(first, arg):
+            test = self.op(first, arg)
+            if type(test) is Vector:
+                # 向量的比较逐元素进行,各次结果按元素取与
+                result = test if result is True else result & test
+            elif not test:
                 return False
+        return result
+
+    def call1(self, a):
+        if not self.arity1:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0):
+            raise LispTypeError(f'error type')
         return True
 
+    def call2(self, a, b):
+        if not self.arity2:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0) or not isinstance(b, self.type1):
+            raise LispTypeError(f'error type')
+        test = self.op(a, b)
+        if type(test) is Vector:
+            return test
+        return True if test else False
+
 class List_mixin():
     """(list 1 2 3)=> list(1,2,3)"""
     def operate(self, args):
@@ -491,7 +2175,21 @@ class List_mixin():
             if not isinstance(arg, next(type_gen)):
                 raise LispTypeError(f'error type')
         return self.op(args)
-    
+
+    def call1(self, a):
+        if not self.arity1:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0):
+            raise LispTypeError(f'error type')
+        return self.op([a])
+
+    def call2(self, a, b):
+        if not self.arity2:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0) or not isinstance(b, self.type1):
+            raise LispTypeError(f'error type')
+        return self.op([a, b])
+
 class One_mixin():
     """(abs 1)=> abs(1)"""
     def operate(self, args):
@@ -502,8 +2200,17 @@ class One_mixin():
                 raise LispTypeError(f'error type')
             result = self.op(arg)
         return result
-    
+
+    def call1(self, a):
+        if not self.arity1:
+            raise LispTypeError(f'error arguments number')
+        if not isinstance(a, self.type0):
+            raise LispTypeError(f'error type')
+        return self.op(a)
+
 class And_OP(Operator):
+    lazy = True
+
     def __init__(self):
         pass
     
@@ -517,6 +2224,8 @@ class And_OP(Operator):
         return str(self)
 
 class Or_OP(Operator):
+    lazy = True
+
     def __init__(self):
         pass
 
@@ -537,15 +2246,41 @@ class Map_OP(Operator):
         args_list= list(args)
         if not callable(args_list[0]):
             raise LispTypeError(f'first element must be a procedure or operator')
+        func=args_list[0]
+        if any(type(arg) is Vector for arg in args_list[1:]):
+            return self.map_vector(func, args_list[1:])
         for arg in args_list[1:]:
-            if not isinstance(arg, Compound):
+            if not isinstance(arg, LIST_TYPES):
                 raise LispTypeError(f'map function must be operate on the list')
         # 函数作用在参数迭代器上
-        func=args_list[0]
+        if isinstance(func, Operator) and not func.lazy and 2 <= len(args_list) <= 3:
+            # 一、二个列表时直接使用内置操作的快速入口
+            call = func.call1 if len(args_list) == 2 else func.call2
+            return Compound(map(call, *args_list[1:]))
         if isinstance(func, Procedure):
             return Compound(map(func.no_tail_call,(iter(i) for i in zip(*args_list[1:]))))
         else:
             return Compound(map(args_list[0],(iter(i) for i in zip(*args_list[1:]))))
+
+    @staticmethod
+    def map_vector(func: Any, vectors: list[Any]) -> Vector:
+        """
+        对向量map:内置算术操作直接作用在整个向量上(由numpy广播),
+        其他过程逐元素调用,结果重新组成向量
+        """
+        for arg in vectors:
+            if type(arg) is not Vector:
+                raise LispTypeError(f'map function must be operate on vectors of the same kind')
+        # and/or、map、记忆化的过程等没有经过Operator.__init__,没有type0
+        if isinstance(func, Operator) and getattr(func, 'type0', None) is NUMERIC_TYPES and 1 <= len(vectors) <= 2:
+            result = func.call1(vectors[0]) if len(vectors) == 1 else func.call2(*vectors)
+            if type(result) is Vector:
+                return result
+        if len({len(arg) for arg in vectors}) > 1:
+            raise LispTypeError('map over vectors of different lengths')
+        if isinstance(func, Procedure):
+            return Vector.from_items(map(func.no_tail_call, (iter(i) for i in zip(*vectors))))
+        return Vector.from_items(map(func, (iter(i) for i in zip(*vectors))))
     
     def __str__(self) -> str:
         return f'<operator:map>'
@@ -553,21 +2288,180 @@ class Map_OP(Operator):
     def __repr__(self) -> str:
         return str(self)
 
+# 工作进程中正在执行的pmap:(操作, 过程, 各列表),由进程池的initializer设置,
+# 以fork方式创建进程时initializer的参数直接继承而不序列化,因此不需要序列化过程与环境
+PMAP_TASK: tuple[Any, Any, list[list[Exp]]]|None = None
+# 为真时当前进程是pmap的工作进程,其中的pmap依次求值而不再创建进程池
+PMAP_WORKER = False
+
+
+def pmap_worker_init(task: tuple[Any, Any, list[list[Exp]]]) -> None:
+    global PMAP_WORKER, PMAP_TASK
+    PMAP_WORKER = True
+    PMAP_TASK = task
+
+
+def pmap_chunk(start: int, end: int) -> list[Exp]:
+    """在工作进程中对第start到end个元素求值"""
+    operator, func, lists = PMAP_TASK # type:ignore
+    try:
+        return Map_OP.__call__(operator, iter([func, *(Compound(l[start:end]) for l in lists)])).data
+    except LispError as e:
+        # 编译模式下的表达式带有闭包无法传回,只保留报错信息
+        try:
+            pickle.dumps(e.stack)
+        except Exception:
+            e.stack = [None]
+        raise
+
+
+class PMap_OP(Map_OP):
+    """
+    (pmap f list1 list2 ...):结果与map相同
+    元素较多时把各列表分块,在fork出的进程池中求值后按顺序拼接;
+    工作进程继承fork时的全局环境,因此闭包与用户定义都可使用,但f对环境的修改不会传回
+    f应当是纯函数,结果须可以pickle
+    有其他线程在运行时(如lisp_server中)fork并不安全,此时依次求值
+    """
+    def __init__(self, workers: int|None = PMAP_WORKERS, chunk_size: int|None = PMAP_CHUNK_SIZE,
+                 serial_below: int = PMAP_SERIAL_BELOW):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.serial_below = serial_below
+
+    def __call__(self, args:Generator[Exp,None,None]) -> Any:
+        import os
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        args_list = list(args)
+        if not args_list or not callable(args_list[0]):
+            raise LispTypeError(f'first element must be a procedure or operator')
+        for arg in args_list[1:]:
+            if not isinstance(arg, LIST_TYPES):
+                raise LispTypeError(f'pmap function must be operate on the list')
+        length = min(map(len, args_list[1:]), default=0)
+        workers = self.workers or os.cpu_count() or 1
+        if (PMAP_WORKER or workers < 2 or length < max(self.serial_below, 2) or threading.active_count() > 1
+                or 'fork' not in multiprocessing.get_all_start_methods()):
+            return super().__call__(iter(args_list))
+        chunk = self.chunk_size or -(-length // (workers * 4))
+        starts = range(0, length, chunk)
+        task = (self, args_list[0], [list(arg) for arg in args_list[1:]])
+        pool = ProcessPoolExecutor(min(workers, len(starts)), multiprocessing.get_context('fork'), pmap_worker_init, (task,))
+        try:
+            futures = [pool.submit(pmap_chunk, start, min(start + chunk, length)) for start in starts]
+            result: list[Exp] = []
+            for future in futures:
+                result.extend(future.result())
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return Compound(result)
+
+    def __str__(self) -> str:
+        return f'<operator:pmap>'
+
+class Memoized(Operator):
+    """
+    带LRU缓存的过程:以参数的structural_key为键缓存结果
+    缓存超过maxsize(None为不限)时淘汰最久未使用的结果,hits/misses记录命中情况
+    """
+    def __init__(self, procedure: Procedure, maxsize: int|None = MEMO_SIZE):
+        if maxsize is not None and maxsize < 0:
+            raise LispTypeError('memoize size must not be negative')
+        self.procedure = procedure
+        self.maxsize = maxsize
+        self.cache: OrderedDict[Any, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, args:Generator[Exp,None,None]) -> Any:
+        args_list = list(args)
+        try:
+            key = tuple(map(structural_key, args_list))
+            result = self.cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # 参数不可哈希时不缓存
+            self.misses += 1
+            return self.procedure.no_tail_call(iter(args_list))
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return result
+        self.misses += 1
+        result = self.procedure.no_tail_call(iter(args_list))
+        if self.maxsize != 0:
+            self.cache[key] = result
+            if self.maxsize is not None and len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return result
+
+    def stats(self) -> Compound:
+        """(hits misses size maxsize)"""
+        return Compound([self.hits, self.misses, len(self.cache), self.maxsize])
+
+    def __str__(self) -> str:
+        return f'<memoized procedure>'
+
+    def __repr__(self) -> str:
+        return str(self)
+
 class Func():
     @staticmethod
     def set_ref(arg:list):
         arg[0][arg[1]]=arg[2]
 
-class S_OP(Operator,Sequential_Mixin):
+    @staticmethod
+    def car(x: Pair|Compound) -> Exp:
+        return x.car if type(x) is Pair else x[0]
+
+    @staticmethod
+    def cdr(x: Pair|Compound) -> Pair|Compound:
+        """Pair直接返回cdr;Compound的剩余部分一次性转换为序对,之后的cdr均为O(1)"""
+        if type(x) is Pair:
+            return x.cdr
+        return Pair.from_items(x.data[1:])
+
+    @staticmethod
+    def max(args: list) -> Any:
+        """只有一个向量参数时求其最大元素,参数中有向量时逐元素取最大值"""
+        if not any(type(x) is Vector for x in args):
+            return max(args)
+        if len(args) == 1:
+            if not len(args[0]):
+                raise LispTypeError('max of an empty vector')
+            return to_python(args[0].array.max())
+        return Vector(numpy_apply(lambda *arrays: reduce(numpy_module().maximum, arrays), *map(unwrap, args)))
+
+    @staticmethod
+    def min(args: list) -> Any:
+        if not any(type(x) is Vector for x in args):
+            return min(args)
+        if len(args) == 1:
+            if not len(args[0]):
+                raise LispTypeError('min of an empty vector')
+            return to_python(args[0].array.min())
+        return Vector(numpy_apply(lambda *arrays: reduce(numpy_module().minimum, arrays), *map(unwrap, args)))
+
+    @staticmethod
+    def append(x: Pair|Compound, y: Pair|Compound) -> Pair|Compound:
+        """两个Compound相接仍得到可修改的Compound,否则复制x并共享y"""
+        if type(x) is not Pair and type(y) is not Pair:
+            return x + y
+        return Pair.from_items(list(x), y)
+
+# mixin在前,其call1/call2覆盖Operator中的通用实现
+class S_OP(Sequential_Mixin,Operator):
     pass
 
-class C_OP(Operator,Comparative_mixin):
+class C_OP(Comparative_mixin,Operator):
     pass
 
-class L_OP(Operator,List_mixin):
+class L_OP(List_mixin,Operator):
     pass
 
-class O_OP(Operator,One_mixin):
+class O_OP(One_mixin,Operator):
     pass
 
 
@@ -586,32 +2480,111 @@ def standard_env() -> Environment:
             '<=': C_OP(op.le,(2,None),all_float),
             '=': C_OP(op.eq,(2,None),all_float),
             'abs': O_OP(abs,(1,1),all_float),
-            'append': S_OP(op.add,(2,None),one_list),
-            'car': O_OP(lambda x: x[0],(1,1),one_list),
-            'cdr': O_OP(lambda x: Compound(x[1:]),(1,1),one_list),
+            'append': S_OP(Func.append,(2,None),one_list),
+            'car': O_OP(Func.car,(1,1),one_list),
+            'cdr': O_OP(Func.cdr,(1,1),one_list),
             'eq?': C_OP(op.is_,(2,None)),
             'equal?': C_OP(op.eq,(2,None)),
             'length': O_OP(len,(1,1),one_list),
             'list': L_OP(Compound,(0,None)),
-            'list?': C_OP(lambda x: isinstance(x, Compound),(1,None)),
-            'max': L_OP(max,(1,None),all_float),
-            'min': L_OP(min,(1,None),all_float),
+            'list?': O_OP(lambda x: isinstance(x, LIST_TYPES),(1,1)),
+            'max': L_OP(Func.max,(1,None),all_float),
+            'min': L_OP(Func.min,(1,None),all_float),
             'not': O_OP(lambda x: not x,(1,1)),
             'empty?': O_OP(lambda x: x == [],(1,1),one_list),
-            'number?': C_OP(lambda x: isinstance(x, (int, float)),(1,None)),
+            'number?': C_OP(lambda x: isinstance(x, NUMBER_TYPES),(1,None)),
             'procedure?': C_OP(callable,(1,None)),
             'symbol?': C_OP(lambda x: isinstance(x, Symbol),(1,None)),
-            'cons': S_OP(lambda x,y: Compound([x]+y),(2,2),one_list_end),
+            'cons': S_OP(Pair,(2,2),one_list_end),
             'map': Map_OP(),
+            'pmap': PMap_OP(),
             'and': And_OP(),
             'or': Or_OP(),
             'set-ref!': L_OP(Func.set_ref,(3,3),list_int_object),
+            'memoize': L_OP(lambda args: Memoized(*args),(1,2),procedure_int),
+            'memo-stats': O_OP(Memoized.stats,(1,1),memoized),
+            'vector': L_OP(Vector.from_items,(0,None)),
+            'list->vector': O_OP(Vector.from_items,(1,1),one_list),
+            'vector-range': L_OP(lambda args: Vector.range(*args),(1,3),all_float),
+            'vector->list': O_OP(Vector.to_list,(1,1),all_vector),
+            'vector?': O_OP(lambda x: type(x) is Vector,(1,1)),
+            'vector-length': O_OP(len,(1,1),all_vector),
+            'vector-ref': L_OP(lambda args: args[0].ref(args[1]),(2,2),vector_int),
+            'vector-sum': O_OP(Vector.sum,(1,1),all_vector),
+            'vector-prod': O_OP(Vector.prod,(1,1),all_vector),
+            'vector-mean': O_OP(Vector.mean,(1,1),all_vector),
+            'vector-dot': L_OP(lambda args: args[0].dot(args[1]),(2,2),all_vector),
+            'force': O_OP(force,(1,1)),
+            'the-empty-stream': Compound([]),
+            'stream-null?': O_OP(lambda x: isinstance(x, LIST_TYPES) and not len(x),(1,1)),
+            'stream-car': O_OP(lambda s: s.car,(1,1),one_stream),
+            'stream-cdr': O_OP(Stream.rest,(1,1),one_stream),
+            'stream-map': L_OP(lambda args: stream_map(args[0], args[1:]),(2,None)),
+            'stream-filter': L_OP(lambda args: stream_filter(*args),(2,2),procedure_stream),
+            'stream-take': L_OP(lambda args: stream_take(*args),(2,2),stream_int),
+            'stream->list': L_OP(lambda args: stream_to_list(*args),(1,2),stream_int),
+            'file-lines': O_OP(file_lines,(1,1),one_path),
+            'read-csv': O_OP(read_csv,(1,1),one_path),
+            'make-hash-table': L_OP(lambda args: HashTable(),(0,0)),
+            'hash-table?': O_OP(lambda x: type(x) is HashTable,(1,1)),
+            'hash-table-ref': L_OP(lambda args: args[0].ref(*args[1:]),(2,3),hash_table),
+            'hash-table-set!': L_OP(lambda args: args[0].set(args[1], args[2]),(3,3),hash_table),
+            'hash-table-delete!': L_OP(lambda args: args[0].delete(args[1]),(2,2),hash_table),
+            'hash-table-contains?': L_OP(lambda args: args[0].contains(args[1]),(2,2),hash_table),
+            'hash-table-update!': L_OP(lambda args: args[0].update(*args[1:]),(3,4),hash_table),
+            'hash-table-count': O_OP(len,(1,1),hash_table),
+            'hash-table-keys': O_OP(HashTable.keys,(1,1),hash_table),
+            'hash-table-values': O_OP(HashTable.values,(1,1),hash_table),
     })
     return env
 
 run_env:Environment=standard_env()
 
-def eval(exp: Exp,env=run_env) -> Atom:
+
+# eval与编译模式下的非尾调用每STACK_CHECK_SPARSE+1次检查一次python栈的深度,将要用尽时改由machine.py在显式栈上继续,
+# 不再增长python栈。一旦发现栈深就每次都检查,直到栈退回。计数只决定检查的时机,多线程下不精确也无妨
+STACK_CHECK = 0
+STACK_CHECK_SPARSE = 15
+STACK_CHECK_MASK = STACK_CHECK_SPARSE
+
+
+def stack_is_deep() -> bool:
+    """python栈距离递归深度限制不足HEAP_STACK_MARGIN帧(sys._getframe在栈不够深时抛出ValueError)"""
+    global STACK_CHECK_MASK
+    try:
+        sys._getframe(max(sys.getrecursionlimit() - HEAP_STACK_MARGIN, 0))
+    except ValueError:
+        STACK_CHECK_MASK = STACK_CHECK_SPARSE
+        return False
+    STACK_CHECK_MASK = 0
+    return True
+
+# 正在统计的profiler(见profiler.py):named let/do的原生循环与machine.py中的过程调用据此自行记录
+PROFILER: Any = None
+
+
+def active_profiler() -> Any:
+    """开启profiler的线程中返回它,否则返回None"""
+    profiler = PROFILER
+    if profiler is not None and profiler.thread == threading.get_ident():
+        return profiler
+    return None
+
+
+def eval(exp: Exp,env=run_env,fuel:int|None=None) -> Atom:
+    """
+    fuel为None时求值到结束;否则最多执行fuel步,用完时返回可以继续求值的Continuation(见machine.py)
+    python栈将要用尽时同样改由machine.py在显式栈上求值
+    """
+    global STACK_CHECK
+    t = type(exp)
+    if (t is LocalRef or t is GlobalRef) and fuel is None:
+        # 变量引用不会嵌套求值,不必检查栈深
+        return exp.lookup(env) #type:ignore
+    STACK_CHECK += 1
+    if fuel is not None or (not STACK_CHECK & STACK_CHECK_MASK and stack_is_deep()):
+        from machine import run
+        return run(exp, env, fuel)
     # 用于优化尾递归
     result=None
     exp_queue=[exp]
@@ -620,7 +2593,7 @@ def eval(exp: Exp,env=run_env) -> Atom:
         if isinstance(exp, Compound):
             result= exp.evaluate(env,exp_queue)
             # 尾递归优化，传递的是新的环境
-            if isinstance(result, Environment):
+            if type(result) is Frame:
                 env=result
         else:
             if isinstance(exp, Symbol):
@@ -636,26 +2609,33 @@ def eval(exp: Exp,env=run_env) -> Atom:
 #                                             Error                                                 #
 #####################################################################################################
 
-from prompt_toolkit import HTML
-from prompt_toolkit.shortcuts import print_formatted_text
-from lisp_shell_config import ERROR_STYLE
-# 定义样式
-style = ERROR_STYLE
-
+import re
+from html import escape, unescape
+from lisp_shell_config import ERROR_EXP_LENGTH, ERROR_STACK_DEPTH
+# 报错信息中使用的标签,纯文本输出时去掉
+MARKUP_RE = re.compile(r'</?(?:input|keyword|error)>')
 
 class InterpretError(Exception):
     """Generic interpreter exception."""
-    def display(self):
+    def markup(self) -> list[str]:
+        """带样式标签的报错信息,每项为一段html"""
         if isinstance(self.output, str):
-            print_formatted_text(HTML(self.output), style=style)
-        if isinstance(self.output, deque):
-            traceback_info=(f"<error>---------------------------------------------------------------------------</error>\n"
-                            f"<error>{self.__class__.__name__}</error>                                 Traceback (most recent call last)\n")
-            print_formatted_text(HTML(traceback_info), style=style)
-            for i in self.output:
-                print_formatted_text(HTML(i), style=style)
+            return [self.output]
+        traceback_info=(f"<error>---------------------------------------------------------------------------</error>\n"
+                        f"<error>{self.__class__.__name__}</error>                                 Traceback (most recent call last)\n")
+        return [traceback_info, *self.output]
 
-        
+    def display(self):
+        # prompt_toolkit只在需要在终端中显示时才导入
+        from prompt_toolkit import HTML
+        from prompt_toolkit.shortcuts import print_formatted_text
+        from lisp_shell_config import ERROR_STYLE
+        for i in self.markup():
+            print_formatted_text(HTML(i), style=ERROR_STYLE)
+
+    def render_text(self) -> str:
+        """不依赖prompt_toolkit的纯文本报错信息"""
+        return '\n'.join(unescape(MARKUP_RE.sub('', i)) for i in self.markup())
 
     
 class ExpError(InterpretError):
@@ -687,27 +2667,88 @@ class UnmatchedQuote(ExpError):
     def __init__(self, token:Token):
         super().__init__('Nothing after quote',token)
 
+def exp_preview(exp: Exp, limit: int) -> str:
+    """
+    表达式的字符串形式,超过limit个字符时截断并以...结尾
+    逐个元素拼接,遇到超长的表达式时只遍历前limit个字符所需的部分
+    """
+    parts: list[str] = []
+    length = 0
+    stack = [iter((exp,))]
+    while stack:
+        item = next(stack[-1], UNBOUND)
+        if item is UNBOUND:
+            stack.pop()
+            if stack:
+                parts.append(')')
+                length += 1
+            continue
+        # 同一个表中除第一个元素外前面有空格
+        if parts and parts[-1] != '(':
+            parts.append(' ')
+            length += 1
+        # 语法节点有自己的__str__,只展开普通的表
+        if type(item) in (Compound, Compound_, Pair):
+            parts.append('(')
+            length += 1
+            stack.append(iter(item))
+        else:
+            text = str(item)
+            parts.append(text)
+            length += len(text)
+        if length > limit:
+            return ''.join(parts)[:limit] + ' ...'
+    return ''.join(parts)
+
+
 class LispError(InterpretError):
-    """An generic error after Exp generation."""
+    """
+    An generic error after Exp generation.
+    传播过程中只记录出错的表达式,调用栈信息在display(访问output)时才渲染
+    """
 
     def __init__(self, message: str='', exp: Exp=None):
         self.message = message
-        self.output:deque[str] = deque()
-        now=''
-        if isinstance(exp,LocationInterface):
-            now=exp.location_message()
-        now += (f"  <keyword>{str(exp)}</keyword>\n"
-                f"<error>{self.__class__.__name__}:</error>{self.message}\n")
-        self.output.appendleft(now)
+        # stack[0]为出错处,之后依次为外层调用
+        self.stack: list[Exp] = [exp]
 
     def __call__(self, exp: Exp):
         """add call stack information"""
+        if self.stack[0] is None:
+            # 内置过程等抛出时不知道出错的表达式,以所在的调用为出错处
+            self.stack[0] = exp
+        else:
+            self.stack.append(exp)
+        return self
+
+    def locate(self, exp: Exp):
+        """还没有出错处时以exp为出错处(如if的条件为向量时),不增加调用栈"""
+        if self.stack[0] is None:
+            self.stack[0] = exp
+        return self
+
+    @staticmethod
+    def render_frame(exp: Exp) -> str:
         now=''
         if isinstance(exp,LocationInterface):
             now = exp.location_message()
-        now+=f"  <keyword>{str(exp)}</keyword>\n"
-        self.output.appendleft(now)
-        return self
+        return now + f"  <keyword>{escape(exp_preview(exp, ERROR_EXP_LENGTH))}</keyword>\n"
+
+    @property
+    def output(self) -> deque[str]:
+        """由外到内的调用栈,超过ERROR_STACK_DEPTH层时省略中间部分"""
+        frames = self.stack
+        if len(frames) > ERROR_STACK_DEPTH:
+            half = ERROR_STACK_DEPTH // 2
+            omitted = len(frames) - 2 * half
+            output = deque(map(self.render_frame, frames[:half]))
+            output.append(f"  <keyword>... {omitted} frames omitted ...</keyword>\n")
+            output.extend(map(self.render_frame, frames[-half:]))
+        else:
+            output = deque(map(self.render_frame, frames))
+        output[0] += f"<error>{self.__class__.__name__}:</error>{escape(str(self.message))}\n"
+        output.reverse()
+        return output
 
 
 class LispSyntaxError(LispError):
@@ -724,4 +2765,8 @@ class LispProcError(LispError):
 
 class LispNameError(LispError):
     """Appear when can't find that name in the environment"""
-    pass
\ No newline at end of file
+    pass
+
+class LispKeyError(LispError):
+    """Appear when a key is not in a hash table"""
+    pass
@@ -0,0 +1,6 @@
+"""
+解释器的基准测试:python -m benchmark [负载名...] [--modes tree compiled] [-o out.json] [-c base.json]
+对每个负载报告墙钟时间、每秒求值次数与tracemalloc峰值内存,结果可保存为JSON以比较两次运行
+"""
+from benchmark.workloads import Workload, WORKLOADS
+from benchmark.runner import run_all, report
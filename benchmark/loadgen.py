@@ -0,0 +1,112 @@
+"""
+lisp_server的负载生成器:python -m benchmark.loadgen [--port 端口 | --unix 路径 | --spawn] [选项]
+
+建立connections个并发连接,每个连接依次发送requests个请求(每个连接先发送一次setup),
+报告吞吐量与请求延迟的分位数。--spawn时在本进程中启动一个临时的服务
+"""
+from __future__ import annotations
+import sys
+import time
+import asyncio
+import argparse
+from typing import Any
+
+from lisp_server import LispServer, Client, FRAMINGS
+
+DEFAULT_SETUP = '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'
+DEFAULT_SOURCE = '(fib 10)'
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+async def run_connection(connect, setup: str, source: str, requests: int,
+                         latencies: list[float]) -> int:
+    """一个连接上的请求,返回出错的请求数"""
+    errors = 0
+    client: Client = await connect()
+    async with client:
+        if setup and not (await client.request(setup))['ok']:
+            raise RuntimeError(f'setup failed: {setup}')
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = await client.request(source)
+            latencies.append(time.perf_counter() - start)
+            if not response['ok']:
+                errors += 1
+    return errors
+
+
+async def run_load(connect, connections: int = 8, requests: int = 100, setup: str = DEFAULT_SETUP,
+                   source: str = DEFAULT_SOURCE) -> dict[str, Any]:
+    """connect为建立Client的协程函数,返回吞吐量与延迟(秒)的统计"""
+    latencies: list[float] = []
+    start = time.perf_counter()
+    errors = await asyncio.gather(*(run_connection(connect, setup, source, requests, latencies)
+                                    for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+
+def report(stats: dict[str, Any]) -> str:
+    return (f"{stats['requests']} requests over {stats['connections']} connections in {stats['elapsed']:.3f}s, "
+            f"{stats['errors']} errors\n"
+            f"throughput {stats['throughput']:.1f} req/s\n"
+            f"latency(ms) mean {stats['mean'] * 1e3:.3f}  p50 {stats['p50'] * 1e3:.3f}  "
+            f"p95 {stats['p95'] * 1e3:.3f}  p99 {stats['p99'] * 1e3:.3f}  max {stats['max'] * 1e3:.3f}")
+
+
+async def main_async(args: argparse.Namespace) -> dict[str, Any]:
+    server = None
+    if args.spawn:
+        server = LispServer(args.framing, args.compiled)
+        listening = await server.start_tcp('127.0.0.1', 0)
+        host, port = listening.sockets[0].getsockname()[:2]
+        connect = lambda: Client.connect_tcp(host, port, args.framing)
+    elif args.unix:
+        connect = lambda: Client.connect_unix(args.unix, args.framing)
+    else:
+        connect = lambda: Client.connect_tcp(args.host, args.port, args.framing)
+    try:
+        return await run_load(connect, args.connections, args.requests, args.setup, args.source)
+    finally:
+        if server is not None:
+            await server.close()
+
+
+def main(argv: list[str]|None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark.loadgen', description='Load generator for lisp_server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--unix', help='connect to this Unix socket path instead of TCP')
+    parser.add_argument('--spawn', action='store_true', help='start a server in this process')
+    parser.add_argument('--framing', choices=FRAMINGS, default='line')
+    parser.add_argument('-c', '--compiled', action='store_true', help='compiled mode for a spawned server')
+    parser.add_argument('-n', '--connections', type=int, default=8, help='concurrent connections')
+    parser.add_argument('-r', '--requests', type=int, default=100, help='requests per connection')
+    parser.add_argument('--setup', default=DEFAULT_SETUP, help='source sent once per connection')
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help='source of each request')
+    args = parser.parse_args(argv)
+    stats = asyncio.run(main_async(args))
+    print(report(stats))
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any
+
+from analyze_eval import standard_env, EndOfSource
+from interpreter import interpret, StrGen, TokenGen, GenExp
+from profiler import Profiler
+from benchmark.workloads import Workload, WORKLOADS
+
+# 解析负载每次读入的字符数
+PARSE_CHUNK = 4096
+MODES = ('tree', 'compiled')
+
+
+def parse_all(source: str) -> int:
+    """用GenExp解析source中的全部表达式,返回GenExp从TokenGen中取出的token个数"""
+    count = 0
+    def counted():
+        nonlocal count
+        for token in TokenGen(StrGen(source, PARSE_CHUNK), 1):
+            count += 1
+            yield token
+    tokengen = counted()
+    while True:
+        try:
+            GenExp(tokengen)
+        except EndOfSource:
+            return count
+
+
+def count_evals(run) -> int:
+    """
+    在不计时的预热中运行一次负载,返回其中过程(包括内置过程)的调用次数,named let/do的每次循环计为一次
+    调用次数与求值模式无关,因此不同负载、不同模式的每秒求值次数可以比较
+    """
+    with Profiler() as profiler:
+        run()
+    return sum(row.calls for row in profiler.table())
+
+
+def prepare(workload: Workload, mode: str):
+    """返回执行一次负载的函数"""
+    if workload.kind == 'parse':
+        return lambda: parse_all(workload.source)
+    compiled = mode == 'compiled'
+    env = standard_env()
+    if workload.setup:
+        interpret(workload.setup, 1, eval_time=float('inf'), default_env=env, compiled=compiled)
+
+    def run():
+        result = interpret(workload.source, 1, default_env=env, compiled=compiled)[0]
+        if workload.expected is not None and result != workload.expected:
+            raise RuntimeError(f'{workload.name}: expected {workload.expected}, got {result}')
+    return run
+
+
+def measure(workload: Workload, mode: str) -> dict[str, Any]:
+    """
+    先预热一次得到每次运行的求值次数(解析负载为token个数),
+    计时与测内存分开进行:先不开tracemalloc重复运行repeat次取墙钟时间,
+    再在tracemalloc下运行一次得到峰值内存
+    """
+    run = prepare(workload, mode)
+    work = parse_all(workload.source) if workload.kind == 'parse' else count_evals(run)
+    times = []
+    for _ in range(workload.repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    total = sum(times)
+    unit = 'tokens' if workload.kind == 'parse' else 'evals'
+    return {
+        'name': workload.name,
+        'mode': mode if workload.kind == 'interpret' else 'parse',
+        'repeat': workload.repeat,
+        'best': min(times),
+        'mean': total / len(times),
+        unit: work,
+        f'{unit}_per_sec': work * len(times) / total,
+        'peak_kib': peak / 1024,
+    }
+
+
+def run_all(names: list[str]|None = None, modes: tuple[str, ...] = MODES) -> list[dict[str, Any]]:
+    """运行名字在names中(None为全部)的负载,解析负载与模式无关只运行一次"""
+    results = []
+    for workload in WORKLOADS:
+        if names and workload.name not in names:
+            continue
+        for mode in (modes if workload.kind == 'interpret' else modes[:1]):
+            results.append(measure(workload, mode))
+    return results
+
+
+def report(results: list[dict[str, Any]], baseline: list[dict[str, Any]]|None = None) -> str:
+    """格式化结果表,给出baseline时附加相对于它的加速比"""
+    old = {(r['name'], r['mode']): r for r in baseline or []}
+    header = f"{'name':<12}{'mode':<10}{'best(s)':>10}{'mean(s)':>10}{'evals/s':>12}{'tokens/s':>12}{'peak(KiB)':>12}"
+    if baseline is not None:
+        header += f"{'speedup':>10}"
+    lines = [header]
+    for r in results:
+        rates = ''.join(f"{r[key]:>12.1f}" if key in r else f"{'-':>12}" for key in ('evals_per_sec', 'tokens_per_sec'))
+        line = (f"{r['name']:<12}{r['mode']:<10}{r['best']:>10.4f}{r['mean']:>10.4f}"
+                f"{rates}{r['peak_kib']:>12.1f}")
+        if baseline is not None:
+            before = old.get((r['name'], r['mode']))
+            line += f"{before['best'] / r['best']:>9.2f}x" if before else f"{'-':>10}"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv: list[str]|None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Benchmark the lisp interpreter')
+    parser.add_argument('names', nargs='*', help='workloads to run (default: all)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help='evaluation modes')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('-c', '--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('-l', '--list', action='store_true', help='list workloads and exit')
+    args = parser.parse_args(argv)
+    if args.list:
+        for workload in WORKLOADS:
+            print(f'{workload.name:<12}{workload.kind}')
+        return 0
+    unknown = set(args.names) - {w.name for w in WORKLOADS}
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    results = run_all(args.names, tuple(args.modes))
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print(report(results, baseline))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'time': time.time(), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+from typing import NamedTuple
+
+
+class Workload(NamedTuple):
+    """
+    一个基准测试负载
+    kind为'interpret'时先在新环境中运行setup,再用interpret重复运行source
+    kind为'parse'时用GenExp重复解析source中的全部表达式
+    expected为source最后一个表达式的结果,用于确认负载确实被正确执行
+    """
+    name: str
+    kind: str
+    setup: str
+    source: str
+    repeat: int
+    expected: str|None = None
+
+
+def large_source(copies: int) -> str:
+    """生成用于测试解析速度的大段源代码"""
+    unit = """(define (tree-insert tree k)
+  (cond ((empty? tree) (list k (list) (list)))
+        ((< k (car tree)) (list (car tree) (tree-insert (car (cdr tree)) k) (car (cdr (cdr tree)))))
+        (else (list (car tree) (car (cdr tree)) (tree-insert (car (cdr (cdr tree))) k)))))
+'(quoted data 1 2.5 -3 #t #f (nested (list of symbols)))
+"""
+    return unit * copies
+
+
+WORKLOADS: list[Workload] = [
+    Workload('fib', 'interpret',
+             '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))',
+             '(fib 18)', 3, '2584'),
+    Workload('tak', 'interpret',
+             '''(define (tak x y z)
+                  (if (not (< y x)) z
+                      (tak (tak (- x 1) y z) (tak (- y 1) z x) (tak (- z 1) x y))))''',
+             '(tak 12 8 4)', 3, '5'),
+    Workload('ackermann', 'interpret',
+             '''(define (ack m n)
+                  (cond ((= m 0) (+ n 1))
+                        ((= n 0) (ack (- m 1) 1))
+                        (else (ack (- m 1) (ack m (- n 1))))))''',
+             '(ack 2 30)', 3, '63'),
+    Workload('countdown', 'interpret',
+             '(define (count n) (if (= n 0) 0 (count (- n 1))))',
+             '(count 30000)', 3, '0'),
+    Workload('cons-list', 'interpret',
+             '''(define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+                (define (sum l acc) (if (empty? l) acc (sum (cdr l) (+ acc (car l)))))''',
+             '(sum (build 10000 (list)) 0)', 3, '50005000'),
+    Workload('map', 'interpret',
+             '''(define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+                (define big (build 20000 (list)))''',
+             '(length (map (lambda (x) (* x x)) (map abs big)))', 3, '20000'),
+    Workload('closures', 'interpret',
+             '''(define (make-adder n) (lambda (x) (+ x n)))
+                (define (chain f n) (if (= n 0) f (chain (lambda (x) ((make-adder n) (f x))) (- n 1))))
+                (define deep (chain (lambda (x) x) 60))
+                (define (repeat n acc) (if (= n 0) acc (repeat (- n 1) (deep acc))))''',
+             '(repeat 200 0)', 3, '366000'),
+    Workload('parse', 'parse', '', large_source(500), 3),
+]
@@ -1,12 +1,16 @@
+import re
 from typing import Generator
 from analyze_eval import * 
 from fractions import Fraction
-from lisp_shell_config import MAX_IN, EVAL_TIME
+from lisp_shell_config import MAX_IN, EVAL_TIME, COMPILED, EXACT_FRACTION, ATOM_CACHE_SIZE
+QUOTE = Symbol('quote')
 def interpret(
-    source: str, time: int, max_in: int = MAX_IN, eval_time: int|float  = EVAL_TIME, default_env:Environment= run_env
+    source: str, time: int, max_in: int = MAX_IN, eval_time: int|float  = EVAL_TIME, default_env:Environment= run_env,
+    compiled: bool = COMPILED
 ) -> tuple[str|None, str, set[str]]:
     """
     解释器入口:time为当前shell输入次数,max_in为最大输入长度,eval_time为最大运行次数
+    compiled为真时表达式先编译为闭包再执行
     返回值为:结果,剩余输入,当前环境
     """
     strgen = StrGen(source, max_in)
@@ -19,7 +23,7 @@ def interpret(
             except EndOfSource:
                 # 表达式全部运行结束
                 break
-            result=eval(analyze(exp),default_env)
+            result=eval(analyze(exp,compiled),default_env)
         except InterpretError as result:
             result.display()
             if isinstance(result,ExpError):
@@ -31,7 +35,13 @@ def interpret(
 
     left=find_left(tokengen,source)
     if result is not None:
-        return str(result),left,set(run_env.keys())
+        try:
+            text=str(result)
+        except ValueError as e:
+            # 整数超过python转换为字符串的位数限制(见sys.set_int_max_str_digits)
+            LispProcError(str(e),exp).display()
+            return None,left,set(run_env.keys())
+        return text,left,set(run_env.keys())
     else:
         return None,left,set(run_env.keys())
 
@@ -52,58 +62,78 @@ def StrGen(source: str, max_in: int) -> Generator[str, None, None]:
         start += max_in
 
 
+# 一次匹配一个完整的token:换行单独匹配用于计算行号,空格不匹配直接跳过
+TOKEN_RE = re.compile(r"\n|[()']|[^() \n']+")
+
+
 def TokenGen(
     strgen: Generator[str, None, None], time: int
 ) -> Generator[Token, None, None]:
-    """读取字符串生成器，生成Token"""
-    col, line = -1, 1
+    """
+    读取字符串生成器，生成Token
+    每块字符串用正则整体切分,最后一个分隔符之后的部分可能是跨越块边界的token,留到与下一块拼接后再切分
+    """
+    # 直接用tuple.__new__构造NamedTuple,省去其python层的__new__
+    new = tuple.__new__
+    finditer = TOKEN_RE.finditer
+    line = 1
+    line_start = 0  # 当前行首在源代码中的位置
+    offset = 0  # 当前块首在源代码中的位置
     pending = ""
-    finished = []
-    where = -1
     for string in strgen:
-        for i in string:
-            where+=1
-            if i == "\n":
+        chunk = pending + string
+        base = offset - len(pending)
+        offset += len(string)
+        cut = max(chunk.rfind(" "), chunk.rfind("\n"), chunk.rfind("("), chunk.rfind(")"), chunk.rfind("'")) + 1
+        pending = chunk[cut:]
+        for match in finditer(chunk, 0, cut):
+            value = match.group()
+            if value == "\n":
                 line += 1
-                col = -1
-            else:
-                col += 1
-            # 分割符
-            if i in {"(", ")", " ", "\n", "'"}:
-                if pending:
-                    finished.append(
-                        Token(pending, Location(line, col - len(pending), time),where-len(pending))
-                    )
-                    pending = ""
-
-                if i in {"(", ")", "'"}:
-                    finished.append(Token(i, Location(line, col, time),where))
-
+                line_start = base + match.end()
             else:
-                pending += i
-
-        yield from finished
-
-        finished = []
+                where = base + match.start()
+                yield new(Token, (value, new(Location, (line, where - line_start, time)), where))
     if pending:
-        yield Token(pending, Location(line, col - len(pending)+1, time),where-len(pending)+1)
-
+        where = offset - len(pending)
+        yield Token(pending, Location(line, where - line_start, time), where)
+
+
+# 数字只可能以数字、正负号或小数点开头,其余token不必尝试匹配
+NUMBER_START = frozenset('0123456789+-.')
+NUMBER_RE = re.compile(r"""[+-]?(?:
+    (?P<int>\d+)
+   |(?P<float>(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?|\d+[eE][+-]?\d+)
+   |(?P<fraction>\d+/\d+)
+)""", re.VERBOSE)
+# token字面值到原子的缓存:相同的数字字面量共享同一个对象,符号与布尔值直接命中
+ATOM_CACHE: dict[str, Atom] = {'#t': True, '#f': False}
+
+
+def prase_atom(token:Token)->Atom:
+    """单次匹配判断token为整数、浮点数、分数、布尔值或符号,不依赖异常"""
+    value = token.value
+    atom = ATOM_CACHE.get(value)
+    if atom is not None:
+        return atom
+    match = NUMBER_RE.fullmatch(value) if value[0] in NUMBER_START else None
+    if match is None:
+        atom = Symbol(value)
+    elif match.lastgroup == 'int':
+        atom = int(value)
+    elif match.lastgroup == 'float':
+        atom = float(value)
+    else:
+        numerator, denominator = value.split('/')
+        if int(denominator) == 0:
+            return Symbol(value)
+        # 分数不进入缓存,其取值取决于EXACT_FRACTION
+        fraction = Fraction(int(numerator), int(denominator))
+        return fraction if EXACT_FRACTION else float(fraction)
+    if len(ATOM_CACHE) < ATOM_CACHE_SIZE:
+        ATOM_CACHE[value] = atom
+    return atom
 
-def prase_atom(token:Token)->Atom:                 
-    try:
-        return int(token.value)
-    except ValueError:
-            try:
-                return float(token.value)
-            except ValueError:
-                try:
-                    return float(Fraction(token.value))
-                except ValueError:
-                    if token.value in {"#t", "#f"}:
-                        return (token.value == "#t")
-                    else:
-                        return Symbol_(token)
-                    
 def GenExp(tokengen: Generator[Token, None, None],slot:Token|None=None) -> Exp:
     stack: list[Token] = []  # 事实上空间只需要一个Token
     result = None
@@ -133,7 +163,7 @@ def GenExp(tokengen: Generator[Token, None, None],slot:Token|None=None) -> Exp:
             else:
             # 如果result不为None,说明这是嵌套括号
             # 将当前token放入预留槽,并递归解析
-                result.append(GenExp(tokengen,token))
+                result.add(GenExp(tokengen,token))
 
         elif token.value == ")":
             try:
@@ -152,15 +182,14 @@ def GenExp(tokengen: Generator[Token, None, None],slot:Token|None=None) -> Exp:
             except StopIteration:
                 raise UnmatchedQuote(token)
             
-            new_token=Token('quote',token.location,token.where)
             if isinstance(next_exp,Compound_):
-                tmp=Compound_([Symbol_(new_token),next_exp],token.location,next_exp.end)
+                tmp=Compound_([QUOTE,next_exp],token.location,next_exp.end,[token.location,None])
             else:
-                tmp=Compound_([Symbol_(new_token),next_exp],token.location,next_token.location)
+                tmp=Compound_([QUOTE,next_exp],token.location,next_token.location,[token.location,next_token.location])
             if result is None:
                 result=tmp
             else:
-                result.append(tmp)
+                result.add(tmp)
                 
 
         else:
@@ -169,7 +198,7 @@ def GenExp(tokengen: Generator[Token, None, None],slot:Token|None=None) -> Exp:
                 result=prase_atom(token) # type:ignore
 
             else:
-                result.append(prase_atom(token))  # type:ignore
+                result.add(prase_atom(token),token.location)  # type:ignore
 
         if not stack:
             break
@@ -1,6 +1,7 @@
 import ast
 import math
 from pytest import mark, fixture, raises
+import analyze_eval
 from analyze_eval import *
 from interpreter import *
 
@@ -25,13 +26,49 @@ def test_parse(source: str, expected) -> None:
 
 #通过测试
 
+@mark.parametrize('max_in', [1, 2, 3, 100])
+def test_token_across_chunks(max_in: int) -> None:
+    source = "(define abc\n  '(12 3.5))"
+    tokens = list(TokenGen(StrGen(source, max_in), 1))
+    assert [t.value for t in tokens] == ['(', 'define', 'abc', "'", '(', '12', '3.5', ')', ')']
+    assert [t.where for t in tokens] == [0, 1, 8, 14, 15, 16, 19, 22, 23]
+    # 紧跟换行的token仍位于其所在行
+    assert tokens[2].location == Location(1, 8, 1)
+    assert tokens[3].location == Location(2, 2, 1)
+    assert tokens[-1].location == Location(2, 11, 1)
+
+@mark.parametrize('value, expected', [
+    ('12', 12), ('-3', -3), ('1.5', 1.5), ('.5', 0.5), ('-2.5E-3', -0.0025),
+    ('1/2', 0.5), ('#t', True), ('#f', False),
+    ('+', 'x+'), ('...', 'x...'), ('1/0', 'x1/0'), ('inf', 'xinf'), ('1a', 'x1a'),
+])
+def test_prase_atom(value: str, expected) -> None:
+    got = prase_atom(Token(value, Location(1, 0, 1), 0))
+    if isinstance(expected, str):
+        assert isinstance(got, Symbol) and got == expected[1:]
+    else:
+        assert got == expected and type(got) is type(expected)
+
+
+def test_atom_cache_shares_literals() -> None:
+    token = Token('123456789', Location(1, 0, 1), 0)
+    assert prase_atom(token) is prase_atom(token)
+    assert prase_atom(Token('car', Location(1, 0, 1), 0)) is Symbol('car')
+
+
+def test_exact_fraction(monkeypatch) -> None:
+    import interpreter
+    monkeypatch.setattr(interpreter, 'EXACT_FRACTION', True)
+    got = interpret('(+ 1/2 1/3)', 1, 100, 1, standard_env())[0]
+    assert got == '5/6'
+
 # ########################################################## tests for evaluate
 
 # Norvig's tests are not isolated: they assume the
 # same environment from first to last test.
 # Norvig_suite_global_env = standard_env()
 # #quote 可能会对内部数字进行处理
-@mark.parametrize( 'source, expected', [
+norvig_suite = [
     ("(quote (testing 1 (2.0) -3.14e159))", "(testing 1 (2.0) -3.14e+159)"),
     ("(+ 2 2)", "4"),
     ("(+ (* 2 100) (* 1 10))", "210"),
@@ -60,10 +97,20 @@ def test_parse(source: str, expected) -> None:
                         ((combine f) (cdr x) (cdr y)))))))""", None),
     ("(define zip (combine list))", None),
     ("(zip (list 1 2 2) (list 4 5 6))", "((1 4) (2 5) (2 6))"),
-])
+]
+
+@mark.parametrize( 'source, expected', norvig_suite)
 def test_evaluate(source: str, expected: Exp | None) -> None:
     got = interpret(source, 1, 100, 1)[0]
     assert got == expected
+
+# 编译模式同样不隔离环境
+compiled_suite_env = standard_env()
+
+@mark.parametrize( 'source, expected', norvig_suite)
+def test_evaluate_compiled(source: str, expected: Exp | None) -> None:
+    got = interpret(source, 1, 100, 1, compiled_suite_env, compiled=True)[0]
+    assert got == expected
 # 通过测试
 
 
@@ -217,6 +264,28 @@ def test_call_builtin_map_2(std_env: Environment) -> None:
     assert got == '(5 7 9)'
 
 
+def test_cons_shares_structure(std_env: Environment) -> None:
+    source = "(define a (cons 1 '(2 3))) (define b (cons 0 a)) (eq? (cdr b) a)"
+    got = interpret(source, 1, 100, 3, std_env)[0]
+    assert got == 'True'
+    source = "(list (length b) (car (cdr (cdr b))) (append b '(4)) (equal? (cdr a) '(2 3)) (list? a))"
+    got = interpret(source, 1, 100, 1, std_env)[0]
+    assert got == '(4 2 (0 1 2 3 4) True True)'
+    # 序对不可修改,set-ref!只作用于Compound
+    with raises(LispTypeError):
+        exps = TokenGen(StrGen('(set-ref! a 0 5)', 100), 1)
+        eval(analyze(GenExp(exps)), std_env)
+
+
+def test_cons_long_list(std_env: Environment) -> None:
+    source = '''(define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+    (define (sum l acc) (if (empty? l) acc (sum (cdr l) (+ acc (car l)))))
+    (define l (build 100000 (list)))
+    (list (length l) (sum l 0) (car (map (lambda (x) (* x 2)) l)))'''
+    got = interpret(source, 1, 100, 4, std_env)[0]
+    assert got == '(100000 5000050000 2)'
+
+
 def test_define_procedure(std_env: Environment) -> None:
     source = '(max 1 2 3)'
     got = interpret(source, 1, 100, 1,std_env)[0]
@@ -302,6 +371,29 @@ def test_and(source: str, expected) -> None:
     got = interpret(source, 1, 100, 1)[0]
     assert got == expected
 
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source, expected', [
+    ('(- 5 2)', '3'),
+    ('(< 1 2)', 'True'),
+    ('(< 2 1)', 'False'),
+    ('(abs -2)', '2'),
+    ('(list 1 2)', '(1 2)'),
+    ('(map abs (list -1 -2))', '(1 2)'),
+    ('(map + (list 1 2) (list 3 4))', '(4 6)'),
+    ('(and 0 (crash))', 'False'),
+])
+def test_operator_fast_path(source: str, expected: str, compiled: bool) -> None:
+    got = interpret(source, 1, 100, 1, standard_env(), compiled=compiled)[0]
+    assert got == expected
+
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source', ['(- 5)', '(abs 1 2)', '(car 1)', "(+ 1 'a)", '(cons 1)'])
+def test_operator_fast_path_error(source: str, compiled: bool) -> None:
+    with raises(LispTypeError):
+        eval(analyze(GenExp(TokenGen(StrGen(source, 100), 1)), compiled), standard_env())
+
 # ############### tail-call optimization (TCO)
 
 def test_simple_user_procedure_call(std_env: Environment) -> None:
@@ -359,3 +451,875 @@ def test_tail_call_factorial(std_env: Environment) -> None:
     source = f'(factorial-iter {n} 1)'
     got = interpret(source, 1, 100, 1,std_env)[0]
     assert got == str(math.prod(range(2, n + 1)))
+
+
+def test_tail_call_countdown_compiled(std_env: Environment) -> None:
+    countdown_scm = """
+        (define (countdown n)
+            (if (= n 0)
+                0
+                (countdown (- n 1))))
+    """
+    interpret(countdown_scm, 1, 100, 1, std_env, compiled=True)
+    got = interpret('(countdown 100000)', 1, 100, 1, std_env, compiled=True)[0]
+    assert got == '0'
+
+
+def test_compiled_error_call_stack() -> None:
+    source = """
+        (define (c x) (return (car x)))
+        (define (b x) (+ 1 (c x)))
+        (b 1)
+    """
+    def call_stack(compiled: bool) -> list[str]:
+        env = standard_env()
+        tokengen = TokenGen(StrGen(source, 100), 1)
+        with raises(LispError) as excinfo:
+            while True:
+                eval(analyze(GenExp(tokengen), compiled), env)
+        return list(excinfo.value.output)
+
+    expected = call_stack(False)
+    # (+ 1 (c x)) -> (c x) -> (car x),内置过程的报错以所在的调用为出错处
+    assert len(expected) == 3 and 'None' not in ''.join(expected)
+    assert call_stack(True) == expected
+
+
+def test_error_output_limits() -> None:
+    big = Compound([Symbol('<')] * 100000)
+    error = LispError('message', big)
+    for _ in range(1000):
+        error(big)
+    assert len(error.stack) == 1001
+    output = error.output
+    # 中间的调用栈被省略为一行
+    assert len(output) == ERROR_STACK_DEPTH + 1
+    assert 'frames omitted' in output[ERROR_STACK_DEPTH // 2]
+    # 表达式被截断并转义
+    assert output[0].count('&lt;') == ERROR_EXP_LENGTH // 2 and ' ...' in output[0]
+    assert output[-1].endswith('message\n')
+
+############### lexical addressing
+
+def test_lexical_address() -> None:
+    source = '(lambda (f g) (lambda (x) (f (g x))))'
+    outer = analyze(GenExp(TokenGen(StrGen(source, 100), 1)))
+    inner = outer.body[0] #type: ignore
+    call = inner.body[0]
+    assert (call[0].depth, call[0].slot) == (1, 0)
+    assert (call[1][0].depth, call[1][0].slot) == (1, 1)
+    assert (call[1][1].depth, call[1][1].slot) == (0, 0)
+    assert isinstance(analyze(GenExp(TokenGen(StrGen('(car x)', 100), 1)))[0], GlobalRef)
+
+
+def test_internal_define_mutual_recursion(std_env: Environment) -> None:
+    source = """
+        (define (parity n)
+            (define (even? n) (if (= n 0) #t (odd? (- n 1))))
+            (define (odd? n) (if (= n 0) #f (even? (- n 1))))
+            (list (even? n) (odd? n)))
+        (parity 7)
+    """
+    got = interpret(source, 1, 100, 2, std_env)[0]
+    assert got == '(False True)'
+
+
+def test_set_outer_local(std_env: Environment) -> None:
+    source = """
+        (define (make-counter)
+            (define n 0)
+            (lambda () (set! n (+ n 1)) n))
+        (define c (make-counter))
+        (c) (c) (c)
+    """
+    got = interpret(source, 1, 100, 5, std_env)[0]
+    assert got == '3'
+    got = interpret(source, 1, 100, 5, std_env, compiled=True)[0]
+    assert got == '3'
+
+
+def test_unbound_internal_define(std_env: Environment) -> None:
+    source = '(define (f) (define a b) (define b 1) a) (f)'
+    with raises(LispNameError):
+        exps = TokenGen(StrGen(source, 100), 1)
+        eval(analyze(GenExp(exps)), std_env)
+        eval(analyze(GenExp(exps)), std_env)
+
+############### benchmark
+
+def test_benchmark_runner(tmp_path) -> None:
+    from benchmark.runner import main, run_all, report, parse_all
+    results = run_all(['tak', 'parse'], ('compiled',))
+    assert [(r['name'], r['mode']) for r in results] == [('tak', 'compiled'), ('parse', 'parse')]
+    assert all(r['best'] > 0 and r['peak_kib'] > 0 for r in results)
+    assert results[0]['evals_per_sec'] > 0 and results[1]['tokens_per_sec'] > 0
+    # 解析负载数的是token:'(a (b 1)) 的token为 ' ( a ( b 1 ) )
+    assert parse_all("'(a (b 1)) x") == 9
+    # 求值次数与模式无关
+    tree, compiled = run_all(['fib'])
+    assert tree['evals'] == compiled['evals'] > 0
+    assert 'speedup' in report(results, results)
+    output = tmp_path / 'result.json'
+    assert main(['tak', '--modes', 'tree', '-o', str(output)]) == 0
+    assert output.exists()
+
+############### profiler
+
+@mark.parametrize('compiled', [False, True])
+def test_profile_table(compiled: bool) -> None:
+    import analyze_eval
+    from profiler import profile
+    original = (Procedure.__call__, Procedure.enter, S_OP.call2, analyze_eval.eval)
+    source = '''(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+    (define (count n) (if (= n 0) 0 (count (- n 1))))
+    (fib 10) (count 100)'''
+    rows = {row.name: row for row in profile(source, standard_env(), compiled)}
+    assert (rows['fib'].calls, rows['fib'].tail_calls) == (177, 0)
+    assert (rows['count'].calls, rows['count'].tail_calls) == (101, 100)
+    assert rows['fib'].location == 'In[1] line 1, col 0'
+    assert rows['<operator:add>'].calls == 88
+    assert rows['fib'].inclusive >= rows['fib'].exclusive > 0
+    # 关闭后恢复原来的入口
+    assert (Procedure.__call__, Procedure.enter, S_OP.call2, analyze_eval.eval) == original
+
+
+@mark.parametrize('compiled', [False, True])
+def test_profile_form(compiled: bool, capsys) -> None:
+    env = standard_env()
+    interpret('(define (sq x) (* x x))', 1, 100, 1, env, compiled=compiled)
+    got = interpret('(profile (+ (sq 3) (sq 4)))', 1, 100, 1, env, compiled=compiled)[0]
+    assert got == '25'
+    lines = capsys.readouterr().out.splitlines()
+    assert 'inclusive' in lines[0] and 'sq' in lines[1] and lines[1].split()[0] == '2'
+
+
+@mark.parametrize('compiled', [False, True])
+def test_profile_loop_and_deep(monkeypatch, compiled: bool) -> None:
+    import sys
+    from profiler import profile
+    source = '''(define (fact n) (if (<= n 1) 1 (* n (fact (- n 1)))))
+    (define (sum n) (let loop ((i 0) (acc 0)) (if (> i n) acc (loop (+ i 1) (+ acc i)))))
+    (fact 300) (sum 100) (do ((i 0 (+ i 1))) ((= i 5) i))'''
+    # 原生循环与python栈将要用尽后在显式栈上的调用同样被统计,全部在显式栈上求值时结果相同
+    monkeypatch.setattr(analyze_eval, 'STACK_CHECK_MASK', 0)
+    for margin in (analyze_eval.HEAP_STACK_MARGIN, sys.getrecursionlimit()):
+        monkeypatch.setattr(analyze_eval, 'HEAP_STACK_MARGIN', margin)
+        rows = {row.name: row for row in profile(source, standard_env(), compiled)}
+        assert rows['fact'].calls == 300
+        assert (rows['loop'].calls, rows['loop'].tail_calls) == (102, 101)
+        assert (rows['do loop'].calls, rows['do loop'].tail_calls) == (6, 5)
+        assert rows['loop'].inclusive >= rows['loop'].exclusive > 0
+    assert analyze_eval.PROFILER is None
+
+
+@mark.parametrize('compiled', [False, True])
+def test_profile_threads(compiled: bool) -> None:
+    import threading
+    from profiler import profile
+    fib = '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'
+    stop = threading.Event()
+    results = []
+    def other() -> None:
+        env = standard_env()
+        interpret(fib, 1, 100, 1, env, compiled=compiled)
+        while not stop.is_set():
+            results.append(interpret('(fib 10)', 1, 100, 1, env, compiled=compiled)[0])
+    thread = threading.Thread(target=other)
+    thread.start()
+    try:
+        rows = {row.name: row for row in profile(fib + ' (fib 15)', standard_env(), compiled)}
+    finally:
+        stop.set()
+        thread.join()
+    # 只统计开启profiler的线程,其他线程的求值不受影响
+    assert rows['fib'].calls == 1973
+    assert results and set(results) == {'55'}
+
+############### memoization
+
+@mark.parametrize('compiled', [False, True])
+def test_define_memo(compiled: bool) -> None:
+    env = standard_env()
+    source = '''(define-memo (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+    (fib 80)'''
+    assert interpret(source, 1, 100, 2, env, compiled=compiled)[0] == '23416728348467685'
+    assert interpret('(memo-stats fib)', 1, 100, 1, env, compiled=compiled)[0] == f'(78 81 81 {MEMO_SIZE})'
+
+
+@mark.parametrize('compiled', [False, True])
+def test_memoize_lru(compiled: bool) -> None:
+    env = standard_env()
+    source = '''(define g (memoize (lambda (l) (length l)) 2))
+    (list (g '(1 2)) (g (cons 1 (list 2))) (g '(1)) (g '(1 2 3)) (g '(1 2)) (memo-stats g))'''
+    # 结构相同的表命中同一项,超过两项时淘汰最久未使用的(1 2)
+    assert interpret(source, 1, 100, 2, env, compiled=compiled)[0] == '(2 2 1 3 2 (1 4 2 2))'
+
+
+def test_structural_key() -> None:
+    assert structural_key(Compound([1, Compound([2])])) == structural_key(Pair(1, Pair(Compound([2]), Compound([]))))
+    assert len({structural_key(1), structural_key(1.0), structural_key(True)}) == 3
+
+############### script runner
+
+def test_lisp_run(tmp_path, capsys) -> None:
+    from lisp_run import main
+    script = tmp_path / 'ok.scm'
+    script.write_text("(define (sq x) (* x x))\n(sq 12)\n(list 1 2)\n")
+    bad = tmp_path / 'bad.scm'
+    bad.write_text("(define x 1)\n(car (quote (< 1)) x)\n")
+    assert main([str(script), '--compiled', '--time']) == 0
+    out, err = capsys.readouterr()
+    assert out == '144\n(1 2)\n' and 'total: 3 expressions' in err
+    assert main([str(script), str(bad)]) == 1
+    out, err = capsys.readouterr()
+    # 纯文本报错:没有样式标签,表达式中的<原样输出
+    assert 'LispTypeError:error arguments number' in err and '(car (quote (< 1)) x)' in err
+    assert '<keyword>' not in err
+    assert main([str(tmp_path / 'missing.scm')]) == 2
+
+
+def test_lisp_run_skips_prompt_toolkit() -> None:
+    import subprocess, sys
+    code = "import sys, lisp_run; print('prompt_toolkit' in sys.modules)"
+    got = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert got.stdout.strip() == 'False'
+
+############### analysis cache
+
+def test_analysis_cache(tmp_path, monkeypatch, capsys) -> None:
+    import analysis_cache
+    from lisp_run import main
+    script = tmp_path / 'lib.scm'
+    script.write_text("(define (f x) (if (< x 0) (- 0 x) x))\n(f -3)\n(car 1)\n")
+    assert main(['-q', str(script)]) == 1
+    assert (tmp_path / '__lispcache__' / 'lib.scm.lispc').exists()
+    first = capsys.readouterr().err
+    # 命中缓存时不再解析,报错中的位置信息与不使用缓存时相同
+    def fail(*args):
+        raise AssertionError('program was analyzed again')
+    monkeypatch.setattr(analysis_cache, 'analyze_program', fail)
+    for compiled in ([], ['-c']):
+        assert main([*compiled, str(script)]) == 1
+        out, err = capsys.readouterr()
+        assert out == '3\n' and err == first
+    # 源码改变后缓存失效
+    script.write_text("(define (f x) (* x x))\n(f -3)\n")
+    with raises(AssertionError):
+        main([str(script)])
+
+
+def test_analysis_cache_load_store(tmp_path, monkeypatch) -> None:
+    import gc, threading
+    import analysis_cache
+    path = str(tmp_path / 'lib.scm')
+    program = analysis_cache.analyze_program('(define x 1) (+ x 2)')
+    analysis_cache.store(path, 'key', program)
+    frozen = []
+    monkeypatch.setattr(gc, 'freeze', lambda: frozen.append(True))
+    # 键不符时不反序列化程序
+    loads = []
+    load = analysis_cache.pickle.load
+    monkeypatch.setattr(analysis_cache.pickle, 'load', lambda f: loads.append(f) or load(f))
+    assert analysis_cache.load(path, 'other') is None
+    assert len(loads) == 1
+    assert [str(exp) for exp in analysis_cache.load(path, 'key')] == [str(exp) for exp in program]
+    # 加载没有副作用:只有作为命令运行的lisp_run才冻结
+    assert not frozen and gc.isenabled()
+    from lisp_run import main
+    (tmp_path / 'lib.scm').write_text('(define x 1) (+ x 2)')
+    assert main(['-q', path]) == 0 and not frozen
+    assert main(['-q', path], freeze=True) == 0 and frozen == [True]
+    # 不能pickle的程序不缓存,也不报错
+    analysis_cache.store(str(tmp_path / 'lock.scm'), 'key', [threading.Lock()])
+    assert not (tmp_path / '__lispcache__' / 'lock.scm.lispc').exists()
+
+
+def test_analysis_cache_syntax_error(tmp_path, capsys) -> None:
+    from lisp_run import main
+    script = tmp_path / 'broken.scm'
+    script.write_text("(+ 1 2)\n(car '(1 2)\n")
+    assert main([str(script)]) == 1
+    out, err = capsys.readouterr()
+    # 有语法错误的源码不缓存,出错前的表达式照常执行
+    assert out == '3\n' and 'UnmatchedLeftParenthesis' in err
+    assert not (tmp_path / '__lispcache__').exists()
+
+############### vector
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source, expected', [
+    ('(* (+ v 1) 2)', '#(2 4 6 8)'),
+    ('(/ v 2)', '#(0.0 0.5 1.0 1.5)'),
+    ('(< v 2)', '#(True True False False)'),
+    ('(abs (- 1 v))', '#(1 0 1 2)'),
+    ('(list (max v) (min v 2))', '(3 #(0 1 2 2))'),
+    ('(map + v (vector-range 4 0 -1))', '#(4 4 4 4)'),
+    ('(map (lambda (x) (* x x)) v)', '#(0 1 4 9)'),
+    ('(begin (define-memo (square x) (* x x)) (map square v))', '#(0 1 4 9)'),
+    ('(map (memoize (lambda (x y) (+ x y))) v v)', '#(0 2 4 6)'),
+    ('(list (vector-sum v) (vector-dot v v) (vector-ref v -1) (vector-length v))', '(6 14 3 4)'),
+    ('(vector->list (list->vector (list 1 2.5)))', '(1.0 2.5)'),
+    ('(vector-sum (* (vector-range 1000000) 2))', '999999000000'),
+    # 超出int64时改用python整数,结果回到int64范围内时转回int64
+    ('(* v 4611686018427387904)', '#(0 4611686018427387904 9223372036854775808 13835058055282163712)'),
+    ('(list (vector-sum (* v 4611686018427387904)) (* (* v 4611686018427387904) 0))', '(27670116110564327424 #(0 0 0 0))'),
+    ('(vector-prod (vector-range 1 30))', '8841761993739701954543616000000'),
+    ('(list (+ v 99999999999999999999) (vector-ref (vector 1 99999999999999999999) 1))',
+     '(#(99999999999999999999 100000000000000000000 100000000000000000001 100000000000000000002) 99999999999999999999)'),
+    ('(/ v 0)', '#(nan inf inf inf)'),
+])
+def test_vector(source: str, expected: str, compiled: bool) -> None:
+    import pytest
+    pytest.importorskip('numpy')
+    import warnings
+    env = standard_env()
+    interpret('(define v (vector 0 1 2 3))', 1, 100, 1, env, compiled=compiled)
+    # numpy的溢出与除零警告不输出
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert interpret(source, 1, 100, 1, env, compiled=compiled)[0] == expected
+
+
+@mark.parametrize('source', ['(vector 1 (list 2))', '(+ (vector 1) (list 1))', '(if (< (vector 1 2) 2) 1 2)',
+                             '(vector-dot (vector 1 2) (vector 1))'])
+def test_vector_error(source: str) -> None:
+    import pytest
+    pytest.importorskip('numpy')
+    with raises(LispTypeError):
+        eval(analyze(GenExp(TokenGen(StrGen(source, 100), 1))), standard_env())
+
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('fuel', [None, 1000])
+@mark.parametrize('source, expected', [
+    ('(if (< v 2) 1 2)', ['(< v 2)']),
+    ('(cond ((= v 1) 1) (else 2))', ['(= v 1)']),
+    ('(list (and v 1))', ['(and v 1)', '(list (and v 1))']),
+    ('(not v)', ['(not v)']),
+])
+def test_vector_truth_error(source: str, expected: list[str], compiled: bool, fuel: int|None) -> None:
+    import pytest
+    pytest.importorskip('numpy')
+    env = standard_env()
+    interpret('(define v (vector 1 2))', 1, 100, 1, env)
+    with raises(LispTypeError) as e:
+        eval(analyze(GenExp(TokenGen(StrGen(source, 100), 1)), compiled), env, fuel)
+    # 报错处为作为条件的表达式或所在的调用,而不是None
+    assert [str(i) for i in e.value.stack] == expected
+
+############### loop
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source, expected', [
+    ('(let loop ((i 0) (acc 0)) (if (= i 10) acc (loop (+ i 1) (+ acc i))))', '45'),
+    ('(let ((x 1) (y 2)) (+ x y))', '3'),
+    ('(let loop ((i 0)) (cond ((< i 5) (begin (define j (+ i 1)) (loop j))) (else i)))', '5'),
+    ('(do ((i 0 (+ i 1)) (acc (list) (cons i acc))) ((= i 4) acc))', '(3 2 1 0)'),
+    ('(do ((i 0 (+ i 1)) (x 7)) ((= i 3) x) (set! x (+ x i)))', '10'),
+    ('(do ((i 0 (+ i 1))) ((= i 3)))', None),
+    # 非尾调用与闭包引用循环变量时按过程展开,每次循环有自己的帧
+    ('(let fact ((n 10)) (if (= n 0) 1 (* n (fact (- n 1)))))', '3628800'),
+    ('(let loop ((i 0) (fs (list))) (if (= i 3) (map (lambda (f) (f)) fs) (loop (+ i 1) (cons (lambda () i) fs))))',
+     '(2 1 0)'),
+    ('(let loop ((f car)) (if (eq? f car) (loop loop) 1))', '1'),
+    # 循环结束时的调用仍是尾调用
+    ('(begin (define (down n) (let loop ((i 0)) (if (< i 2) (loop (+ i 1)) (if (= n 0) 0 (down (- n 1)))))) (down 20000))',
+     '0'),
+    ('(let countdown ((n 100000)) (if (= n 0) 0 (countdown (- n 1))))', '0'),
+])
+def test_loop(source: str, expected: str, compiled: bool) -> None:
+    assert interpret(source, 1, 100, 1, standard_env(), compiled=compiled)[0] == expected
+
+
+@mark.parametrize('source, native', [
+    ('(let loop ((i 0)) (if (< i 3) (loop (+ i 1)) i))', True),
+    ('(do ((i 0 (+ i 1))) ((= i 3) i))', True),
+    ('(let loop ((i 0)) (if (< i 3) (+ 1 (loop (+ i 1))) i))', False),
+    ('(let loop ((i 0)) (if (< i 3) (loop i 1) i))', False),
+    ('(let loop ((i 0)) (if (< i 3) (loop (+ i 1)) (lambda () i)))', False),
+])
+def test_loop_native(source: str, native: bool) -> None:
+    exp = analyze(GenExp(TokenGen(StrGen(source, 100), 1)))
+    assert isinstance(exp, Loop) == native
+
+
+@mark.parametrize('compiled', [False, True])
+def test_loop_error(compiled: bool) -> None:
+    source = '(define (f n) (let loop ((i 0)) (if (= i n) (car i) (loop (+ i 1)))))'
+    env = standard_env()
+    interpret(source, 1, 100, 1, env, compiled=compiled)
+    with raises(LispTypeError) as e:
+        eval(analyze(GenExp(TokenGen(StrGen('(f 3)', 100), 1)), compiled), env)
+    # 与过程的尾调用相同,循环所在的调用已被尾调用替换
+    assert [str(i) for i in e.value.stack] == ['(car i)']
+
+
+############### hash table
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source, expected', [
+    ("(list (hash-table-ref t 1) (hash-table-ref t 'a) (hash-table-ref t 'z 0) (hash-table-count t))", '(one 2 0 3)'),
+    ('(hash-table-ref t (cons 1 (list 2)))', 'l'),
+    ('(list (hash-table-contains? t 1.0) (hash-table-contains? t #t) (hash-table-contains? t (list 1 2)))',
+     '(False False True)'),
+    ("(begin (hash-table-update! t 'a (lambda (x) (* x 10))) (hash-table-update! t 'b abs -1) (hash-table-values t))",
+     '(one 20 l 1)'),
+    ('(begin (hash-table-delete! t 1) (hash-table-delete! t 1) (hash-table-keys t))', '(a (1 2))'),
+    ("(begin (hash-table-set! t 'a 3) (list (hash-table-keys t) (hash-table-ref t 'a)))", '((1 a (1 2)) 3)'),
+    ("(begin (map (lambda (w) (hash-table-update! t w (lambda (n) (+ n 1)) 0)) '(x y x)) (hash-table-ref t 'x))", '2'),
+])
+def test_hash_table(source: str, expected: str, compiled: bool) -> None:
+    env = standard_env()
+    interpret("""(define t (make-hash-table))
+    (hash-table-set! t 1 'one)
+    (hash-table-set! t 'a 2)
+    (hash-table-set! t (list 1 2) 'l)""", 1, 100, 4, env, compiled=compiled)
+    assert interpret(source, 1, 100, 1, env, compiled=compiled)[0] == expected
+
+
+@mark.parametrize('source, error', [
+    ("(hash-table-ref (make-hash-table) 'a)", LispKeyError),
+    ("(hash-table-ref (list 1) 'a)", LispTypeError),
+    ("(hash-table-update! (make-hash-table) 'a car)", LispKeyError),
+    ("(hash-table-set! (make-hash-table) (list car (lambda (x) x)) 1)", None),
+])
+def test_hash_table_error(source: str, error) -> None:
+    exp = analyze(GenExp(TokenGen(StrGen(source, 100), 1)))
+    if error is None:
+        assert eval(exp, standard_env()) is None
+        return
+    with raises(error):
+        eval(exp, standard_env())
+
+
+############### stream
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('source, expected', [
+    ('(list (force p) (force p) count (force 5))', '(1 1 1 5)'),
+    ('(stream->list nat 3)', '(0 1 2)'),
+    ('(stream-car (stream-cdr (stream-cdr nat)))', '2'),
+    ('(stream->list (stream-take (stream-filter (lambda (x) (= 0 (- x (* 3 (quotient x 3))))) (stream-map * nat nat)) 5))',
+     '(0 9 36 81 144)'),
+    ('(stream->list (stream-filter (lambda (x) (> x 5000)) nat) 1)', '(5001)'),
+    ('(stream->list (stream-map + nat (stream-take nat 3)))', '(0 2 4)'),
+    ('(list (stream-null? the-empty-stream) (stream-null? nat) (stream->list (stream-take nat 0)) (stream-take nat 1))',
+     '(True False () (0 . #<promise>))'),
+])
+def test_stream(source: str, expected: str, compiled: bool) -> None:
+    env = standard_env()
+    interpret("""(define (integers-from n) (cons-stream n (integers-from (+ n 1))))
+    (define nat (integers-from 0))
+    (define count 0)
+    (define p (delay (begin (set! count (+ count 1)) count)))""", 1, 100, 4, env, compiled=compiled)
+    assert interpret(source, 1, 100, 1, env, compiled=compiled)[0] == expected
+
+
+@mark.parametrize('compiled', [False, True])
+def test_stream_lazy(compiled: bool) -> None:
+    env = standard_env()
+    # 只有被访问的元素才被计算,访问过的不再重新计算
+    source = """(define calls 0)
+    (define (f x) (set! calls (+ calls 1)) (* x 10))
+    (define (from n) (cons-stream n (from (+ n 1))))
+    (define s (stream-map f (from 0)))
+    (define t (stream-take s 3))
+    (list calls (stream->list t) (stream->list s 3) calls)"""
+    assert interpret(source, 1, 100, 6, env, compiled=compiled)[0] == '(1 (0 10 20) (0 10 20) 3)'
+    with raises(LispTypeError):
+        eval(analyze(GenExp(TokenGen(StrGen('(stream-cdr (list 1 2))', 100), 1)), compiled), env)
+
+
+############### file
+
+def test_file_lines(tmp_path) -> None:
+    path = tmp_path / 'lines.txt'
+    path.write_text('first\nsecond\r\n\nlast')
+    env = standard_env()
+    source = f"""(define s (file-lines '{path}))
+    (define (count s n) (if (stream-null? s) n (count (stream-cdr s) (+ n 1))))
+    (list (stream->list s 2) (count s 0) (stream-car (stream-cdr (stream-cdr (stream-cdr s)))))"""
+    assert interpret(source, 1, 100, 3, env)[0] == '((first second) 4 last)'
+
+
+@mark.parametrize('numpy', [True, False])
+def test_read_csv(tmp_path, monkeypatch, numpy: bool) -> None:
+    if numpy:
+        import pytest
+        pytest.importorskip('numpy')
+    else:
+        def no_numpy():
+            raise LispTypeError('vector requires numpy')
+        monkeypatch.setattr(analyze_eval, 'numpy_module', no_numpy)
+    # 很小的块:各列的类型在之后的块中被提升
+    monkeypatch.setattr(analyze_eval, 'CSV_BLOCK_SIZE', 16)
+    path = tmp_path / 'data.csv'
+    path.write_text('id,x,name,big\n1,2,a,7\n\n2,2.5,"b,c",8\n3,,4,9\n4,1e3,d,99999999999999999999\n')
+    table = read_csv(str(path))
+    assert str(table.keys()) == '(id x name big)'
+    columns = [table.ref(Symbol(name)) for name in ('id', 'x', 'name', 'big')]
+    assert isinstance(columns[0], Vector if numpy else Compound)
+    assert list(columns[0]) == [1, 2, 3, 4]
+    x = list(columns[1])
+    assert x[:2] == [2.0, 2.5] and math.isnan(x[2]) and x[3] == 1000.0
+    assert list(columns[2]) == ['a', 'b,c', '4', 'd']
+    assert list(columns[3]) == [7.0, 8.0, 9.0, 1e20]
+    path.write_text('a,b\n1,2\n3\n')
+    with raises(LispTypeError):
+        read_csv(str(path))
+
+
+############### pmap
+
+@mark.parametrize('compiled', [False, True])
+def test_pmap(compiled: bool) -> None:
+    import multiprocessing, pytest
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('pmap needs fork')
+    env = standard_env()
+    # 强制使用进程池:两个进程,每块3个元素
+    env[Symbol('pmap')] = PMap_OP(workers=2, chunk_size=3, serial_below=0)
+    source = '''(define k 100)
+    (define (f x) (+ x k))
+    (define xs '(1 2 3 4 5 6 7 8 9 10))
+    (list (pmap f xs) (pmap + xs xs '(1 1)) (pmap (lambda (x) (* x x)) '(3)))'''
+    assert interpret(source, 1, 100, 4, env, compiled=compiled)[0] == \
+        '((101 102 103 104 105 106 107 108 109 110) (3 5) (9))'
+    with raises(LispTypeError):
+        eval(analyze(GenExp(TokenGen(StrGen("(pmap car '(1 2 3 4))", 100), 1)), compiled), env)
+
+
+def test_pmap_serial_fallback(monkeypatch) -> None:
+    import concurrent.futures
+    def fail(*args, **kwargs):
+        raise AssertionError('process pool was created')
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', fail)
+    env = standard_env()
+    env[Symbol('pmap')] = PMap_OP(workers=2, serial_below=5)
+    assert interpret("(pmap abs '(-1 2 -3 4))", 1, 100, 1, env)[0] == '(1 2 3 4)'
+    # 有其他线程在运行时不fork
+    import threading
+    env[Symbol('pmap')] = PMap_OP(workers=2, serial_below=0)
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        assert interpret("(pmap abs '(-1 2 -3 4))", 1, 100, 1, env)[0] == '(1 2 3 4)'
+    finally:
+        stop.set()
+        thread.join()
+
+############### server
+
+def test_server_sessions() -> None:
+    import asyncio
+    from lisp_server import LispServer, Client
+
+    async def scenario():
+        server = LispServer()
+        host, port = (await server.start_tcp('127.0.0.1', 0)).sockets[0].getsockname()[:2]
+        try:
+            async with await Client.connect_tcp(host, port) as a, await Client.connect_tcp(host, port) as b:
+                assert (await a.request('(define x 41) (+ x 1)'))['results'] == [None, '42']
+                # 每个连接有独立的环境
+                response = await b.request('(+ 1 2) x')
+                assert not response['ok'] and response['results'] == ['3']
+                assert response['error']['type'] == 'LispNameError' and 'undefined variable x' in response['error']['traceback']
+                # 耗时的求值在线程中进行,不阻塞其他会话
+                await a.request('(define (count n) (if (= n 0) 0 (count (- n 1))))')
+                slow = asyncio.ensure_future(a.request('(count 200000)'))
+                assert (await b.request('(* 6 7)'))['results'] == ['42']
+                assert not slow.done()
+                assert (await slow)['results'] == ['0']
+        finally:
+            await server.close()
+    asyncio.run(scenario())
+
+
+def test_session_unexpected_error() -> None:
+    from lisp_server import Session
+    session = Session()
+    # 结果超过python整数转字符串的位数限制
+    response = session.evaluate('(define (fact n) (if (<= n 1) 1 (* n (fact (- n 1))))) (fact 5000)')
+    assert not response['ok'] and response['results'] == [None]
+    assert response['error']['type'] == 'ValueError' and response['error']['message']
+    assert session.evaluate('(> (fact 5000) 0)')['results'] == ['True']
+
+
+def test_server_unix_length_framing(tmp_path) -> None:
+    import asyncio
+    from lisp_server import LispServer, Client
+    from benchmark.loadgen import run_load
+    path = str(tmp_path / 'lisp.sock')
+
+    async def scenario():
+        server = LispServer('length', compiled=True)
+        await server.start_unix(path)
+        try:
+            async with await Client.connect_unix(path, 'length') as client:
+                response = await client.request("(define (sq x)\n  (* x x))\n(sq 12) '(a b)")
+                assert response['ok'] and response['results'] == [None, '144', '(a b)']
+            return await run_load(lambda: Client.connect_unix(path, 'length'), 3, 5)
+        finally:
+            await server.close()
+    stats = asyncio.run(scenario())
+    assert stats['requests'] == 15 and stats['errors'] == 0 and stats['p99'] >= stats['p50'] > 0
+
+############### fuel and scheduler
+
+FUEL_SOURCE = '''(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(define (f x) (define y (* x 2)) (set! y (+ y 1)) (cond ((< y 0) 'neg) ((= y 5) 'five) (else (list y (and 1 2) (or #f #f) (begin 1 2)))))
+(list (fib 12) (f 2) (f 3) (map (lambda (x) (* x x)) '(1 2 3)))'''
+
+
+@mark.parametrize('compiled', [False, True])
+@mark.parametrize('fuel', [1, 7, 1000])
+def test_fuel_resume(compiled: bool, fuel: int) -> None:
+    from analysis_cache import analyze_program
+    from machine import Continuation
+    env = standard_env()
+    suspended = 0
+    for exp in analyze_program(FUEL_SOURCE):
+        result = eval(Compiled(exp) if compiled else exp, env, fuel)
+        while isinstance(result, Continuation):
+            suspended += 1
+            result = result.resume(fuel)
+    assert str(result) == '(144 five (7 True False 2) (1 4 9))'
+    assert suspended > 0
+
+
+def test_fuel_infinite_loop() -> None:
+    from machine import Continuation
+    env = standard_env()
+    interpret('(define (loop n) (loop (+ n 1)))', 1, 100, 1, env)
+    result = eval(analyze(GenExp(TokenGen(StrGen('(loop 0)', 100), 1))), env, 500)
+    for _ in range(10):
+        assert isinstance(result, Continuation) and result.depth < 5
+        result = result.resume(500)
+    # 每个Continuation只能继续一次
+    result.resume(1)
+    with raises(RuntimeError):
+        result.resume(1)
+
+
+@mark.parametrize('source', ['(h 1)', '(undefined-x 1)', '(f 1 2)', "(k 5)", '(and 1 (car 1))', '(set! zz 1)',
+                            '(let loop ((i 0)) (if (= i 3) (h i) (loop (+ i 1))))'])
+def test_fuel_error_stack(source: str) -> None:
+    from analysis_cache import analyze_program
+    from machine import Continuation
+    setup = '''(define (g x) (return (car x)))
+    (define (h x) (+ 1 (g x)))
+    (define (f x) x)
+    (define (k n) (if (= n 0) (car 1) (+ 1 (k (- n 1)))))'''
+    outputs = []
+    for fuel in (None, 3):
+        env = standard_env()
+        for exp in analyze_program(setup):
+            eval(exp, env)
+        with raises(LispError) as info:
+            result = eval(analyze_program(source, 2)[0], env, fuel)
+            while isinstance(result, Continuation):
+                result = result.resume(fuel)
+        outputs.append(info.value.render_text())
+    # 调用栈信息与不限fuel的eval相同
+    assert outputs[0] == outputs[1]
+
+
+def test_scheduler_round_robin() -> None:
+    from scheduler import Scheduler
+    scheduler = Scheduler(200)
+    endless = scheduler.spawn('(define (loop) (loop)) (loop)')
+    long = scheduler.spawn("(define (count n) (if (= n 0) 'long (count (- n 1)))) (count 3000)")
+    short = scheduler.spawn("(define (count n) (if (= n 0) 'short (count (- n 1)))) (count 300)")
+    broken = scheduler.spawn('(car 1)')
+    scheduler.run(max_slices=1000)
+    assert scheduler.finished == [broken, short, long] and not endless.done
+    assert long.results[-1] == 'long' and short.results[-1] == 'short'
+    assert isinstance(broken.error, LispTypeError)
+
+
+def test_scheduler_loop() -> None:
+    from scheduler import Scheduler
+    scheduler = Scheduler(50)
+    endless = scheduler.spawn('(let loop ((i 0)) (loop (+ i 1)))')
+    endless_do = scheduler.spawn('(do ((i 0 (+ i 1))) (#f 1))')
+    # named let与do的每次循环都计入步数,循环内的define与多句循环体按步求值后结果不变
+    source = '''(let loop ((i 0) (acc 0)) (define x (* i 2)) (if (= i 100) (list acc x) (loop (+ i 1) (+ acc x))))
+    (do ((i 0 (+ i 1)) (v (list) (cons i v))) ((= i 5) v))'''
+    finite = scheduler.spawn(source)
+    scheduler.run(max_slices=1000)
+    assert scheduler.finished == [finite] and not endless.done and not endless_do.done
+    assert list(map(str, finite.results)) == ['(9900 200)', '(4 3 2 1 0)']
+
+############### constant folding
+
+@mark.parametrize('source, folded', [
+    ('(* 60 60 24)', 86400),
+    ("(if (< 1 2) 'yes 'no)", Quote(Symbol('yes'))),
+    ('(if #f 1 2)', 2),
+    ('(cond ((> 1 2) 1) ((= 1 1) 2) (else 3))', 2),
+    ('(begin 1 (+ 1 2) 3)', 3),
+])
+def test_constant_folding(source: str, folded) -> None:
+    exp = analyze(GenExp(TokenGen(StrGen(source, 100), 1)))
+    result = exp.result if isinstance(exp, Folded) else exp
+    assert str(result) == str(folded)
+
+
+@mark.parametrize('source', ['(/ 1 0)', '(lambda (+) (+ 1 2))', '(list 1 2)', "(+ 1 'a)", '(cond (x 1) ((< 1 2) 2))'])
+def test_constant_folding_skipped(source: str) -> None:
+    exp = analyze(GenExp(TokenGen(StrGen(source, 100), 1)))
+    assert not isinstance(exp, Folded)
+
+
+@mark.parametrize('compiled', [False, True])
+def test_constant_folding_redefined(compiled: bool) -> None:
+    env = standard_env()
+    source = '''(define (day) (* 60 60 24))
+    (define (sign) (if (< 0 1) 'pos 'neg))
+    (define (local +) (+ 1 2))
+    (list (day) (sign) (local -))'''
+    assert interpret(source, 1, 100, 4, env, compiled=compiled)[0] == '(86400 pos -1)'
+    # 全局重新定义内置过程后,已经折叠的表达式按原表达式求值
+    source = '''(define * +)
+    (define (< a b) #f)
+    (list (day) (sign))'''
+    assert interpret(source, 1, 100, 3, env, compiled=compiled)[0] == '(144 neg)'
+
+
+############### inline cache
+
+@mark.parametrize('compiled', [False, True])
+def test_global_inline_cache(compiled: bool) -> None:
+    env = standard_env()
+    source = '''(define x 1)
+    (define (get-x) x)
+    (define (f n) (abs n))
+    (list (get-x) (f -2))'''
+    assert interpret(source, 1, 100, 4, env, compiled=compiled)[0] == '(1 2)'
+    # define、set!与Environment.change都使缓存失效
+    source = '''(set! x 2)
+    (define y (get-x))
+    (define (abs n) n)
+    (list y (f -2))'''
+    assert interpret(source, 1, 100, 4, env, compiled=compiled)[0] == '(2 -2)'
+    env.change('x', 3)
+    env['abs'] = standard_env()['abs']
+    assert interpret('(list (get-x) (f -2))', 1, 100, 1, env, compiled=compiled)[0] == '(3 2)'
+    # 同一段代码在另一个环境中求值时不使用这个环境的缓存
+    exp = analyze(GenExp(TokenGen(StrGen('x', 100), 1)), compiled)
+    other = standard_env()
+    other['x'] = 'other'
+    assert eval(exp, env) == 3 and eval(exp, other) == 'other' and eval(exp, env) == 3
+    del env['x']
+    with raises(LispNameError):
+        eval(analyze(GenExp(TokenGen(StrGen('(get-x)', 100), 1)), compiled), env)
+
+
+def test_global_version() -> None:
+    env = standard_env()
+    env['x'] = 1
+    version = analyze_eval.GLOBALS_VERSION
+    # 值不变的赋值不使缓存失效
+    value = env['car']
+    env['car'] = value
+    env.change('car', value)
+    assert analyze_eval.GLOBALS_VERSION == version
+    env.change('x', 2)
+    assert analyze_eval.GLOBALS_VERSION > version
+
+
+def test_global_version_threads() -> None:
+    import sys, threading
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    env = standard_env()
+    version = analyze_eval.GLOBALS_VERSION
+    def define(name: str) -> None:
+        for i in range(2000):
+            env[name] = i
+    threads = [threading.Thread(target=define, args=(f'x{n}',)) for n in range(4)]
+    try:
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    # 多个线程同时修改绑定时版本号的增加不会丢失
+    assert analyze_eval.GLOBALS_VERSION == version + 8000
+
+
+############### heap stack
+@mark.parametrize('source, expected', [
+    ('(define (fact n) (if (<= n 1) 1 (* n (fact (- n 1))))) (= (fact 5000) (* 5000 (fact 4999)))', 'True'),
+    ('(define (sum n) (if (= n 0) 0 (+ n (sum (- n 1))))) (sum 30000)', '450015000'),
+    ('(define (sum n) (return (if (= n 0) 0 (+ n (sum (- n 1)))))) (sum 20000)', '200010000'),
+    ('''(define (build n) (if (= n 0) (list) (list (build (- n 1)) (list))))
+    (define (depth t) (if (empty? t) 0 (+ 1 (max (depth (car t)) (depth (car (cdr t)))))))
+    (depth (build 10000))''', '10000'),
+    ('(define (count n) (if (= n 0) 0 (count (- n 1)))) (count 30000)', '0'),
+])
+@mark.parametrize('compiled', [False, True])
+def test_deep_recursion(source: str, expected: str, compiled: bool) -> None:
+    assert interpret(source, 1, 100, 3, standard_env(), compiled=compiled)[0] == expected
+
+
+@mark.parametrize('compiled', [False, True])
+def test_big_result(monkeypatch, compiled: bool) -> None:
+    shown = []
+    monkeypatch.setattr(InterpretError, 'display', lambda self: shown.append(self))
+    # 超过python整数转字符串的位数限制时报错而不是使shell崩溃
+    source = '(define (fact n) (if (<= n 1) 1 (* n (fact (- n 1))))) (fact 5000)'
+    assert interpret(source, 1, 100, 2, standard_env(), compiled=compiled)[0] is None
+    assert isinstance(shown[0], LispProcError) and 'digits' in shown[0].render_text()
+
+
+@mark.parametrize('compiled', [False, True])
+def test_deep_recursion_error_stack(monkeypatch, compiled: bool) -> None:
+    import sys, inspect
+    setup = '''(define (g x) (return (car x)))
+    (define (k n) (if (= n 0) (g 1) (+ 1 (k (- n 1)))))'''
+    outputs = []
+    # 分别在递归途中与一开始就改在显式栈上继续求值
+    limit = sys.getrecursionlimit()
+    for margin in (analyze_eval.HEAP_STACK_MARGIN, limit - len(inspect.stack()) - 30, limit):
+        monkeypatch.setattr(analyze_eval, 'HEAP_STACK_MARGIN', margin)
+        monkeypatch.setattr(analyze_eval, 'STACK_CHECK_MASK', 0)
+        env = standard_env()
+        interpret(setup, 1, 100, 2, env, compiled=compiled)
+        with raises(LispError) as info:
+            eval(analyze(GenExp(TokenGen(StrGen('(k 40)', 100), 2)), compiled), env)
+        outputs.append(info.value.render_text())
+    # 在显式栈上继续求值时调用栈信息不变
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+############### shell completion
+def test_keyword_index() -> None:
+    import pytest
+    pytest.importorskip('prompt_toolkit')
+    from lisp_shell import KeywordIndex
+    index = KeywordIndex(['car', 'cdr', 'cond'])
+    index.update({'car', 'count', 'cadr'})
+    index.update(f'name{i}' for i in range(20))
+    assert index.match('c') == ['cadr', 'car', 'cdr', 'cond', 'count']
+    assert index.match('co', None) == ['cond', 'count'] and index.match('x') == []
+    assert index.match('name', 3) == ['name0', 'name1', 'name10']
+    # 用过的关键字按使用次数、最近使用排在前面,未知的词不记录
+    index.record('(count (cdr x)) (cdr (cond y))')
+    assert index.match('c') == ['cdr', 'cond', 'count', 'cadr', 'car']
+    assert index.match('c', 2) == ['cdr', 'cond'] and index.match('ca') == ['cadr', 'car']
+    assert 'x' not in index.uses
+
+
+def test_keyword_completer() -> None:
+    import pytest
+    pytest.importorskip('prompt_toolkit')
+    from prompt_toolkit.document import Document
+    from lisp_shell import DynamicKeywordCompleter
+    completer = DynamicKeywordCompleter({'lambda', 'list', 'list?'})
+    completer.update_keywords({'lisp', 'list'})
+    completer.record_use('(list lisp)')
+    completions = list(completer.get_completions(Document('(li'), None))
+    assert [c.text for c in completions] == ['lisp', 'list', 'list?']
+    assert completions[0].start_position == -2
+    assert list(completer.get_completions(Document('( '), None)) == []
@@ -0,0 +1,108 @@
+"""
+无交互地运行.scm脚本:python -m lisp_run [选项] 脚本...
+
+不导入prompt_toolkit,报错以纯文本输出到stderr
+退出码:0为正常结束,1为脚本出错,2为参数或文件错误
+"""
+import gc
+import sys
+import time
+import argparse
+from analyze_eval import standard_env, analyze, eval, Environment, InterpretError, EndOfSource, Compiled
+from interpreter import StrGen, TokenGen, GenExp
+from lisp_shell_config import COMPILED
+
+# 脚本按块读入的字符数,比交互时的MAX_IN大得多
+CHUNK_SIZE = 1 << 16
+
+
+def run_source(source: str, env: Environment, time_: int = 1, compiled: bool = COMPILED, echo: bool = True) -> int:
+    """依次求值source中的全部表达式,echo为真时打印不为None的结果,返回求值的表达式个数"""
+    tokengen = TokenGen(StrGen(source, CHUNK_SIZE), time_)
+    count = 0
+    while True:
+        try:
+            exp = GenExp(tokengen)
+        except EndOfSource:
+            return count
+        result = eval(analyze(exp, compiled), env)
+        count += 1
+        if echo and result is not None:
+            print(result)
+
+
+def run_file(path: str, source: str, env: Environment, time_: int = 1, compiled: bool = COMPILED,
+             echo: bool = True, cache: bool = True, freeze: bool = False) -> int:
+    """
+    优先使用磁盘上已解析的结果(见analysis_cache)
+    源码中有语法错误时不缓存,退回到边解析边求值,使出错前的表达式仍被执行
+    freeze为真时在程序加载后把现有对象移入永久代(gc.freeze),运行期间的垃圾回收不再反复遍历加载的程序;
+    这影响整个进程,只在作为短时运行的命令时使用
+    """
+    if not cache or path == '-':
+        return run_source(source, env, time_, compiled, echo)
+    import analysis_cache
+    try:
+        program = analysis_cache.load_program(path, source, time_)
+    except InterpretError:
+        return run_source(source, env, time_, compiled, echo)
+    if freeze:
+        gc.freeze()
+    for exp in program:
+        result = eval(Compiled(exp) if compiled else exp, env)
+        if echo and result is not None:
+            print(result)
+    return len(program)
+
+
+def read_script(path: str) -> str:
+    if path == '-':
+        return sys.stdin.read()
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def main(argv: list[str]|None = None, freeze: bool = False) -> int:
+    """freeze见run_file,只在作为命令运行时为真"""
+    parser = argparse.ArgumentParser(prog='python -m lisp_run', description='Run lisp scripts without the interactive shell')
+    parser.add_argument('scripts', nargs='+', help="script files ('-' for stdin), evaluated in one environment")
+    parser.add_argument('-c', '--compiled', action='store_true', default=COMPILED, help='compile expressions to closures')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print top-level results')
+    parser.add_argument('-t', '--time', action='store_true', help='print a timing summary to stderr')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the analysis cache')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    env = standard_env()
+    status = 0
+    total = 0
+    # 脚本的序号作为位置信息中的In[n]
+    for number, path in enumerate(args.scripts, 1):
+        try:
+            source = read_script(path)
+        except OSError as e:
+            print(f'lisp_run: {path}: {e.strerror}', file=sys.stderr)
+            status = 2
+            break
+        file_start = time.perf_counter()
+        try:
+            count = run_file(path, source, env, number, args.compiled, not args.quiet, not args.no_cache, freeze)
+        except InterpretError as e:
+            print(f'In[{number}] = {path}', file=sys.stderr)
+            print(e.render_text(), file=sys.stderr)
+            status = 1
+            break
+        except RecursionError:
+            print(f'{path}: maximum recursion depth exceeded', file=sys.stderr)
+            status = 1
+            break
+        total += count
+        if args.time:
+            print(f'{path}: {count} expressions in {time.perf_counter() - file_start:.4f}s', file=sys.stderr)
+    if args.time:
+        print(f'total: {total} expressions in {time.perf_counter() - start:.4f}s', file=sys.stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(freeze=True))
@@ -0,0 +1,242 @@
+"""
+asyncio求值服务:python -m lisp_server [--port 端口 | --unix 路径] [选项]
+
+每个连接是一个会话,拥有由standard_env()建立的独立环境,连接关闭后环境随之释放
+请求为源码文本,可包含多个表达式,按framing分帧:
+    line   每行一个请求(源码中不能有换行),响应为一行json
+    length 4字节大端长度 + utf-8内容,请求与响应相同
+响应:{"ok": true, "results": [...], "time": 秒}
+      出错时ok为false,results为出错前各表达式的结果,error为{"type", "message", "traceback"}
+结果为表达式结果的字符串形式,结果为None时为null
+求值在线程池中进行,单个耗时的求值不会阻塞事件循环与其他会话
+"""
+from __future__ import annotations
+import sys
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from analyze_eval import standard_env, analyze, eval, Environment, InterpretError, EndOfSource
+from interpreter import StrGen, TokenGen, GenExp
+from lisp_shell_config import COMPILED
+
+FRAMINGS = ('line', 'length')
+# 单个请求的最大字节数
+MAX_REQUEST = 1 << 24
+CHUNK_SIZE = 1 << 16
+HEADER_SIZE = 4
+
+
+class FrameError(Exception):
+    """请求不符合分帧格式"""
+
+
+def encode_frame(data: bytes, framing: str) -> bytes:
+    if framing == 'line':
+        return data + b'\n'
+    return len(data).to_bytes(HEADER_SIZE, 'big') + data
+
+
+async def read_frame(reader: asyncio.StreamReader, framing: str) -> bytes|None:
+    """读取一帧,连接正常关闭时返回None"""
+    if framing == 'line':
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise FrameError(f'request longer than {MAX_REQUEST} bytes') from None
+        if not line:
+            return None
+        if not line.endswith(b'\n'):
+            raise FrameError('incomplete request')
+        return line.rstrip(b'\r\n')
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise FrameError('incomplete header') from None
+    size = int.from_bytes(header, 'big')
+    if size > MAX_REQUEST:
+        raise FrameError(f'request longer than {MAX_REQUEST} bytes')
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise FrameError('incomplete request') from None
+
+
+def error_data(e: BaseException) -> dict[str, str]:
+    if isinstance(e, InterpretError):
+        return {'type': e.__class__.__name__, 'message': str(getattr(e, 'message', '')), 'traceback': e.render_text()}
+    if isinstance(e, RecursionError):
+        return {'type': 'RecursionError', 'message': 'maximum recursion depth exceeded', 'traceback': ''}
+    return {'type': e.__class__.__name__, 'message': str(e), 'traceback': ''}
+
+
+class Session:
+    """一个连接的求值状态:独立的环境与输入序号(用作位置信息中的In[n])"""
+    def __init__(self, compiled: bool = COMPILED):
+        self.env: Environment = standard_env()
+        self.compiled = compiled
+        self.count = 0
+
+    def evaluate(self, source: str) -> dict[str, Any]:
+        """依次求值source中的全部表达式,返回结构化的响应"""
+        self.count += 1
+        start = time.perf_counter()
+        tokengen = TokenGen(StrGen(source, CHUNK_SIZE), self.count)
+        results: list[str|None] = []
+        try:
+            while True:
+                try:
+                    exp = GenExp(tokengen)
+                except EndOfSource:
+                    break
+                result = eval(analyze(exp, self.compiled), self.env)
+                results.append(None if result is None else str(result))
+        except Exception as e:
+            # 除lisp的报错外,内置过程或结果转为字符串时的其他异常同样作为错误响应返回,不中断会话
+            return {'ok': False, 'results': results, 'error': error_data(e), 'time': time.perf_counter() - start}
+        return {'ok': True, 'results': results, 'time': time.perf_counter() - start}
+
+
+class LispServer:
+    """
+    server = LispServer(); await server.start_tcp(host, port) 或 await server.start_unix(path)
+    同一会话的请求依次求值,不同会话的求值在executor的线程中并发进行
+    """
+    def __init__(self, framing: str = 'line', compiled: bool = COMPILED, workers: int|None = None):
+        if framing not in FRAMINGS:
+            raise ValueError(f'framing must be one of {FRAMINGS}')
+        self.framing = framing
+        self.compiled = compiled
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='lisp-eval')
+        self.server: asyncio.AbstractServer|None = None
+        self.sessions = 0
+
+    async def start_tcp(self, host: str = '127.0.0.1', port: int = 0) -> asyncio.AbstractServer:
+        self.server = await asyncio.start_server(self.handle, host, port, limit=MAX_REQUEST)
+        return self.server
+
+    async def start_unix(self, path: str) -> asyncio.AbstractServer:
+        self.server = await asyncio.start_unix_server(self.handle, path, limit=MAX_REQUEST)
+        return self.server
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(self.compiled)
+        self.sessions += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    frame = await read_frame(reader, self.framing)
+                except FrameError as e:
+                    await self.send(writer, {'ok': False, 'results': [], 'error': error_data(e)})
+                    break
+                if frame is None:
+                    break
+                try:
+                    source = frame.decode('utf-8')
+                except UnicodeDecodeError as e:
+                    response = {'ok': False, 'results': [], 'error': error_data(e)}
+                else:
+                    response = await loop.run_in_executor(self.executor, session.evaluate, source)
+                await self.send(writer, response)
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def send(self, writer: asyncio.StreamWriter, response: dict[str, Any]) -> None:
+        writer.write(encode_frame(json.dumps(response, ensure_ascii=False).encode('utf-8'), self.framing))
+        await writer.drain()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # 正在进行的求值无法中断,不等待它们结束
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Client:
+    """简单的客户端:async with Client.connect_tcp(...) as client: await client.request(source)"""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, framing: str = 'line'):
+        self.reader = reader
+        self.writer = writer
+        self.framing = framing
+
+    @classmethod
+    async def connect_tcp(cls, host: str, port: int, framing: str = 'line') -> Client:
+        reader, writer = await asyncio.open_connection(host, port, limit=MAX_REQUEST)
+        return cls(reader, writer, framing)
+
+    @classmethod
+    async def connect_unix(cls, path: str, framing: str = 'line') -> Client:
+        reader, writer = await asyncio.open_unix_connection(path, limit=MAX_REQUEST)
+        return cls(reader, writer, framing)
+
+    async def request(self, source: str) -> dict[str, Any]:
+        if self.framing == 'line' and '\n' in source:
+            raise ValueError('line framing does not allow newlines in a request')
+        self.writer.write(encode_frame(source.encode('utf-8'), self.framing))
+        await self.writer.drain()
+        frame = await read_frame(self.reader, self.framing)
+        if frame is None:
+            raise ConnectionError('server closed the connection')
+        return json.loads(frame)
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def __aenter__(self) -> Client:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+async def serve(args: argparse.Namespace) -> None:
+    server = LispServer(args.framing, args.compiled, args.workers)
+    if args.unix:
+        await server.start_unix(args.unix)
+        where = args.unix
+    else:
+        listening = await server.start_tcp(args.host, args.port)
+        host, port = listening.sockets[0].getsockname()[:2]
+        where = f'{host}:{port}'
+    print(f'lisp_server: listening on {where} ({args.framing} framing)', file=sys.stderr, flush=True)
+    try:
+        await server.server.serve_forever() # type:ignore
+    finally:
+        await server.close()
+
+
+def main(argv: list[str]|None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m lisp_server', description='Serve lisp evaluation over a socket')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=7777, help='TCP port, 0 for any free port (default: 7777)')
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--framing', choices=FRAMINGS, default='line', help='request framing')
+    parser.add_argument('--workers', type=int, help='evaluation threads')
+    parser.add_argument('-c', '--compiled', action='store_true', default=COMPILED, help='compile expressions to closures')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
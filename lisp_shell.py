@@ -7,23 +7,89 @@ from prompt_toolkit.document import Document
 from interpreter import interpret
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.shortcuts import print_formatted_text
-from lisp_shell_config import scheme_keywords, SPACENUM, PARENTHESES_ADDED, SHELL_STYLE
+from lisp_shell_config import scheme_keywords, SPACENUM, PARENTHESES_ADDED, SHELL_STYLE, COMPLETION_LIMIT
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from itertools import islice
+import re
+
+WORD = re.compile(r'[^\s()\[\]\'"`,;]+')
+
+
+class KeywordIndex:
+    """
+    补全用的前缀索引:关键字按字典序保存在列表中,前缀对应的是其中连续的一段,用bisect在O(log n)内找到
+    用过的关键字另外按使用次数与最近使用排序,排在其余(按字典序)的候选之前
+    """
+    def __init__(self, keywords=()):
+        self.words: list[str] = sorted(set(keywords))
+        self.known: set[str] = set(self.words)
+        # 用过的关键字同样按字典序保存,只在其中排序
+        self.used: list[str] = []
+        self.uses: dict[str, int] = {}
+        self.last_used: dict[str, int] = {}
+        self.clock = 0
+
+    def update(self, keywords) -> None:
+        """加入新的关键字,已有的不变"""
+        new = set(keywords) - self.known
+        if not new:
+            return
+        self.known |= new
+        if len(new) > 8:
+            # 两段有序的序列合并,timsort为O(n)
+            self.words = sorted(self.words + list(new))
+        else:
+            for word in new:
+                insort(self.words, word)
+
+    def record(self, text: str) -> None:
+        """记录text中用到的关键字"""
+        for word in WORD.findall(text):
+            if word not in self.known:
+                continue
+            if word not in self.uses:
+                insort(self.used, word)
+                self.uses[word] = 0
+            self.clock += 1
+            self.uses[word] += 1
+            self.last_used[word] = self.clock
+
+    @staticmethod
+    def prefix_range(words: list[str], prefix: str) -> tuple[int, int]:
+        return bisect_left(words, prefix), bisect_left(words, prefix + '\U0010ffff')
+
+    def match(self, prefix: str, limit: int|None = COMPLETION_LIMIT) -> list[str]:
+        """以prefix开头的关键字,用过的按使用次数、最近使用排在前面,最多limit个"""
+        lo, hi = self.prefix_range(self.used, prefix)
+        used = self.used[lo:hi]
+        key = lambda word: (-self.uses[word], -self.last_used[word])
+        ranked = sorted(used, key=key) if limit is None else nsmallest(limit, used, key=key)
+        if limit is not None and len(ranked) >= limit:
+            return ranked
+        lo, hi = self.prefix_range(self.words, prefix)
+        rest = (word for word in islice(self.words, lo, hi) if word not in self.uses)
+        if limit is None:
+            return ranked + list(rest)
+        return ranked + list(islice(rest, limit - len(ranked)))
+
 
 class DynamicKeywordCompleter(Completer):
     def __init__(self, keywords):
-        self.keywords = keywords
-        self.additional_keywords = set()
+        self.index = KeywordIndex(keywords)
 
     def update_keywords(self, new_keywords):
-        self.additional_keywords.update(new_keywords)
+        self.index.update(new_keywords)
+
+    def record_use(self, text):
+        self.index.record(text)
 
     def get_completions(self, document, complete_event):
         word_before_cursor = document.get_word_before_cursor()
         if not word_before_cursor:
             return  # 如果没有输入内容，不生成补全建议
-        for keyword in sorted(self.keywords | self.additional_keywords):
-            if keyword.startswith(word_before_cursor):
-                yield Completion(text=keyword, start_position=-len(word_before_cursor),display=keyword)
+        for keyword in self.index.match(word_before_cursor):
+            yield Completion(text=keyword, start_position=-len(word_before_cursor),display=keyword)
 
 # 创建关键字补全器
 keyword_completer = DynamicKeywordCompleter(set(scheme_keywords))
@@ -162,8 +228,9 @@ def interactive_shell():
                     if isinstance(result, str):
                         print_formatted_text(HTML(f'<output>Out[{input_counter}]:</output>'), style=style,end='')
                         print(f'{result}\n')
-                    #根据环境 更新关键字补全器
+                    #根据环境 更新关键字补全器,并记录用到的关键字用于排序
                     keyword_completer.update_keywords(env_variable)
+                    keyword_completer.record_use(text)
                     input_counter += 1
                 continue
 
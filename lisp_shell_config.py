@@ -1,11 +1,39 @@
-from prompt_toolkit.styles import Style
 scheme_keywords = [
     'if', 'begin', 'cond', 'lambda', 'define', 'set!', 'quote',
-    'car', 'cdr', 'list', 'and', 'or', 'return'
+    'car', 'cdr', 'list', 'and', 'or', 'return', 'profile', 'define-memo',
+    'delay', 'cons-stream', 'let', 'do'
 ]
 SPACENUM = 2
 PARENTHESES_ADDED = False
-SHELL_STYLE=Style.from_dict({'input': 'ansigreen', 'output': 'ansired'})
 MAX_IN=100
 EVAL_TIME=1
-ERROR_STYLE=Style.from_dict({'input': 'ansigreen','keyword': 'ansiyellow','error': 'ansired',})
\ No newline at end of file
+COMPILED=False # 为True时表达式先编译为闭包再求值
+EXACT_FRACTION=False # 为True时分数字面量保留为精确的Fraction,否则转换为float
+CONSTANT_FOLDING=True # 解析后折叠常量表达式并去掉条件为常量的分支
+ATOM_CACHE_SIZE=65536 # 字面量缓存的最大条目数
+CACHE_DIR=None # 解析结果缓存的目录,None为脚本所在目录下的__lispcache__
+MEMO_SIZE=4096 # define-memo/memoize缓存的默认最大条目数,None为不限
+ERROR_EXP_LENGTH=200 # 报错时每层调用栈显示的表达式最大字符数
+ERROR_STACK_DEPTH=40 # 报错时最多显示的调用栈层数,超过时省略中间部分
+PMAP_WORKERS=None # pmap的进程数,None为CPU核数
+PMAP_CHUNK_SIZE=None # pmap每块的元素个数,None为按进程数自动划分
+PMAP_SERIAL_BELOW=256 # 元素少于该数时pmap在当前进程中依次求值
+SCHEDULER_QUANTUM=1000 # 调度器每次分给一个任务的步数(fuel)
+HEAP_STACK_MARGIN=400 # python栈距离递归深度限制不足该帧数时改用machine.py中的显式栈继续,递归深度只受内存限制
+FILE_BUFFER_SIZE=1<<20 # file-lines读取文件时的缓冲区字节数
+CSV_BLOCK_SIZE=1<<22 # read-csv每次从mmap中取出并转换的字节数
+COMPLETION_LIMIT=100 # shell每次补全最多给出的候选数,None为不限
+
+# prompt_toolkit的样式在第一次使用时才创建,不需要终端的脚本运行不必导入prompt_toolkit
+STYLES = {
+    'SHELL_STYLE': {'input': 'ansigreen', 'output': 'ansired'},
+    'ERROR_STYLE': {'input': 'ansigreen','keyword': 'ansiyellow','error': 'ansired',},
+}
+
+def __getattr__(name: str):
+    if name in STYLES:
+        from prompt_toolkit.styles import Style
+        style = Style.from_dict(STYLES[name])
+        globals()[name] = style
+        return style
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
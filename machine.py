@@ -0,0 +1,373 @@
+"""
+显式栈求值器:可以按步数(fuel)挂起与继续的求值
+
+与analyze_eval.eval求值同样的(树遍历模式)表达式,但待完成的工作(if的分支、参数的求值、过程体的剩余语句等)
+保存在一个列表中的帧里,而不是python的调用栈上,因此求值可以在任意一步停下:
+fuel用完时run返回Continuation,其resume(fuel)从挂起处继续。
+
+与eval的对应关系:
+- 过程调用在求值最后一句之前就弹出自己的帧,尾调用不增长栈(对应eval中放回exp_queue的做法)
+- 出错时按栈中尚未完成的过程调用由内到外向报错加入调用栈信息,与eval在各层Compound.evaluate中加入的相同
+- 编译模式的表达式(Compiled)按其解析后的表达式求值;named let与do的循环按帧逐步求值;profile等其余句式按Compound.evaluate求值,
+  map等内置过程中对过程的调用仍由eval一次求值完成,期间不能挂起
+
+eval与编译模式的过程调用发现python栈距离递归深度限制不足HEAP_STACK_MARGIN帧时也改由run(或call)继续,
+此时待求值的参数与过程体保存在帧中,非尾递归的深度只受内存限制
+"""
+from __future__ import annotations
+from typing import Any
+import analyze_eval
+from analyze_eval import (
+    Compound, Compound_, Symbol, If, Begin, Cond, Lambda, Define, Set, Quote, Return, LocalRef, GlobalRef,
+    Compiled, Folded, Loop, Recur, Procedure, Operator, And_OP, Or_OP, Environment, Frame, Exp,
+    LispError, LispTypeError, LispNameError, active_profiler,
+)
+
+# 帧的种类,帧为[种类, 表达式, 环境, ...]
+K_IF, K_BEGIN, K_COND, K_DEFINE, K_SET, K_OPERATOR, K_APPLY, K_AND, K_OR, K_BODY, K_LOOP, K_LOOP_BODY, K_RECUR, K_PROFILED = range(14)
+# 出错时需要加入调用栈信息的帧(未完成的过程调用),求值调用的第一个元素时还不算在调用中
+CALL_FRAMES = (K_APPLY, K_AND, K_OR, K_BODY)
+
+
+class Continuation:
+    """
+    fuel用完时被挂起的求值,只能继续一次
+    resume(fuel)继续求值,返回结果或新的Continuation
+    """
+    __slots__ = ('exp', 'env', 'stack')
+
+    def __init__(self, exp: Exp, env: Environment, stack: list[list]):
+        self.exp = exp
+        self.env = env
+        self.stack: list[list]|None = stack
+
+    def resume(self, fuel: int|None = None) -> Any:
+        if self.stack is None:
+            raise RuntimeError('continuation has already been resumed')
+        stack, self.stack = self.stack, None
+        return run(self.exp, self.env, fuel, stack)
+
+    @property
+    def depth(self) -> int:
+        """挂起时栈中的帧数"""
+        return len(self.stack) if self.stack is not None else 0
+
+    def __str__(self) -> str:
+        return '<continuation>'
+
+
+def run(exp: Exp, env: Environment, fuel: int|None = None, stack: list[list]|None = None) -> Any:
+    """
+    在env中求值exp,最多执行fuel步(None为不限),每求值一个子表达式为一步
+    求值结束时返回结果,fuel用完时返回Continuation
+    """
+    if stack is None:
+        stack = []
+    try:
+        return execute(exp, env, fuel, stack)
+    except LispError as e:
+        unwind(e, stack)
+        raise
+    except Exception as e:
+        # 与eval相同:其他异常在最内层的过程调用处转换为LispError
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i][0] in CALL_FRAMES:
+                error = LispError(str(e), stack[i][1])
+                del stack[i:]
+                unwind(error, stack)
+                raise error from None
+        raise
+
+
+def call(procedure: Procedure, args: list, node: Compound) -> Any:
+    """在显式栈上调用过程,参数已经求值,与execute中K_APPLY之后的做法相同"""
+    env = procedure.application_env(args)
+    body = procedure.body
+    tail = procedure.need_tail_optimization()
+    stack: list[list] = []
+    if analyze_eval.PROFILER is not None:
+        profile_enter(procedure, stack)
+    if not tail or len(body) > 1:
+        stack.append([K_BODY, node, env, procedure, 0, tail])
+    return run(body[0], env, None, stack)
+
+
+def profile_enter(callee: Procedure|Loop, stack: list[list]) -> None:
+    """
+    profile开启时记录过程(或named let循环)的开始:过程调用时栈顶为K_PROFILED即处于尾位置,替换其中正在统计的过程,
+    否则(以及循环总是)开始新的过程并压入K_PROFILED帧,其得到值时结束,与eval中原生循环的统计相同
+    """
+    profiler = active_profiler()
+    if profiler is None:
+        return
+    key = profiler.key(callee)
+    top = stack[-1] if stack else None
+    if (top is not None and top[0] == K_PROFILED and top[3] is profiler and top[4] == len(profiler.stack)
+            and type(callee) is not Loop):
+        profiler.tail_call(key)
+    else:
+        profiler.push(key)
+        stack.append([K_PROFILED, None, None, profiler, len(profiler.stack)])
+
+
+def enter_loop(loop: Loop, frame: Frame, stack: list[list], start: bool) -> Exp:
+    """开始(start)或者在Recur之后重新开始执行循环体,返回第一句;最后一句位于尾位置,不保留帧"""
+    if analyze_eval.PROFILER is not None:
+        if start:
+            profile_enter(loop, stack)
+        elif (profiler := active_profiler()) is not None:
+            profiler.iterate(profiler.key(loop))
+    if len(loop.body) > 1:
+        stack.append([K_LOOP_BODY, loop, frame, 1])
+    return loop.body[0]
+
+
+def unwind(error: LispError, stack: list[list]) -> None:
+    """由内到外加入未完成的过程调用"""
+    for frame in reversed(stack):
+        if frame[0] in CALL_FRAMES:
+            error(frame[1])
+    stack.clear()
+
+
+def apply(first: Any, args: list, node: Compound) -> Any:
+    """调用内置过程,与Compound.evaluate中的相同"""
+    try:
+        if isinstance(first, Operator) and not first.lazy:
+            if len(args) == 1:
+                return first.call1(args[0])
+            if len(args) == 2:
+                return first.call2(args[0], args[1])
+        return first(iter(args))
+    except Exception as e:
+        if isinstance(e, LispError):
+            raise e(node)
+        raise LispError(str(e), node) from None
+
+
+def execute(exp: Exp, env: Any, fuel: int|None, stack: list[list]) -> Any:
+    while True:
+        ############################## 求值exp:得到value,或者压入帧后转而求值子表达式
+        if fuel is not None:
+            if fuel <= 0:
+                return Continuation(exp, env, stack)
+            fuel -= 1
+        t = type(exp)
+        if t is GlobalRef or t is LocalRef:
+            value = exp.lookup(env) # type:ignore
+        elif t is Compound_ or t is Compound:
+            if not exp.data: # type:ignore
+                value = None
+            else:
+                stack.append([K_OPERATOR, exp, env, []])
+                exp = exp.data[0] # type:ignore
+                continue
+        elif t is If:
+            stack.append([K_IF, exp, env])
+            exp = exp.condition # type:ignore
+            continue
+        elif t is Begin:
+            if len(exp.expressions) > 1: # type:ignore
+                stack.append([K_BEGIN, exp, env, 1])
+            exp = exp.expressions[0] # type:ignore
+            continue
+        elif t is Cond:
+            if not exp.clauses: # type:ignore
+                value = None
+            else:
+                predicate, expression = exp.clauses[0] # type:ignore
+                if predicate is None:
+                    exp = expression
+                else:
+                    stack.append([K_COND, exp, env, 0])
+                    exp = predicate
+                continue
+        elif t is Lambda:
+            value = Procedure(exp.parameters, exp.body, env, exp.scope, source=exp) # type:ignore
+        elif t is Define:
+            stack.append([K_DEFINE, exp, env])
+            exp = exp.value # type:ignore
+            continue
+        elif t is Set:
+            stack.append([K_SET, exp, env])
+            exp = exp.value # type:ignore
+            continue
+        elif t is Quote:
+            value = exp.value # type:ignore
+        elif t is Return or t is Compiled:
+            exp = exp.value if t is Return else exp.exp # type:ignore
+            continue
+        elif t is Folded:
+            exp = exp.result if exp.valid(env) else exp.original # type:ignore
+            continue
+        elif t is Symbol:
+            try:
+                value = env[exp]
+            except KeyError:
+                raise LispNameError(f'undefined variable {exp}', exp)
+        elif t is Loop or t is Recur:
+            # named let与do:循环变量的初值(或新值)逐个求值,每次循环都计入步数
+            args = exp.inits if t is Loop else exp.args # type:ignore
+            if args:
+                stack.append([K_LOOP if t is Loop else K_RECUR, exp, env, []])
+                exp = args[0]
+                continue
+            if t is Loop:
+                env = exp.frame([], env) # type:ignore
+            exp = enter_loop(exp if t is Loop else exp.loop, env, stack, t is Loop) # type:ignore
+            continue
+        elif isinstance(exp, Compound):
+            # profile、define-memo等其余句式:evaluate返回结果,
+            # 或者把尾位置的表达式放入queue并返回求值它的环境
+            queue: list[Exp] = []
+            value = exp.evaluate(env, queue)
+            if queue:
+                if type(value) is Frame:
+                    env = value
+                exp = queue[0]
+                continue
+        else:
+            value = exp
+
+        ############################## 把value交给栈顶的帧,直到某个帧需要求值新的表达式
+        while True:
+            if not stack:
+                return value
+            frame = stack[-1]
+            kind = frame[0]
+            if kind == K_APPLY or kind == K_OPERATOR:
+                node = frame[1]
+                values = frame[3]
+                values.append(value)
+                if kind == K_OPERATOR:
+                    if not callable(value):
+                        stack.pop()
+                        raise LispTypeError('first element must be a procedure or operator', node)
+                    frame[0] = K_APPLY
+                    if type(value) is And_OP or type(value) is Or_OP:
+                        # and/or逐个求值参数,保持短路
+                        if len(node.data) == 1:
+                            stack.pop()
+                            value = type(value) is And_OP
+                            continue
+                        frame[0] = K_AND if type(value) is And_OP else K_OR
+                        frame[3] = 1
+                        exp, env = node.data[1], frame[2]
+                        break
+                if len(values) < len(node.data):
+                    exp, env = node.data[len(values)], frame[2]
+                    break
+                stack.pop()
+                first = values[0]
+                if not isinstance(first, Procedure):
+                    value = apply(first, values[1:], node)
+                    continue
+                args = values[1:]
+                if len(args) != len(first.parms):
+                    raise LispTypeError('error arguments number')(node)
+                env = first.application_env(args)
+                body = first.body
+                tail = first.need_tail_optimization()
+                if analyze_eval.PROFILER is not None:
+                    profile_enter(first, stack)
+                # 尾调用优化:最后一句不再保留调用的帧
+                if not tail or len(body) > 1:
+                    stack.append([K_BODY, node, env, first, 0, tail])
+                exp = body[0]
+                break
+            elif kind == K_BODY:
+                body = frame[3].body
+                i = frame[4] + 1
+                if i == len(body):
+                    stack.pop()
+                    continue
+                if frame[5] and i == len(body) - 1:
+                    stack.pop()
+                else:
+                    frame[4] = i
+                exp, env = body[i], frame[2]
+                break
+            elif kind == K_IF:
+                stack.pop()
+                node = frame[1]
+                try:
+                    exp = node.consequence if value else node.alternative
+                except LispError as e:
+                    raise e.locate(node.condition)
+                env = frame[2]
+                break
+            elif kind == K_AND or kind == K_OR:
+                node = frame[1]
+                if (not value) if kind == K_AND else value:
+                    stack.pop()
+                    value = kind == K_OR
+                    continue
+                i = frame[3] + 1
+                if i == len(node.data):
+                    stack.pop()
+                    value = kind == K_AND
+                    continue
+                frame[3] = i
+                exp, env = node.data[i], frame[2]
+                break
+            elif kind == K_LOOP or kind == K_RECUR:
+                node = frame[1]
+                values = frame[3]
+                values.append(value)
+                args = node.inits if kind == K_LOOP else node.args
+                if len(values) < len(args):
+                    exp, env = args[len(values)], frame[2]
+                    break
+                stack.pop()
+                if kind == K_LOOP:
+                    env = node.frame(values, frame[2])
+                else:
+                    env = frame[2]
+                    env.values[:len(values)] = values
+                    node = node.loop
+                exp = enter_loop(node, env, stack, kind == K_LOOP)
+                break
+            elif kind == K_BEGIN or kind == K_LOOP_BODY:
+                expressions = frame[1].expressions if kind == K_BEGIN else frame[1].body
+                i = frame[3]
+                if i == len(expressions) - 1:
+                    stack.pop()
+                else:
+                    frame[3] = i + 1
+                exp, env = expressions[i], frame[2]
+                break
+            elif kind == K_COND:
+                clauses = frame[1].clauses
+                i = frame[3]
+                try:
+                    value = bool(value)
+                except LispError as e:
+                    raise e.locate(clauses[i][0])
+                if value:
+                    stack.pop()
+                    exp, env = clauses[i][1], frame[2]
+                    break
+                i += 1
+                if i == len(clauses):
+                    stack.pop()
+                    value = None
+                    continue
+                predicate, expression = clauses[i]
+                if predicate is None:
+                    stack.pop()
+                    exp, env = expression, frame[2]
+                    break
+                frame[3] = i
+                exp, env = predicate, frame[2]
+                break
+            elif kind == K_PROFILED:
+                stack.pop()
+                profiler = frame[3]
+                # 挂起期间profiler可能已经结束这一层,此时不再重复结束
+                if profiler is analyze_eval.PROFILER and frame[4] == len(profiler.stack):
+                    profiler.pop()
+            else:
+                # K_DEFINE与K_SET
+                stack.pop()
+                frame[1].assign(frame[2], value)
+                value = None
@@ -0,0 +1,304 @@
+"""
+按过程统计的确定性profiler
+
+开启时临时替换Procedure的__call__/no_tail_call/enter、内置Operator的调用入口以及analyze_eval中的eval与trampoline,
+关闭时全部恢复,因此不使用profile时没有任何额外开销。替换是全局的,但只统计开启profiler的线程中的调用,
+其他线程(如lisp_server中的其他会话)经过替换的入口时直接调用原来的实现;同一时间只能有一个profiler。
+named let/do的原生循环与machine.py中的过程调用不经过这些入口,它们在analyze_eval.PROFILER不为None时自行记录
+
+统计模型:每个eval循环(编译模式下为trampoline)是一个"段",段内通过尾调用依次替换的过程共用同一个位置。
+尾调用发生时结束被替换的过程并开始新的过程(计入tail_calls),段结束时结束其中仍在运行的过程。
+inclusive为过程从开始到结束的时间(递归时只计最外层),exclusive为其中减去子过程的部分
+"""
+from __future__ import annotations
+import time
+import threading
+from typing import Any, Callable, NamedTuple
+
+import analyze_eval
+from analyze_eval import (
+    Procedure, Operator, Sequential_Mixin, Comparative_mixin, List_mixin, One_mixin,
+    And_OP, Or_OP, Map_OP, PMap_OP, TailCall, Loop, LispError, LispProcError, Environment, Exp,
+    EndOfSource, run_env, analyze,
+)
+
+# 段的起点标记
+SEGMENT = None
+
+
+class ProfileRow(NamedTuple):
+    name: str
+    location: str
+    calls: int
+    tail_calls: int
+    inclusive: float
+    exclusive: float
+
+
+SORT_KEYS = ('inclusive', 'exclusive', 'calls', 'tail_calls')
+
+
+def procedure_key(procedure: Procedure) -> tuple[str, str]:
+    """过程以定义时的名字与lambda所在位置区分"""
+    source = procedure.source
+    if source is None:
+        return ('lambda', '')
+    location = source.location
+    where = f'In[{location.time}] line {location.line}, col {location.col}' if location else ''
+    return (str(source.name) if source.name is not None else 'lambda', where)
+
+
+def operator_key(operator: Operator) -> tuple[str, str]:
+    return (str(operator), '<builtin>')
+
+
+def loop_key(loop: Loop) -> tuple[str, str]:
+    return (str(loop.name), '<loop>')
+
+
+class Profiler:
+    """
+    with Profiler() as profiler: ...  期间的过程调用都被统计
+    profiler.table()返回排好序的ProfileRow列表,profiler.report()返回格式化的表格
+    """
+    active: Profiler|None = None
+    lock = threading.Lock()
+
+    def __init__(self) -> None:
+        # key -> [calls, tail_calls, inclusive, exclusive]
+        self.stats: dict[tuple[str, str], list] = {}
+        # 运行中的过程:[key, 开始时间, 子过程时间],SEGMENT为段的起点
+        self.stack: list[list|None] = []
+        # 每个key正在运行的层数,用于递归时只计最外层的inclusive
+        self.running: dict[tuple[str, str], int] = {}
+        self.patched: list[tuple[object, str, Any]] = []
+        # 开启profiler的线程,只统计其中的调用
+        self.thread: int|None = None
+
+    #################################################### 计时
+
+    def push(self, key: tuple[str, str], tail: bool = False) -> None:
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = [0, 0, 0.0, 0.0]
+        stat[0] += 1
+        if tail:
+            stat[1] += 1
+        self.running[key] = self.running.get(key, 0) + 1
+        self.stack.append([key, time.perf_counter(), 0.0])
+
+    def pop(self) -> None:
+        """结束栈顶(不是段标记)的过程"""
+        key, start, child = self.stack.pop() # type:ignore
+        elapsed = time.perf_counter() - start
+        stat = self.stats[key]
+        stat[3] += elapsed - child
+        self.running[key] -= 1
+        if not self.running[key]:
+            stat[2] += elapsed
+        for entry in reversed(self.stack):
+            if entry is not SEGMENT:
+                entry[2] += elapsed
+                break
+
+    def close_to(self, depth: int) -> None:
+        """结束depth以上的所有过程与段"""
+        stack = self.stack
+        while len(stack) > depth:
+            if stack[-1] is SEGMENT:
+                stack.pop()
+            else:
+                self.pop()
+
+    def close_segment(self) -> None:
+        """结束最近的一个段"""
+        stack = self.stack
+        while stack:
+            if stack[-1] is SEGMENT:
+                stack.pop()
+                return
+            self.pop()
+
+    def iterate(self, key: tuple[str, str]) -> None:
+        """原生循环的一次循环:与尾调用相同地计数,但不切换正在运行的过程"""
+        stat = self.stats[key]
+        stat[0] += 1
+        stat[1] += 1
+
+    def key(self, callee: Procedure|Loop) -> tuple[str, str]:
+        return loop_key(callee) if isinstance(callee, Loop) else procedure_key(callee)
+
+    def tail_call(self, key: tuple[str, str]) -> None:
+        """段内的尾调用:结束当前的过程,开始新的过程"""
+        if self.stack and self.stack[-1] is not SEGMENT:
+            self.pop()
+            self.push(key, True)
+        else:
+            self.push(key)
+
+    #################################################### 替换入口
+
+    def patch(self, owner: object, name: str, wrapper: Any) -> None:
+        self.patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, wrapper)
+
+    def install(self) -> None:
+        profiler = self
+        thread = self.thread = threading.get_ident()
+        get_ident = threading.get_ident
+        original_eval = analyze_eval.eval
+        original_call = Procedure.__call__
+        original_no_tail_call = Procedure.no_tail_call
+        original_enter = Procedure.enter
+        original_trampoline = analyze_eval.trampoline
+
+        def eval(exp: Exp, env=run_env, fuel=None):
+            if get_ident() != thread:
+                return original_eval(exp, env, fuel)
+            depth = len(profiler.stack)
+            profiler.stack.append(SEGMENT)
+            try:
+                return original_eval(exp, env, fuel)
+            finally:
+                profiler.close_to(depth)
+
+        def trampoline(result: Any) -> Any:
+            # 与analyze_eval.trampoline相同,只是尾调用时切换正在运行的过程
+            # 出错时段不在此结束,而由外层按深度结束
+            if get_ident() != thread:
+                return original_trampoline(result)
+            while type(result) is TailCall:
+                procedure, args, exp = result
+                try:
+                    profiler.tail_call(procedure_key(procedure))
+                    env, last_code = original_enter(procedure, args)
+                except Exception as e:
+                    if isinstance(e, LispError):
+                        raise e(exp)
+                    else:
+                        raise LispProcError(str(e),exp) from None
+                result = last_code(env)
+            profiler.close_segment()
+            return result
+
+        def call(procedure: Procedure, args):
+            # 参数先求值,其时间不计入被调用的过程
+            args_list = list(args)
+            if get_ident() != thread:
+                return original_call(procedure, iter(args_list))
+            profiler.tail_call(procedure_key(procedure))
+            return original_call(procedure, iter(args_list))
+
+        def no_tail_call(procedure: Procedure, args):
+            args_list = list(args)
+            if get_ident() != thread:
+                return original_no_tail_call(procedure, iter(args_list))
+            depth = len(profiler.stack)
+            profiler.stack.append(SEGMENT)
+            profiler.push(procedure_key(procedure))
+            try:
+                return original_no_tail_call(procedure, iter(args_list))
+            finally:
+                profiler.close_to(depth)
+
+        def enter(procedure: Procedure, args: list):
+            # 非尾位置的调用:新开一个段,由随后的trampoline结束
+            if get_ident() != thread:
+                return original_enter(procedure, args)
+            profiler.stack.append(SEGMENT)
+            profiler.push(procedure_key(procedure))
+            return original_enter(procedure, args)
+
+        self.patch(analyze_eval, 'eval', eval)
+        self.patch(analyze_eval, 'trampoline', trampoline)
+        self.patch(Procedure, '__call__', call)
+        self.patch(Procedure, 'no_tail_call', no_tail_call)
+        self.patch(Procedure, 'enter', enter)
+        # Operator中的call1/call2只是转交给__call__,不需要重复统计
+        for cls in (Operator, Sequential_Mixin, Comparative_mixin, List_mixin, One_mixin, And_OP, Or_OP, Map_OP, PMap_OP):
+            for name in ('__call__', 'call1', 'call2'):
+                if name in cls.__dict__ and not (cls is Operator and name != '__call__'):
+                    self.patch(cls, name, self.wrap_operator(cls.__dict__[name]))
+        analyze_eval.PROFILER = self
+
+    def wrap_operator(self, method: Callable) -> Callable:
+        profiler = self
+        thread = self.thread
+        get_ident = threading.get_ident
+        def wrapper(operator: Operator, *args):
+            if get_ident() != thread:
+                return method(operator, *args)
+            depth = len(profiler.stack)
+            profiler.push(operator_key(operator))
+            try:
+                return method(operator, *args)
+            finally:
+                profiler.close_to(depth)
+        return wrapper
+
+    def uninstall(self) -> None:
+        analyze_eval.PROFILER = None
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched.clear()
+
+    def __enter__(self) -> Profiler:
+        with Profiler.lock:
+            if Profiler.active is not None:
+                raise RuntimeError('a profiler is already running')
+            Profiler.active = self
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close_to(0)
+        self.uninstall()
+        Profiler.active = None
+
+    #################################################### 结果
+
+    def table(self, sort: str = 'inclusive') -> list[ProfileRow]:
+        """按sort(inclusive/exclusive/calls/tail_calls)从大到小排序的统计表"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f'sort must be one of {SORT_KEYS}')
+        rows = [ProfileRow(name, location, *stat) for (name, location), stat in self.stats.items()]
+        rows.sort(key=lambda row: getattr(row, sort), reverse=True)
+        return rows
+
+    def report(self, sort: str = 'inclusive', limit: int|None = 20) -> str:
+        rows = self.table(sort)[:limit]
+        lines = [f"{'calls':>9}{'tail':>9}{'inclusive(s)':>14}{'exclusive(s)':>14}  procedure"]
+        for row in rows:
+            where = f'  ({row.location})' if row.location else ''
+            lines.append(f'{row.calls:>9}{row.tail_calls:>9}{row.inclusive:>14.6f}{row.exclusive:>14.6f}  {row.name}{where}')
+        return '\n'.join(lines)
+
+    @classmethod
+    def run_and_report(cls, func: Callable[[], Any]) -> Any:
+        """(profile <expression>)的实现:统计func的执行并打印结果,已在统计中(包括其他线程正在统计)时直接执行"""
+        try:
+            profiler = cls().__enter__()
+        except RuntimeError:
+            return func()
+        try:
+            result = func()
+        finally:
+            profiler.__exit__()
+        print(profiler.report())
+        return result
+
+
+def profile(source: str, env: Environment|None = None, compiled: bool = False, sort: str = 'inclusive') -> list[ProfileRow]:
+    """统计source中全部表达式的执行,返回排好序的统计表"""
+    from interpreter import StrGen, TokenGen, GenExp
+    from lisp_shell_config import MAX_IN
+    env = run_env if env is None else env
+    tokengen = TokenGen(StrGen(source, MAX_IN), 1)
+    with Profiler() as profiler:
+        while True:
+            try:
+                exp = GenExp(tokengen)
+            except EndOfSource:
+                break
+            analyze_eval.eval(analyze(exp, compiled), env)
+    return profiler.table(sort)
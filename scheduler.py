@@ -0,0 +1,102 @@
+"""
+基于fuel的协作式调度:在一个线程中轮流运行多个程序
+
+每个任务每轮最多执行quantum步(见machine.py),用完时挂起并排到队尾,
+因此一个死循环的程序不会阻塞其他程序,每个程序得到大致相同的执行步数
+"""
+from __future__ import annotations
+from collections import deque
+from typing import Any
+from analyze_eval import standard_env, Environment, Exp, InterpretError, LispError
+from machine import run, Continuation
+from analysis_cache import analyze_program
+from lisp_shell_config import SCHEDULER_QUANTUM
+
+
+class Task:
+    """依次求值program中的表达式,results为各表达式的结果,出错时error为对应的InterpretError"""
+    def __init__(self, name: str, program: list[Exp], env: Environment):
+        self.name = name
+        self.program = deque(program)
+        self.env = env
+        self.current: Continuation|None = None
+        self.results: list[Any] = []
+        self.error: InterpretError|None = None
+        # 已经运行的轮数
+        self.slices = 0
+
+    @property
+    def done(self) -> bool:
+        return self.error is not None or (self.current is None and not self.program)
+
+    def step(self, fuel: int) -> None:
+        """运行一轮:继续挂起的表达式,或开始下一个表达式"""
+        self.slices += 1
+        try:
+            if self.current is not None:
+                result = self.current.resume(fuel)
+            else:
+                result = run(self.program.popleft(), self.env, fuel)
+        except InterpretError as e:
+            self.error = e
+            self.current = None
+            return
+        except RecursionError:
+            # map等内置过程中的调用仍使用python栈
+            self.error = LispError('maximum recursion depth exceeded')
+            self.current = None
+            return
+        if type(result) is Continuation:
+            self.current = result
+        else:
+            self.current = None
+            self.results.append(result)
+
+    def __repr__(self) -> str:
+        state = 'error' if self.error is not None else 'done' if self.done else 'running'
+        return f'<Task {self.name} {state}>'
+
+
+class Scheduler:
+    """
+    scheduler.spawn(source)加入任务,scheduler.run()轮流运行直到全部结束
+    也可以反复调用step()自行控制,finished按结束的先后记录任务
+    """
+    def __init__(self, quantum: int = SCHEDULER_QUANTUM):
+        if quantum <= 0:
+            raise ValueError('quantum must be positive')
+        self.quantum = quantum
+        self.ready: deque[Task] = deque()
+        self.tasks: list[Task] = []
+        self.finished: list[Task] = []
+
+    def spawn(self, source: str, env: Environment|None = None, name: str|None = None) -> Task:
+        """解析source中的全部表达式并加入任务,env默认为新建的standard_env(),语法错误立即抛出"""
+        number = len(self.tasks) + 1
+        program = analyze_program(source, number)
+        task = Task(name if name is not None else f'task-{number}', program, standard_env() if env is None else env)
+        self.tasks.append(task)
+        if task.done:
+            self.finished.append(task)
+        else:
+            self.ready.append(task)
+        return task
+
+    def step(self) -> bool:
+        """运行队首的任务一轮,返回是否还有未结束的任务"""
+        if self.ready:
+            task = self.ready.popleft()
+            task.step(self.quantum)
+            if task.done:
+                self.finished.append(task)
+            else:
+                self.ready.append(task)
+        return bool(self.ready)
+
+    def run(self, max_slices: int|None = None) -> list[Task]:
+        """轮流运行直到全部任务结束(或共运行max_slices轮),返回全部任务"""
+        slices = 0
+        while self.ready and (max_slices is None or slices < max_slices):
+            self.step()
+            slices += 1
+        return self.tasks